@@ -6,16 +6,19 @@
 """
 
 # Standard library imports
-import atexit, datetime, requests, subprocess, time, os
+import atexit, datetime, functools, requests, subprocess, sys, time, os, uuid
 from os import urandom, path, getcwd
-from subprocess import check_output
 
 # 3rd-party library imports
 import eventlet
 from flask import Flask, render_template, request, Response, send_from_directory
-from flask_socketio import Namespace, SocketIO
+from flask_socketio import join_room, leave_room, Namespace, SocketIO
 from werkzeug.utils import secure_filename
 
+# Thingpilot library imports
+import progress_codec, readiness
+from progress_aggregator import ProgressAggregator
+
 
 # Global Flask and SocketIO objects
 ALLOWED_FW_EXTENSIONS = {'bin'}
@@ -26,6 +29,66 @@ app = Flask(__name__)
 app.config['SECRET_KEY'] = f"{urandom(64)}"
 app.config['FIRMWARE_FOLDER'] = FIRMWARE_FOLDER
 socketio = SocketIO(app, async_mode='eventlet', logger=True)
+progress = ProgressAggregator(socketio)
+
+# Set by single_process.py when the workers run in this interpreter on an in-memory EventBus
+bus = None
+
+
+def emit_to_worker(event, data=None, namespace=None):
+    if bus is not None:
+        bus.emit(event, data, namespace=namespace)
+    else:
+        socketio.emit(event, data, namespace=namespace)
+
+
+class StationNamespace(Namespace):
+    # Workers connect here first and register their capabilities; the returned dict is the ack
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.start_time = time.time()
+        self.workers = {}
+
+    def on_disconnect(self):
+        for service, worker in list(self.workers.items()):
+            if worker['sid'] == request.sid:
+                print(f"{datetime.datetime.now()} app.py: {service} disconnected")
+                del self.workers[service]
+
+    def on_register(self, registration):
+        registration['sid'] = request.sid
+        registration['registered_at'] = time.time()
+        self.workers[registration['service']] = registration
+
+        print(f"{datetime.datetime.now()} app.py: {registration['service']} ready with {registration['capabilities']}")
+
+        return { 'ack': True, 'services': sorted(self.workers) }
+
+    def on_status(self):
+        return { 'start_time': self.start_time, 
+                 'workers': { service: worker['registered_at'] for service, worker in self.workers.items() } }
+
+
+class WebAppNamespace(Namespace):
+    # Browsers subscribe to the whole station or to a single job and receive progress_frame batches
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+    def _room(self, subscription):
+        if subscription.get('job_id'):
+            return ProgressAggregator.job_room(subscription['job_id'])
+
+        return ProgressAggregator.station_room(subscription.get('station'))
+
+    def on_subscribe(self, subscription=None):
+        subscription = subscription or {}
+
+        join_room(self._room(subscription))
+        progress.snapshot(request.sid, subscription.get('job_id'))
+
+    def on_unsubscribe(self, subscription=None):
+        leave_room(self._room(subscription or {}))
 
 
 class GPIONamespace(Namespace):
@@ -39,18 +102,44 @@ class GPIONamespace(Namespace):
         pass
 
     def on_is_connected(self):
-        socketio.emit('is_connected', namespace='/GPIOManagerNamespace')
+        emit_to_worker('is_connected', namespace='/GPIOManagerNamespace')
 
     def on_is_connected_progress(self, data):
-        socketio.emit('is_connected_progress', data, namespace='/WebAppNamespace')
+        progress.publish('is_connected_progress', data)
+
+    def on_get_detect_history(self):
+        emit_to_worker('get_detect_history', namespace='/GPIOManagerNamespace')
+
+    def on_detect_history_progress(self, data):
+        progress.publish('detect_history_progress', data)
 
 
 class DeviceNamespace(Namespace):
+    # How long a run_test/run_provision job may wait in the STM32L0 job queue, e.g. behind a long
+    # program_bin, and then how long it has from starting to get the CPU running
+    QUEUE_TIMEOUT_S = 300
+    HANDOFF_TIMEOUT_S = 30
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-        self._can_test = False
-        self._can_provision = False
+        # job_id -> { 'started': Event sent once the job leaves the STM32L0 job queue, 
+        #             'cpu_running': Event sent True/False once the CPU is running or failed }
+        self._handoffs = {}
+
+    # Workers may send msgpack packets (see progress_codec.py); browsers always get dicts. A
+    # packet that can't be decoded here has already been logged and is dropped
+    def _decode_progress(func):
+        @functools.wraps(func)
+        def wrapper(self, data):
+            record = progress_codec.decode(data)
+
+            if record is None:
+                return
+
+            return func(self, record)
+
+        return wrapper
 
     def on_connect(self):
         pass
@@ -58,71 +147,126 @@ class DeviceNamespace(Namespace):
     def on_disconnect(self):
         pass
     
+    @_decode_progress
+    def on_job_progress(self, data):
+        handoff = self._handoffs.get(data.get('job_id'))
+
+        if handoff is not None:
+            if not handoff['started'].ready():
+                handoff['started'].send(True)
+
+            if data['state'] == 'failed' and not handoff['cpu_running'].ready():
+                handoff['cpu_running'].send(False)
+
+        progress.publish('job_progress', data)
+
     def on_get_unique_id(self):
-        socketio.emit('get_unique_id', namespace='/STM32L0Namespace')
+        emit_to_worker('get_unique_id', namespace='/STM32L0Namespace')
 
+    @_decode_progress
     def on_get_unique_id_progress(self, data):
-        socketio.emit('get_unique_id_progress', data, namespace='/WebAppNamespace')
+        progress.publish('get_unique_id_progress', data)
 
-    def on_program_bin(self, binary):
-        socketio.emit('program_bin', binary, namespace='/STM32L0Namespace')
+    def on_program_bin(self, binary, differential=False):
+        emit_to_worker('program_bin', (binary, differential), namespace='/STM32L0Namespace')
 
+    @_decode_progress
     def on_program_bin_progress(self, data):
         if data['message'] != '':
+            # Only the message is split up; job_id, step, verify_mode, time_taken etc. go through as sent
             if 'enabled\nwrote' in data['message']:
                 messages = data['message'].split('\n')
 
                 for msg in messages[0:2]:
-                    socketio.emit('program_bin_progress', { 'success': True, 'message': msg, 'error': ''}, namespace='/WebAppNamespace')
+                    progress.publish('program_bin_progress', dict(data, message=msg))
             elif 'verified' in data['message']:
                 msg = data['message'].split('\n')[0]
-                socketio.emit('program_bin_progress', { 'success': True, 'message': msg, 'error': ''}, namespace='/WebAppNamespace')
+                progress.publish('program_bin_progress', dict(data, message=msg))
             else:
-                socketio.emit('program_bin_progress', data, namespace='/WebAppNamespace')
+                progress.publish('program_bin_progress', data)
 
-    def on_run_test(self, module):
-        self._can_test = False
+    def on_flash_and_test(self, binary, module, handoff='test', url=None, differential=False):
+        job_id = uuid.uuid4().hex[:8]
 
-        socketio.emit('run_test', namespace='/STM32L0Namespace')
+        emit_to_worker('flash_and_test', (binary, module, handoff, url, differential, job_id), namespace='/STM32L0Namespace')
 
-        start_time = time.time()
+    # The CPU is already running firmware when the flash job hands off, so the STM32L0 
+    # init/reset run stage used by on_run_test/on_run_provision is skipped
+    @_decode_progress
+    def on_flash_and_test_handoff(self, data):
+        if data['handoff'] == 'provision':
+            emit_to_worker('run_provision', (data['module'], data['url'], data['uid'], data['job_id']), namespace='/ProvisionerNamespace')
+        else:
+            emit_to_worker('run_test', (data['module'].lower(), data['job_id']), namespace='/HWTestNamespace')
 
-        while not self._can_test:
-            socketio.sleep(0.1)
+    def _wait_for_handoff(self, event, job_id, *args):
+        handoff = { 'started': eventlet.event.Event(), 'cpu_running': eventlet.event.Event() }
+        self._handoffs[job_id] = handoff
 
-            if time.time() > (start_time + 1000):
-                socketio.emit('run_test_progress', { 'success': False, 'message': 'Failed to place target CPU into control mode', 'error': 'Timeout'}, namespace='/WebAppNamespace')
+        emit_to_worker(event, (*args, job_id), namespace='/STM32L0Namespace')
 
-        if self._can_test:
-            socketio.emit('run_test', module.lower(), namespace='/HWTestNamespace')
+        started = None
+        cpu_running = None
 
-    def on_run_test_progress(self, data):
-        if 'Target CPU running' in data['message']:
-            self._can_test = True 
+        # Queue wait and the hand-off itself are timed separately, so a job queued behind a long
+        # one isn't given up on before it has had a chance to run
+        try:
+            with eventlet.Timeout(DeviceNamespace.QUEUE_TIMEOUT_S, False):
+                started = handoff['started'].wait()
 
-        socketio.emit('run_test_progress', data, namespace='/WebAppNamespace')  
+            if started:
+                with eventlet.Timeout(DeviceNamespace.HANDOFF_TIMEOUT_S, False):
+                    cpu_running = handoff['cpu_running'].wait()
+        finally:
+            self._handoffs.pop(job_id, None)
 
-    def on_run_provision(self, module, url, uid):
-        self._can_provision = False
+        if cpu_running is None:
+            # Drop the job if it is still queued so the CPU isn't reset after we've given up on it
+            emit_to_worker('cancel_job', job_id, namespace='/STM32L0Namespace')
 
-        socketio.emit('run_provision', namespace='/STM32L0Namespace')
+            progress.publish(f'{event}_progress', { 'success': False, 'message': 'Failed to place target CPU into control mode', 
+                                                    'error': 'Timeout' if started else 'Queue timeout', 'job_id': job_id })
 
-        start_time = time.time()
+        return cpu_running
 
-        while not self._can_provision:
-            socketio.sleep(0.1)
+    def _signal_handoff(self, data):
+        handoff = self._handoffs.get(data.get('job_id'))
 
-            if time.time() > (start_time + 1000):
-                socketio.emit('run_provision_progress', { 'success': False, 'message': 'Failed to place target CPU into control mode', 'error': 'Timeout'}, namespace='/WebAppNamespace')
-        
-        if self._can_provision:
-            socketio.emit('run_provision', (module, url, uid), namespace='/ProvisionerNamespace')
+        if handoff is not None and not handoff['cpu_running'].ready():
+            if 'Target CPU running' in data['message']:
+                handoff['cpu_running'].send(True)
+            elif not data['success']:
+                handoff['cpu_running'].send(False)
+            else:
+                return
+
+            # Progress from the job means it has left the queue, should job_progress be late
+            if not handoff['started'].ready():
+                handoff['started'].send(True)
+
+    def on_run_test(self, module):
+        job_id = uuid.uuid4().hex[:8]
 
+        if self._wait_for_handoff('run_test', job_id):
+            emit_to_worker('run_test', (module.lower(), job_id), namespace='/HWTestNamespace')
+
+    @_decode_progress
+    def on_run_test_progress(self, data):
+        self._signal_handoff(data)
+
+        progress.publish('run_test_progress', data)  
+
+    def on_run_provision(self, module, url, uid):
+        job_id = uuid.uuid4().hex[:8]
+
+        if self._wait_for_handoff('run_provision', job_id):
+            emit_to_worker('run_provision', (module, url, uid, job_id), namespace='/ProvisionerNamespace')
+
+    @_decode_progress
     def on_run_provision_progress(self, data):
-        if 'Target CPU running' in data['message']:
-            self._can_provision = True 
+        self._signal_handoff(data)
 
-        socketio.emit('run_provision_progress', data, namespace='/WebAppNamespace')  
+        progress.publish('run_provision_progress', data)  
         
 
 @app.route('/')
@@ -170,21 +314,19 @@ def exit_handler():
     exit()
 
 
-def get_ip_address():
-    ip = check_output(['hostname', '-I'])
-    ip = ip.split()[0]
-    ip = ip.decode('utf-8')
-
-    return ip
-
-
-if __name__ == '__main__':
+def run(device_namespace=None, gpio_namespace=None, use_reloader=True):
     atexit.register(exit_handler)
 
-    socketio.on_namespace(DeviceNamespace('/DeviceNamespace'))
-    socketio.on_namespace(GPIONamespace('/GPIONamespace'))
+    socketio.on_namespace(device_namespace or DeviceNamespace('/DeviceNamespace'))
+    socketio.on_namespace(gpio_namespace or GPIONamespace('/GPIONamespace'))
+    socketio.on_namespace(StationNamespace('/StationNamespace'))
+    socketio.on_namespace(WebAppNamespace('/WebAppNamespace'))
 
     try:      
-        socketio.run(app, host=get_ip_address(), port=80, debug=True)
+        socketio.run(app, host=readiness.server_address(), port=80, debug=True, use_reloader=use_reloader)
     except KeyboardInterrupt:
-        sys.exit()
\ No newline at end of file
+        sys.exit()
+
+
+if __name__ == '__main__':
+    run()
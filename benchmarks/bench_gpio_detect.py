@@ -0,0 +1,98 @@
+"""
+    file:    bench_gpio_detect.py
+    version: 0.2.0
+    author:  Adam Mitchell
+    brief:   Measures GPIOManager module detection on the simulated GPIO backend: latency from the
+             detect line settling to the is_connected_progress emit, how many emits a bouncy 
+             insert/remove produces, and CPU used while idle. Compares edge detection with the 
+             polling fallback. Run from the repository root:
+             python benchmarks/bench_gpio_detect.py [cycles] [bounces]
+"""
+
+# Standard library imports
+import inspect, os, sys, threading, time
+
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+sys.path.insert(0, os.path.dirname(currentdir))
+
+os.environ['RTP_GPIO_BACKEND'] = 'sim'
+
+# Thingpilot library imports
+import gpio_backend, gpio_manager
+
+
+class EmitRecorder():
+    def __init__(self):
+        self.emits = []
+        self.emitted = threading.Event()
+
+    def emit(self, event, data=None, namespace=None):
+        self.emits.append((time.perf_counter(), data))
+        self.emitted.set()
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def start_background_task(self, target, *args, **kwargs):
+        thread = threading.Thread(target=target, args=args, kwargs=kwargs, daemon=True)
+        thread.start()
+
+        return thread
+
+
+def run(mode, cycles, bounces):
+    sim = gpio_backend.SimulatedGPIO()
+    recorder = EmitRecorder()
+
+    gpio_manager.gpio = sim
+    gpio_manager.sio = recorder
+
+    manager = gpio_manager.GPIOManager()
+
+    if mode == 'edge':
+        manager.start()
+    else:
+        manager._started = True
+        recorder.start_background_task(manager.poll)
+
+    time.sleep(0.2)
+    latencies = []
+    emits_before = len(recorder.emits)
+
+    for cycle in range(cycles * 2):
+        recorder.emitted.clear()
+        emits = len(recorder.emits)
+
+        if cycle % 2 == 0:
+            sim.insert_module(gpio_manager.GPIOManager.DETECT_PIN, bounces, wait=True)
+        else:
+            sim.remove_module(gpio_manager.GPIOManager.DETECT_PIN, bounces, wait=True)
+
+        settled = time.perf_counter()
+
+        if recorder.emitted.wait(1):
+            latencies.append(recorder.emits[emits][0] - settled)
+
+        time.sleep(0.3)
+
+    emits = len(recorder.emits) - emits_before
+
+    idle_start = time.process_time()
+    time.sleep(2)
+    idle_cpu = (time.process_time() - idle_start) / 2
+
+    latencies.sort()
+    mean = sum(latencies) / len(latencies) if latencies else float('nan')
+
+    print(f"{mode:>5}: {emits} emits for {cycles * 2} transitions, latency mean {mean * 1000:6.1f} ms, "
+          f"max {latencies[-1] * 1000 if latencies else float('nan'):6.1f} ms, idle CPU {idle_cpu * 100:5.2f}%, "
+          f"{sim.calls['input']} input() calls")
+
+
+if __name__ == '__main__':
+    cycles = int(sys.argv[1]) if len(sys.argv) > 1 else 10
+    bounces = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+    # The poll thread can't be stopped, so it goes last
+    for mode in ('edge', 'poll'):
+        run(mode, cycles, bounces)
@@ -0,0 +1,99 @@
+"""
+    file:    bench_gpio_session.py
+    version: 0.2.0
+    author:  Adam Mitchell
+    brief:   Measures the per-pin GPIO overhead of the hardware test's pin reads: configuring and
+             releasing every pin on every toggle (setmode/setup/input/cleanup) against a
+             GPIOSession configured once per run, read one pin at a time and as a group. Runs on
+             the simulated backend by default, with optional per-call latency; on a Pi run it
+             with RTP_GPIO_BACKEND=rpi or gpiod (and the GPIO manager stopped) to measure the
+             real driver. Run from the repository root:
+             python benchmarks/bench_gpio_session.py [module] [gpio_latency_us] [iterations]
+"""
+
+# Standard library imports
+import inspect, os, sys, time
+
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+sys.path.insert(0, os.path.dirname(currentdir))
+
+os.environ.setdefault('RTP_GPIO_BACKEND', 'sim')
+
+# Thingpilot library imports
+import gpio_backend
+from module_tests import hardware_test
+
+
+def per_toggle(gpio, pins):
+    # What the hardware test used to do for every high and every low check
+    for _ in range(2):
+        for pin in pins:
+            gpio.setmode(gpio.BCM)
+            gpio.setup(pin, gpio.IN)
+            gpio.input(pin)
+            gpio.cleanup()
+
+
+def session_single(gpio, pins):
+    with gpio_backend.GPIOSession(gpio, pins, reserved=gpio_backend.MANAGED_CHANNELS) as session:
+        for _ in range(2):
+            for pin in pins:
+                session.read_one(pin)
+
+
+def session_group(gpio, pins):
+    with gpio_backend.GPIOSession(gpio, pins, reserved=gpio_backend.MANAGED_CHANNELS) as session:
+        for _ in range(2):
+            session.read()
+
+
+def manager_channels_intact(gpio):
+    directions = getattr(gpio, 'directions', None)
+
+    if directions is None:
+        return 'n/a'
+
+    return all(channel in directions for channel in gpio_backend.MANAGED_CHANNELS)
+
+
+def main(module='wright', latency_us=0, iterations=20):
+    gpio = gpio_backend.load()
+
+    if hasattr(gpio, 'latency_s'):
+        gpio.latency_s = latency_us / 1e6
+
+    test = hardware_test.HardwareTest()
+    test.set_module(module)
+    pins = [ mapping['rpi_pin_no'] for _, mapping in test._testable_pins() ]
+
+    print(f"{module}: {len(pins)} test pins on {type(gpio).__name__}, {latency_us} us per GPIO call")
+
+    for name, run in (('per_toggle', per_toggle), ('session_single', session_single), ('session_group', session_group)):
+        # Stand in for the lines GPIOManager holds, so a run that releases them shows up
+        if hasattr(gpio, 'directions'):
+            gpio.setup(list(gpio_backend.MANAGED_CHANNELS), gpio.OUT)
+            gpio.calls.clear()
+
+        timings = []
+
+        for _ in range(iterations):
+            start = time.perf_counter()
+            run(gpio, pins)
+            timings.append(time.perf_counter() - start)
+
+        per_pin_us = min(timings) / len(pins) * 1e6
+        calls = dict(gpio.calls) if hasattr(gpio, 'calls') else {}
+        calls = { call: count // iterations for call, count in calls.items() }
+
+        print(f"  {name:15s} {per_pin_us:9.1f} us/pin, manager lines intact: {manager_channels_intact(gpio)}")
+
+        if calls:
+            print(f"    GPIO calls per run: {calls}")
+
+    if hasattr(gpio, 'directions'):
+        gpio.cleanup()
+
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    main(args[0] if args else 'wright', *[ int(arg) for arg in args[1:] ])
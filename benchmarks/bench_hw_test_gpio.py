@@ -0,0 +1,63 @@
+"""
+    file:    bench_hw_test_gpio.py
+    version: 0.2.0
+    author:  Adam Mitchell
+    brief:   Times HardwareTest.test_gpio off-Pi against a simulated module on the simulated GPIO
+             backend. Reports wall time, pins per second and the number of GPIO calls made, with 
+             optional per-call latency to mimic the real driver, for each GPIO test mode over 
+             both legacy text and framed UART links. Run from the repository root:
+             python benchmarks/bench_hw_test_gpio.py [module] [gpio_latency_us] [iterations]
+"""
+
+# Standard library imports
+import contextlib, inspect, io, os, sys, time
+
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+sys.path.insert(0, os.path.dirname(currentdir))
+
+os.environ['RTP_GPIO_BACKEND'] = 'sim'
+
+# Thingpilot library imports
+import gpio_backend, uart_link
+from module_tests import hardware_test
+from sim_dut import SimulatedDUT
+
+
+def main(module='wright', latency_us=0, iterations=3):
+    sim = gpio_backend.load()
+    sim.latency_s = latency_us / 1e6
+
+    for mode, framed in [ (mode, framed) for mode in hardware_test.HardwareTest.GPIO_TEST_MODES for framed in (False, True) ]:
+        test = hardware_test.HardwareTest(gpio_test_mode=mode)
+        test.set_module(module)
+        test.uart = SimulatedDUT(sim, test.pinmap, timeout=uart_link.IDLE_TIMEOUT_S)
+        test.link = uart_link.UARTLink(test.uart, framed=framed).start()
+
+        timings = []
+
+        for _ in range(iterations):
+            sim.calls.clear()
+            test.uart.bytes_written = test.uart.bytes_read = 0
+            start = time.perf_counter()
+
+            # HardwareTest logs every UART line
+            with contextlib.redirect_stdout(io.StringIO()):
+                result = test.test_gpio()
+
+            timings.append(time.perf_counter() - start)
+
+        pins = len(result['results']['results'])
+        best = min(timings)
+
+        test.link.close()
+        link = 'framed' if framed else 'text'
+
+        print(f"{module} {mode} ({link}): {pins} pins, best {best * 1000:.0f} ms ({pins / best:.1f} pins/s), success={result['success']}, "
+              f"{test.uart.bytes_written + test.uart.bytes_read} UART bytes")
+        print(f"  GPIO calls per run: {dict(sim.calls)}")
+
+
+if __name__ == '__main__':
+    main(sys.argv[1] if len(sys.argv) > 1 else 'wright', 
+         float(sys.argv[2]) if len(sys.argv) > 2 else 0, 
+         int(sys.argv[3]) if len(sys.argv) > 3 else 3)
@@ -0,0 +1,56 @@
+"""
+    file:    bench_progress_codec.py
+    version: 0.2.0
+    author:  Adam Mitchell
+    brief:   Compares payload size and encode+decode time of JSON against progress_codec's msgpack
+             packets for typical progress records. Needs msgpack. Run from the repository root:
+             python benchmarks/bench_progress_codec.py [iterations]
+"""
+
+# Standard library imports
+import inspect, json, os, sys, time
+
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+sys.path.insert(0, os.path.dirname(currentdir))
+
+# Thingpilot library imports
+import progress_codec
+
+
+RECORDS = {
+    'reset run': { 'success': True, 'message': 'Target CPU running', 'error': '', 'command': 'reset run', 
+                   'state': 'running', 'step': 'reset run', 'attempts': 1, 'start_time': 1581000000.125, 
+                   'end_time': 1581000000.166, 'duration': 0.041, 'job_id': '3f2a9c1e' },
+    'job status': { 'job_id': '3f2a9c1e', 'name': 'on_program_bin', 'state': 'started', 'queue_depth': 2, 
+                    'wait_time': 0.115 },
+    'gpio test': { 'success': True, 'message': 'GPIO', 'error': '', 'step': 'test_gpio', 'job_id': '3f2a9c1e',
+                   'results': { 'time_taken': 5120, 'type': 'GPIO', 
+                                'results': [ { 'pin': pin, 'high': True, 'low': True } for pin in range(1, 41) ] } }
+}
+
+
+def time_per_call(func, record, iterations):
+    start = time.perf_counter()
+
+    for _ in range(iterations):
+        func(record)
+
+    return (time.perf_counter() - start) / iterations
+
+
+if __name__ == '__main__':
+    if progress_codec.msgpack is None:
+        print('msgpack is not installed')
+        sys.exit(1)
+
+    iterations = int(sys.argv[1]) if len(sys.argv) > 1 else 20000
+
+    for name, record in RECORDS.items():
+        json_size = len(json.dumps(record).encode('utf-8'))
+        packed_size = len(progress_codec.encode(record))
+
+        json_time = time_per_call(lambda r: json.loads(json.dumps(r)), record, iterations)
+        packed_time = time_per_call(lambda r: progress_codec.decode(progress_codec.encode(r)), record, iterations)
+
+        print(f"{name:>10}: json {json_size:5d} B {json_time * 1e6:6.1f} us, "
+              f"msgpack {packed_size:5d} B {packed_time * 1e6:6.1f} us")
@@ -0,0 +1,129 @@
+"""
+    file:    bench_progress_fanout.py
+    version: 0.2.0
+    author:  Adam Mitchell
+    brief:   Load test for progress fan-out to browsers. Starts a local Flask-SocketIO server, 
+             connects many simulated browser clients to /WebAppNamespace and replays a DUT cycle's
+             worth of progress records, first as one emit per record (the old behaviour) and then
+             through ProgressAggregator frames. Reports Socket.IO messages per client and 
+             publish-to-receive latency. Run from the repository root:
+             python benchmarks/bench_progress_fanout.py [clients] [cycles]
+"""
+
+# Standard library imports
+import inspect, os, sys, time
+
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+sys.path.insert(0, os.path.dirname(currentdir))
+
+# 3rd-party library imports
+import eventlet; eventlet.monkey_patch()
+import socketio as socketio_client
+from flask import Flask
+from flask_socketio import join_room, Namespace, SocketIO
+
+# Thingpilot library imports
+from progress_aggregator import ProgressAggregator
+
+
+PORT = 5055
+
+# Roughly what one program + hardware test cycle sends to the browser
+CYCLE = ([ ('program_bin_progress', { 'success': True, 'message': message, 'error': '' }) 
+           for message in [ 'Target CPU successfully initialised', 'Target CPU successfully halted', 'auto erase enabled', 
+                            'wrote 65536 bytes from file firmware.bin', 'verified 65536 bytes', 'Target CPU running' ] ] +
+         [ ('run_test_progress', { 'success': True, 'message': f'step {step}', 'error': '', 'job_id': 'bench' }) for step in range(12) ] +
+         [ ('run_test_progress', { 'success': True, 'message': 'GPIO', 'error': '', 'job_id': 'bench', 
+                                   'results': { 'time_taken': 5120, 'type': 'GPIO', 
+                                                'results': [ { 'pin': pin, 'high': True, 'low': True } for pin in range(40) ] } }) ])
+
+
+class BenchWebAppNamespace(Namespace):
+    def on_subscribe(self, subscription=None):
+        join_room(ProgressAggregator.station_room())
+
+
+class BrowserClient():
+    def __init__(self):
+        self.messages = 0
+        self.latencies = []
+        self.client = socketio_client.Client()
+
+        self.client.on('progress_frame', self.on_frame, namespace='/WebAppNamespace')
+
+        for event in set(event for event, _ in CYCLE):
+            self.client.on(event, self.on_record, namespace='/WebAppNamespace')
+
+    def connect(self):
+        self.client.connect(f'http://127.0.0.1:{PORT}', namespaces=[ '/WebAppNamespace' ])
+        self.client.emit('subscribe', {}, namespace='/WebAppNamespace')
+
+    def on_record(self, record):
+        self.messages += 1
+        self.latencies.append(time.time() - record['sent_at'])
+
+    def on_frame(self, frame):
+        self.messages += 1
+        now = time.time()
+
+        for entry in frame['entries']:
+            if 'sent_at' in entry.get('v', entry.get('d', {})):
+                self.latencies.append(now - entry.get('v', entry.get('d'))['sent_at'])
+
+
+def replay(publish, cycles):
+    for _ in range(cycles):
+        for event, record in CYCLE:
+            publish(event, dict(record, sent_at=time.time()))
+            eventlet.sleep(0.005)
+
+
+def report(mode, clients, published):
+    latencies = sorted(latency for client in clients for latency in client.latencies)
+    messages = sum(client.messages for client in clients) / len(clients)
+
+    if not latencies:
+        print(f"{mode:>7}: nothing received")
+        return
+
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+
+    print(f"{mode:>7}: {messages:6.0f} messages/client for {published} records, latency mean "
+          f"{sum(latencies) * 1000 / len(latencies):6.1f} ms, p95 {p95 * 1000:6.1f} ms, max {latencies[-1] * 1000:6.1f} ms, "
+          f"{len(latencies) / len(clients) / published * 100:.0f}% delivered")
+
+
+def main(n_clients=50, cycles=5):
+    app = Flask(__name__)
+    socketio = SocketIO(app, async_mode='eventlet')
+    socketio.on_namespace(BenchWebAppNamespace('/WebAppNamespace'))
+
+    eventlet.spawn(socketio.run, app, host='127.0.0.1', port=PORT)
+    eventlet.sleep(1)
+
+    aggregator = ProgressAggregator(socketio)
+    modes = { 'direct': lambda event, record: socketio.emit(event, record, namespace='/WebAppNamespace', 
+                                                            room=ProgressAggregator.station_room()),
+              'frames': aggregator.publish }
+
+    for mode, publish in modes.items():
+        clients = [ BrowserClient() for _ in range(n_clients) ]
+
+        for client in clients:
+            client.connect()
+
+        eventlet.sleep(1)
+
+        replay(publish, cycles)
+        eventlet.sleep(1)
+
+        report(mode, clients, len(CYCLE) * cycles)
+
+        for client in clients:
+            client.client.disconnect()
+
+    socketio.stop()
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 50, int(sys.argv[2]) if len(sys.argv) > 2 else 5)
@@ -0,0 +1,108 @@
+"""
+    file:    bench_startup.py
+    version: 0.2.0
+    author:  Adam Mitchell
+    brief:   Cold-boot benchmark for the station. Starts app.py and the four worker services the 
+             way run.sh does, then polls /StationNamespace until every worker has registered and 
+             reports the time from launch to each registration and to first-DUT-ready (all
+             services up). Needs the Pi, the test HAT and root for port 80. Run from the 
+             repository root: sudo python benchmarks/bench_startup.py [runs]
+"""
+
+# Standard library imports
+import inspect, os, subprocess, sys, threading, time
+
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+sys.path.insert(0, os.path.dirname(currentdir))
+
+# 3rd-party library imports
+import socketio
+
+# Thingpilot library imports
+import readiness
+
+
+SERVICES = [ 'app.py', 'python_ocd/targets/stm32l0.py', 'module_tests/hardware_test.py', 
+             'module_provision/provision.py', 'gpio_manager.py' ]
+WORKERS = [ 'stm32l0.py', 'hardware_test.py', 'provision.py', 'gpio_manager.py' ]
+
+
+def poll_status(client, timeout_s=120):
+    status = {}
+    deadline = time.time() + timeout_s
+
+    while time.time() < deadline:
+        reply = threading.Event()
+
+        def on_status(data):
+            status.update(data)
+            reply.set()
+
+        client.emit('status', namespace='/StationNamespace', callback=on_status)
+        reply.wait(1)
+
+        if all(worker in status.get('workers', {}) for worker in WORKERS):
+            return status
+
+        time.sleep(0.05)
+
+    return None
+
+
+def run_once():
+    launch_time = time.time()
+    processes = [ subprocess.Popen([ sys.executable, service ], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL) 
+                  for service in SERVICES ]
+
+    client = socketio.Client()
+
+    try:
+        while True:
+            try:
+                client.connect(f'http://{readiness.server_address()}:80', namespaces=[ '/StationNamespace' ])
+                break
+            except socketio.exceptions.ConnectionError:
+                time.sleep(0.05)
+
+        server_up = time.time() - launch_time
+        status = poll_status(client)
+    finally:
+        client.disconnect()
+
+        for process in processes:
+            process.terminate()
+
+        for process in processes:
+            process.wait()
+
+    if status is None:
+        print('timed out waiting for workers to register')
+        return None
+
+    print(f"  server accepting connections: {server_up * 1000:8.0f} ms")
+
+    for worker in WORKERS:
+        print(f"  {worker:>28}: {(status['workers'][worker] - launch_time) * 1000:8.0f} ms")
+
+    ready = max(status['workers'].values()) - launch_time
+    print(f"  {'first-DUT-ready':>28}: {ready * 1000:8.0f} ms")
+
+    return ready
+
+
+if __name__ == '__main__':
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 3
+    timings = []
+
+    for run in range(runs):
+        print(f"run {run + 1}:")
+        ready = run_once()
+
+        if ready is not None:
+            timings.append(ready)
+
+        # Give OpenOCD and port 80 time to be released before the next cold start
+        time.sleep(2)
+
+    if timings:
+        print(f"first-DUT-ready: best {min(timings) * 1000:.0f} ms, mean {sum(timings) * 1000 / len(timings):.0f} ms")
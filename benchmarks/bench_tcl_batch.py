@@ -0,0 +1,54 @@
+"""
+    file:    bench_tcl_batch.py
+    version: 0.2.0
+    author:  Adam Mitchell
+    brief:   Compares the UID read sequence (init, reset halt, mdw) sent one command per 
+             round-trip, as before, against a single OCD.send_batch write. Run from the 
+             repository root: python benchmarks/bench_tcl_batch.py
+"""
+
+# Standard library imports
+import inspect, os, sys, time
+
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+sys.path.insert(0, os.path.dirname(currentdir))
+sys.path.insert(0, currentdir)
+
+# Thingpilot library imports
+from python_ocd.python_ocd import OCD
+from tcl_stub import TclStubServer
+
+
+ITERATIONS = 2000
+
+# init, reset halt + two targets queries, mdw
+SEQUENTIAL_COMMANDS = [ 'init', 'reset halt', 'targets', 'targets', 'mdw 0x1FF80050 3' ]
+BATCH_COMMANDS = [ 'init', 'reset halt', 'mdw 0x1FF80050 3' ]
+
+
+def main():
+    server = TclStubServer().start()
+
+    ocd = OCD('stm32l0_ocd.cfg', server.host, server.port)
+    ocd.sock = server.connect()
+
+    start = time.perf_counter()
+    for _ in range(ITERATIONS):
+        for command in SEQUENTIAL_COMMANDS:
+            ocd.send(command, timeout_s=None)
+    sequential_s = time.perf_counter() - start
+
+    start = time.perf_counter()
+    for _ in range(ITERATIONS):
+        ocd.send_batch(BATCH_COMMANDS, timeout_s=None)
+    batch_s = time.perf_counter() - start
+
+    print(f'sequential: {len(SEQUENTIAL_COMMANDS)} round-trips, {sequential_s * 1e6 / ITERATIONS:.1f} us per UID read')
+    print(f'batched:    1 round-trip,  {batch_s * 1e6 / ITERATIONS:.1f} us per UID read')
+
+    ocd.sock.close()
+    server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+"""
+    file:    bench_tcl_recv.py
+    version: 0.2.0
+    author:  Adam Mitchell
+    brief:   Compares the buffered OCD._recv reader against the previous bytes-concatenation 
+             reader for Tcl replies from a few KB up to several MB. Run from the repository root:
+             python benchmarks/bench_tcl_recv.py
+"""
+
+# Standard library imports
+import inspect, os, sys, time
+
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+sys.path.insert(0, os.path.dirname(currentdir))
+sys.path.insert(0, currentdir)
+
+# Thingpilot library imports
+from python_ocd.python_ocd import OCD
+from tcl_stub import TclStubServer
+
+
+PAYLOAD_SIZES = [ 4 * 1024, 64 * 1024, 512 * 1024, 1024 * 1024, 4 * 1024 * 1024, 8 * 1024 * 1024 ]
+ITERATIONS = 5
+
+
+def legacy_recv(sock, buffer_size=4096):
+    data = bytes()
+
+    while True:
+        chunk = sock.recv(buffer_size)
+        data += chunk
+
+        if bytes(OCD.COMMAND_TOKEN, encoding='utf-8') in chunk:
+            break
+
+    data = data.decode('utf-8').strip()
+
+    return data[:-1]
+
+
+def time_reader(sock, reader, size):
+    best = None
+
+    for _ in range(ITERATIONS):
+        start = time.perf_counter()
+
+        sock.sendall(f'payload {size}'.encode('utf-8') + OCD.COMMAND_TOKEN_BYTES)
+        reply = reader()
+
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+
+        assert len(reply) == size
+
+    return best
+
+
+def main():
+    server = TclStubServer().start()
+
+    ocd = OCD('stm32l0_ocd.cfg', server.host, server.port)
+    ocd.sock = server.connect()
+    legacy_sock = server.connect()
+
+    print(f"{'payload':>10} {'legacy ms':>10} {'legacy ms/MB':>13} {'new ms':>8} {'new ms/MB':>10}")
+
+    for size in PAYLOAD_SIZES:
+        legacy_s = time_reader(legacy_sock, lambda: legacy_recv(legacy_sock), size)
+        new_s = time_reader(ocd.sock, ocd._recv, size)
+        size_mb = size / (1024 * 1024)
+
+        print(f'{size:>10} {legacy_s * 1000:>10.2f} {legacy_s * 1000 / size_mb:>13.2f} '
+              f'{new_s * 1000:>8.2f} {new_s * 1000 / size_mb:>10.2f}')
+
+    ocd.sock.close()
+    legacy_sock.close()
+    server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,70 @@
+"""
+    file:    bench_tcl_timeout.py
+    version: 0.2.0
+    author:  Adam Mitchell
+    brief:   Per-command overhead of OCD.send with a timeout: the previous threading.Timer per 
+             command against the socket deadline now used. Both share the same reply reader, so 
+             the difference is the cost of the timeout mechanism. Run from the repository root:
+             python benchmarks/bench_tcl_timeout.py
+"""
+
+# Standard library imports
+import inspect, os, sys, threading, time
+
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+sys.path.insert(0, os.path.dirname(currentdir))
+sys.path.insert(0, currentdir)
+
+# Thingpilot library imports
+from python_ocd.python_ocd import OCD
+from tcl_stub import TclStubServer
+
+
+ITERATIONS = 5000
+TIMEOUT_S = 20
+
+
+def timer_send(ocd, command, timeout_s=TIMEOUT_S):
+    def handle_timeout():
+        ocd.timeout_flag = True
+
+    ocd.sock.sendall((command + OCD.COMMAND_TOKEN).encode('utf-8'))
+
+    timer = threading.Timer(timeout_s, handle_timeout)
+    timer.start()
+
+    try:
+        return ocd._recv()
+    finally:
+        timer.cancel()
+
+
+def measure(func):
+    start = time.perf_counter()
+
+    for _ in range(ITERATIONS):
+        func()
+
+    return (time.perf_counter() - start) * 1e6 / ITERATIONS
+
+
+def main():
+    server = TclStubServer().start()
+
+    ocd = OCD('stm32l0_ocd.cfg', server.host, server.port)
+    ocd.sock = server.connect()
+
+    baseline_us = measure(lambda: ocd.send('targets', timeout_s=None))
+    timer_us = measure(lambda: timer_send(ocd, 'targets'))
+    deadline_us = measure(lambda: ocd.send('targets', timeout_s=TIMEOUT_S))
+
+    print(f'no timeout:          {baseline_us:8.1f} us per command')
+    print(f'threading.Timer:     {timer_us:8.1f} us per command (+{timer_us - baseline_us:.1f} us)')
+    print(f'socket deadline:     {deadline_us:8.1f} us per command (+{deadline_us - baseline_us:.1f} us)')
+
+    ocd.sock.close()
+    server.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,113 @@
+"""
+    file:    bench_uart_link.py
+    version: 0.2.0
+    author:  Adam Mitchell
+    brief:   Throughput of the framed UART link at each baud rate uart_link can negotiate:
+             AT+PING round trips per second and payload bytes per second, plus the time
+             negotiate_baud takes cold and with the per-module cache for modules that top out at
+             different rates. Runs against the simulated module by default. On a Pi, pass the
+             serial device to measure a real module running test firmware (reset it into test
+             mode when prompted). Run from the repository root:
+             python benchmarks/bench_uart_link.py [payload_bytes] [round_trips] [device]
+"""
+
+# Standard library imports
+import contextlib, inspect, io, os, sys, time
+
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+sys.path.insert(0, os.path.dirname(currentdir))
+
+os.environ.setdefault('RTP_GPIO_BACKEND', 'sim')
+
+# Thingpilot library imports
+import gpio_backend, uart_link
+from module_tests import pinmap
+from sim_dut import SimulatedDUT
+
+
+def ping(link, payload_bytes, round_trips):
+    payload = (uart_link.BAUD_PROBE * (payload_bytes // len(uart_link.BAUD_PROBE) + 1))[:payload_bytes]
+    failures = 0
+    start = time.perf_counter()
+
+    # The link logs every message it sends and receives
+    with contextlib.redirect_stdout(io.StringIO()):
+        for _ in range(round_trips):
+            if link.transact(f'AT+PING={payload}', f'PONG: {payload}', timeout_s=0.5) is None:
+                failures += 1
+
+    elapsed = time.perf_counter() - start
+
+    return round_trips / elapsed, 2 * payload_bytes * round_trips / elapsed, failures
+
+
+def simulated(payload_bytes, round_trips):
+    gpio = gpio_backend.load()
+
+    for rate in [ uart_link.DEFAULT_BAUD ] + sorted(uart_link.BAUD_RATES):
+        dut = SimulatedDUT(gpio, pinmap.wright, baudrate=rate, timeout=uart_link.IDLE_TIMEOUT_S)
+        link = uart_link.UARTLink(dut, framed=True).start()
+        per_s, bytes_per_s, failures = ping(link, payload_bytes, round_trips)
+        link.close()
+
+        print(f"{rate:8d} baud: {per_s:7.1f} round trips/s, {bytes_per_s / 1000:7.1f} kB/s payload, {failures} failed")
+
+    for max_baud in (1000000, 460800, 115200):
+        timings = []
+
+        for _ in range(2):
+            dut = SimulatedDUT(gpio, pinmap.wright, timeout=uart_link.IDLE_TIMEOUT_S, max_baud=max_baud)
+            link = uart_link.UARTLink(dut, framed=True).start()
+            start = time.perf_counter()
+
+            with contextlib.redirect_stdout(io.StringIO()):
+                rate = link.negotiate_baud(cache_key=f'bench_{max_baud}')
+
+            timings.append(time.perf_counter() - start)
+            link.close()
+
+        print(f"module good to {max_baud:7d}: negotiated {rate} baud in {timings[0] * 1000:.0f} ms cold, "
+              f"{timings[1] * 1000:.0f} ms cached")
+
+
+def hardware(device, payload_bytes, round_trips):
+    import serial
+
+    port = serial.Serial(device, uart_link.DEFAULT_BAUD, timeout=uart_link.IDLE_TIMEOUT_S)
+    link = uart_link.UARTLink(port, tag='bench_uart_link.py:').start()
+
+    print("Reset the module into test mode...")
+    ctrl = link.expect('AT+CTRL').wait(30)
+
+    if ctrl is None:
+        print('No AT+CTRL from the module')
+        link.close()
+        return
+
+    link.framed = ctrl.framed
+    link.send('TEST')
+    link.send('OK')
+
+    per_s, bytes_per_s, failures = ping(link, payload_bytes, round_trips)
+    print(f"{port.baudrate:8d} baud: {per_s:7.1f} round trips/s, {bytes_per_s / 1000:7.1f} kB/s payload, {failures} failed")
+
+    start = time.perf_counter()
+    rate = link.negotiate_baud()
+    print(f"negotiated {rate} baud in {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    per_s, bytes_per_s, failures = ping(link, payload_bytes, round_trips)
+    print(f"{rate:8d} baud: {per_s:7.1f} round trips/s, {bytes_per_s / 1000:7.1f} kB/s payload, "
+          f"{failures} failed, {link.crc_errors} CRC errors")
+
+    link.transact('AT+END', 'OK', timeout_s=0.5)
+    link.close()
+
+
+if __name__ == '__main__':
+    payload_bytes = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    round_trips = int(sys.argv[2]) if len(sys.argv) > 2 else 50
+
+    if len(sys.argv) > 3:
+        hardware(sys.argv[3], payload_bytes, round_trips)
+    else:
+        simulated(payload_bytes, round_trips)
@@ -0,0 +1,50 @@
+"""
+    file:    bench_verify.py
+    version: 0.2.0
+    author:  Adam Mitchell
+    brief:   Times each OCDTarget.verify_image mode against a connected STM32L0 DUT. Needs OpenOCD
+             and the test HAT. Flashes the given firmware once, then verifies it repeatedly. Run 
+             from the repository root: python benchmarks/bench_verify.py <firmware.bin> [iterations]
+"""
+
+# Standard library imports
+import inspect, os, sys, time
+
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+sys.path.insert(0, os.path.dirname(currentdir))
+
+# Thingpilot library imports
+from python_ocd.targets.stm32l0 import STM32L0
+
+
+def main(firmware, iterations=5):
+    firmware = f'python_ocd/firmware/{firmware}'
+    cpu = STM32L0()
+
+    with cpu:
+        cpu.init()
+        cpu.reset_halt()
+
+        result = cpu.flash_write_image_bin(firmware, STM32L0.PGM_START_ADDRESS)
+        print(f"flash: {result['message']}")
+
+        for mode in STM32L0.VERIFY_MODES:
+            timings = []
+
+            for _ in range(iterations):
+                start = time.perf_counter()
+                result = cpu.verify_image(firmware, STM32L0.PGM_START_ADDRESS, mode)
+                timings.append(time.perf_counter() - start)
+
+            print(f"{mode:>9}: best {min(timings) * 1000:8.1f} ms, mean {sum(timings) * 1000 / len(timings):8.1f} ms, "
+                  f"ran as {result['verify_mode']}, success={result['success']}")
+
+        cpu.reset_run()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 2:
+        print(__doc__)
+        sys.exit(1)
+
+    main(sys.argv[1], int(sys.argv[2]) if len(sys.argv) > 2 else 5)
@@ -0,0 +1,204 @@
+"""
+    file:    sim_dut.py
+    version: 0.2.0
+    author:  Adam Mitchell
+    brief:   Simulated module under test for the off-Pi benchmarks. Looks like the pyserial port
+             HardwareTest talks to and answers the test firmware's AT+GPIO and bulk AT+GPIOS
+             commands by driving the mapped Raspberry Pi pins on a SimulatedGPIO backend. Set
+             bulk=False to model firmware without AT+GPIOS. Commands sent as uart_link frames
+             are answered with frames echoing their seq, plain text with plain text lines.
+             Serial time is modelled from the configured baud rate: replies only become
+             readable once they would have been clocked out. The module follows the AT+BAUD
+             negotiation (or ignores it with negotiate=False); above max_baud every reply gets a
+             corrupted byte, and while the two ends disagree on the rate nothing gets through 
+             intact.
+"""
+
+# Standard library imports
+import collections, inspect, os, sys, threading, time
+
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+sys.path.insert(0, os.path.dirname(currentdir))
+
+# Thingpilot library imports
+import uart_link
+
+
+class SimulatedDUT():
+    def __init__(self, gpio, pinmap, baudrate=9600, timeout=0.2, bulk=True, max_baud=1000000, negotiate=True):
+        self.gpio = gpio
+        self.bulk = bulk
+        self.negotiate = negotiate
+        self.timeout = timeout
+        self.is_open = True
+
+        self.cpu_to_rpi = { mapping['cpu_pin_no']: mapping['rpi_pin_no'] for mapping in pinmap.values() }
+        self.bytes_written = 0
+        self.bytes_read = 0
+
+        # (time the last byte is on the wire, bytes), oldest first
+        self._replies = collections.deque()
+        self._rx = bytearray()
+        self._line_free = 0
+        self._cancel = False
+        self._ready = threading.Condition()
+
+        # baudrate is the host's end, as on a pyserial port; dut_baud is the module's
+        self.baudrate = baudrate
+        self.dut_baud = baudrate
+        self.max_baud = max_baud
+        self._revert = None
+        self._pending_baud = None
+
+    def _line_time(self, n_bytes, baudrate=None):
+        # 10 bits per byte on the wire: start, 8 data, stop
+        return n_bytes * 10 / (baudrate or self.baudrate)
+
+    def _check_revert(self):
+        if self._revert is not None and time.monotonic() > self._revert[1]:
+            self.dut_baud = self._revert[0]
+            self._revert = None
+
+    def _answer(self, command):
+        if command.startswith('AT+BAUD') and not self.negotiate:
+            return None
+        elif command.startswith('AT+BAUD='):
+            rate = int(command[len('AT+BAUD='):])
+
+            if rate > 1000000:
+                return 'ERROR'
+
+            # Switch once the reply has gone out at the old rate
+            self._revert = (self.dut_baud, time.monotonic() + uart_link.BAUD_REVERT_S)
+            self._pending_baud = rate
+
+            return f'BAUD: {rate}'
+        elif command == 'AT+BAUDOK':
+            self._revert = None
+
+            return 'OK'
+        elif command.startswith('AT+PING='):
+            return f'PONG: {command[len("AT+PING="):]}'
+        elif command.startswith('AT+GPIOS=') and self.bulk:
+            mask, value = (int(field, 16) for field in command[len('AT+GPIOS='):].split(','))
+
+            for cpu_pin, rpi_pin in self.cpu_to_rpi.items():
+                if cpu_pin < 999 and mask & (1 << cpu_pin):
+                    self.gpio.set_level(rpi_pin, (value >> cpu_pin) & 1)
+
+            return f'GPIOS: {mask:x},{value:x}'
+        elif command.startswith('AT+GPIO='):
+            cpu_pin, state = command[len('AT+GPIO='):].split(',')
+            self.gpio.set_level(self.cpu_to_rpi[int(cpu_pin)], int(state))
+
+            return f'GPIO: {cpu_pin}, {state}'
+        elif command == 'AT+END':
+            return 'OK'
+
+        return None
+
+    def _send(self, data):
+        if self.baudrate != self.dut_baud:
+            data = bytes((byte * 7 + 3) & 0xFF for byte in data)
+        elif self.dut_baud > self.max_baud:
+            data = data[:-3] + bytes([ data[-3] ^ 0x10 ]) + data[-2:]
+
+        # The DUT's transmitter queues replies back to back behind anything still going out
+        with self._ready:
+            start = max(time.monotonic(), self._line_free)
+            self._line_free = start + self._line_time(len(data), self.dut_baud)
+            self._replies.append((self._line_free, data))
+            self._ready.notify_all()
+
+    def announce(self, framed=False):
+        # What the firmware sends on boot to ask for test or provisioning mode
+        self._send(uart_link.encode_frame(0, 'AT+CTRL') if framed else b'AT+CTRL\r\n')
+
+    def write(self, data):
+        time.sleep(self._line_time(len(data)))
+        self.bytes_written += len(data)
+        self._check_revert()
+        self._pending_baud = None
+
+        if self.baudrate != self.dut_baud:
+            # Framing errors on the module's side; it sees nothing it can act on
+            return len(data)
+
+        if data[:1] == bytes([ uart_link.SOF ]):
+            ring = uart_link.RingBuffer()
+            ring.write(data)
+
+            for message in uart_link.FrameParser(ring).parse():
+                reply = self._answer(message.text)
+
+                if reply is not None:
+                    self._send(uart_link.encode_frame(message.seq, reply))
+        else:
+            reply = self._answer(data.decode('utf-8'))
+
+            if reply is not None:
+                self._send(f'{reply}\r\n'.encode('utf-8'))
+
+        if self._pending_baud is not None:
+            self.dut_baud = self._pending_baud
+
+        return len(data)
+
+    def _collect(self):
+        now = time.monotonic()
+
+        while self._replies and self._replies[0][0] <= now:
+            self._rx += self._replies.popleft()[1]
+
+    @property
+    def in_waiting(self):
+        with self._ready:
+            self._collect()
+
+            return len(self._rx)
+
+    def read(self, size=1):
+        deadline = time.monotonic() + self.timeout
+
+        with self._ready:
+            while self.is_open:
+                self._collect()
+                now = time.monotonic()
+
+                if self._rx or now >= deadline or self._cancel:
+                    break
+
+                wake = min(deadline, self._replies[0][0]) if self._replies else deadline
+                self._ready.wait(wake - now)
+
+            self._cancel = False
+            data = bytes(self._rx[:size])
+            del self._rx[:size]
+
+        self.bytes_read += len(data)
+
+        return data
+
+    def flush(self):
+        # Writes are modelled as complete when write() returns
+        pass
+
+    def cancel_read(self):
+        # As on pyserial: a read in progress returns straight away with whatever has arrived
+        with self._ready:
+            self._cancel = True
+            self._ready.notify_all()
+
+    def reset_input_buffer(self):
+        # Only what has already arrived; replies still on the wire keep coming
+        with self._ready:
+            self._collect()
+            self._rx.clear()
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        with self._ready:
+            self.is_open = False
+            self._ready.notify_all()
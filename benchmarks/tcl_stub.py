@@ -0,0 +1,82 @@
+"""
+    file:    tcl_stub.py
+    version: 0.2.0
+    author:  Adam Mitchell
+    brief:   Minimal stand-in for the OpenOCD Tcl server used by the benchmarks. Replies to every
+             command with a canned response terminated by the OpenOCD command token.
+"""
+
+# Standard library imports
+import socket, threading
+
+
+COMMAND_TOKEN = b'\x1a'
+
+
+class TclStubServer():
+    def __init__(self, host='localhost', port=0):
+        self.responses = {}
+        self.default_response = b'ok'
+        self.delay_s = 0
+
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._sock.bind((host, port))
+        self._sock.listen(8)
+
+        self.host, self.port = self._sock.getsockname()
+
+    def _respond(self, command):
+        if command.startswith('payload '):
+            return b'0' * int(command.split()[1])
+
+        return self.responses.get(command, self.default_response)
+
+    def _handle(self, conn):
+        pending = bytearray()
+
+        # OpenOCD disables Nagle on its Tcl connections, so mirror that here
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        with conn:
+            while True:
+                data = conn.recv(65536)
+
+                if not data:
+                    return
+
+                pending += data
+
+                while True:
+                    end = pending.find(COMMAND_TOKEN)
+
+                    if end == -1:
+                        break
+
+                    command = pending[:end].decode('utf-8')
+                    del pending[:end + 1]
+
+                    conn.sendall(self._respond(command) + COMMAND_TOKEN)
+
+    def _serve(self):
+        while True:
+            try:
+                conn, _ = self._sock.accept()
+            except OSError:
+                return
+
+            threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+    def start(self):
+        threading.Thread(target=self._serve, daemon=True).start()
+
+        return self
+
+    def connect(self):
+        sock = socket.create_connection((self.host, self.port))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        return sock
+
+    def stop(self):
+        self._sock.close()
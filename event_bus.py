@@ -0,0 +1,78 @@
+"""
+    file:    event_bus.py
+    version: 0.2.0
+    author:  Adam Mitchell
+    brief:   In-memory stand-in for the Socket.IO hops between app.py and the hardware workers. 
+             In single-process mode each worker's module-level sio client is swapped for an 
+             EventBus, so emits are delivered straight to the target namespace's handlers 
+             instead of going through the Flask server.
+"""
+
+# Standard library imports
+import datetime, queue, threading, time
+
+
+class EventBus():
+    def __init__(self):
+        self._namespaces = {}
+
+    def register_namespace(self, namespace_handler, concurrent=False):
+        # Worker namespaces get one thread each and see their events in order. Concurrent 
+        # namespaces (the server side ones, whose handlers may block waiting on a worker) run 
+        # every event on its own thread, as the Socket.IO server does.
+        inbox = None
+
+        if not concurrent:
+            inbox = queue.Queue()
+            self.start_background_task(self._work, namespace_handler, inbox)
+
+        self._namespaces[namespace_handler.namespace] = (namespace_handler, inbox)
+
+        connect = getattr(namespace_handler, 'on_connect', None)
+
+        if connect is not None:
+            self._dispatch(namespace_handler, connect, ())
+
+    def emit(self, event, data=None, namespace=None, callback=None):
+        if namespace not in self._namespaces:
+            print(f"{datetime.datetime.now()} event_bus.py: No namespace {namespace} for {event}")
+            return
+
+        namespace_handler, inbox = self._namespaces[namespace]
+        handler = getattr(namespace_handler, f'on_{event}', None)
+
+        if handler is None:
+            return
+
+        # Same argument convention as Socket.IO: a tuple is spread over the handler's arguments
+        if data is None:
+            args = ()
+        elif isinstance(data, tuple):
+            args = data
+        else:
+            args = (data, )
+
+        if inbox is not None:
+            inbox.put((handler, args))
+        else:
+            self.start_background_task(self._dispatch, namespace_handler, handler, args)
+
+    def _work(self, namespace_handler, inbox):
+        while True:
+            handler, args = inbox.get()
+            self._dispatch(namespace_handler, handler, args)
+
+    def _dispatch(self, namespace_handler, handler, args):
+        try:
+            handler(*args)
+        except Exception as e:
+            print(f"{datetime.datetime.now()} event_bus.py: {namespace_handler.namespace} {handler.__name__} raised {type(e).__name__}: {e}")
+
+    def sleep(self, seconds):
+        time.sleep(seconds)
+
+    def start_background_task(self, target, *args, **kwargs):
+        thread = threading.Thread(target=target, args=args, kwargs=kwargs, daemon=True)
+        thread.start()
+
+        return thread
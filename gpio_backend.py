@@ -0,0 +1,380 @@
+"""
+    file:    gpio_backend.py
+    version: 0.2.0
+    author:  Adam Mitchell
+    brief:   Pluggable GPIO backends with the RPi.GPIO module interface, so gpio_manager.py and the
+             hardware test can run on the Pi's RPi.GPIO, on the Linux GPIO character device 
+             (libgpiod) or on an in-memory simulator with scriptable pins, injected latency and
+             module insert/remove events. Select one with RTP_GPIO_BACKEND=rpi|gpiod|sim; by
+             default the first hardware backend that can be imported is used. The simulator is
+             only ever used when asked for, so a station with a broken GPIO install fails 
+             loudly instead of testing against simulated pins.
+"""
+
+# Standard library imports
+import collections, datetime, functools, mmap, os, queue, struct, threading, time
+
+
+# BCM channels driven by gpio_manager.py: module detect, BOOT0 and the level shifter enables.
+# Kept here so other GPIO users can stay off them without importing the GPIO manager
+DETECT_PIN       = 1
+BOOT0_PIN        = 0
+U2_OUTPUT_ENABLE = 16
+U3_OUTPUT_ENABLE = 12
+
+MANAGED_CHANNELS = (DETECT_PIN, BOOT0_PIN, U2_OUTPUT_ENABLE, U3_OUTPUT_ENABLE)
+
+
+class GPIOBackend():
+    # Same values as RPi.GPIO so callers can't tell the backends apart
+    BCM      = 11
+    BOARD    = 10
+    OUT      = 0
+    IN       = 1
+    LOW      = 0
+    HIGH     = 1
+    PUD_OFF  = 20
+    PUD_DOWN = 21
+    PUD_UP   = 22
+    RISING   = 31
+    FALLING  = 32
+    BOTH     = 33
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setwarnings(self, flag):
+        pass
+
+    def _edge_matches(self, edge, level):
+        return edge == self.BOTH or (edge == self.RISING and level) or (edge == self.FALLING and not level)
+
+    def _channels(self, channel):
+        if channel is None:
+            return None
+
+        return list(channel) if isinstance(channel, (list, tuple)) else [ channel ]
+
+
+class _EdgeDispatcher():
+    # Runs edge callbacks one at a time on a single thread, as RPi.GPIO does, and drops edges 
+    # that arrive within bouncetime of the last one delivered for the same channel
+    def __init__(self):
+        self._events = queue.Queue()
+        self._last_edge = {}
+        self._thread = None
+
+    def post(self, channel, callback, bouncetime_ms):
+        now = time.monotonic()
+
+        if bouncetime_ms and now - self._last_edge.get(channel, -1e9) < bouncetime_ms / 1000:
+            return
+
+        self._last_edge[channel] = now
+        self._events.put((channel, callback))
+
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._work, daemon=True)
+            self._thread.start()
+
+    def _work(self):
+        while True:
+            channel, callback = self._events.get()
+            callback(channel)
+
+
+class SimulatedGPIO(GPIOBackend):
+    def __init__(self, latency_s=0):
+        self.mode = None
+        self.latency_s = latency_s
+
+        self.levels = {}
+        self.directions = {}
+        self.calls = collections.Counter()
+
+        self._detects = {}
+        self._dispatcher = _EdgeDispatcher()
+        self._lock = threading.Lock()
+
+    def _access(self, name):
+        self.calls[name] += 1
+
+        if self.latency_s:
+            time.sleep(self.latency_s)
+
+    def setup(self, channel, direction, initial=None, pull_up_down=None):
+        for pin in self._channels(channel):
+            self._access('setup')
+            self.directions[pin] = direction
+
+            if direction == self.OUT:
+                self.levels[pin] = initial or 0
+            elif pin not in self.levels:
+                self.levels[pin] = 1 if pull_up_down == self.PUD_UP else 0
+
+    def input(self, channel):
+        self._access('input')
+
+        if channel not in self.directions:
+            raise RuntimeError('You must setup() the GPIO channel first')
+
+        return self.levels.get(channel, 0)
+
+    def input_group(self, channels):
+        self._access('input_group')
+
+        for channel in channels:
+            if channel not in self.directions:
+                raise RuntimeError('You must setup() the GPIO channel first')
+
+        return [ self.levels.get(channel, 0) for channel in channels ]
+
+    def output(self, channel, value):
+        for pin in self._channels(channel):
+            self._access('output')
+
+            if self.directions.get(pin) != self.OUT:
+                raise RuntimeError('The GPIO channel has not been set up as an OUTPUT')
+
+            self.levels[pin] = int(bool(value))
+
+    def cleanup(self, channel=None):
+        self._access('cleanup')
+        pins = self._channels(channel) or list(self.directions)
+
+        for pin in pins:
+            self.directions.pop(pin, None)
+            self._detects.pop(pin, None)
+
+    def add_event_detect(self, channel, edge, callback=None, bouncetime=None):
+        self._access('add_event_detect')
+
+        if channel not in self.directions:
+            raise RuntimeError('You must setup() the GPIO channel first')
+
+        self._detects[channel] = (edge, callback, bouncetime)
+
+    def remove_event_detect(self, channel):
+        self._detects.pop(channel, None)
+
+    # Simulation controls: these stand in for the outside world and don't count as accesses
+
+    def set_level(self, channel, level):
+        with self._lock:
+            previous = self.levels.get(channel, 0)
+            self.levels[channel] = int(bool(level))
+
+        detect = self._detects.get(channel)
+
+        if detect is not None and previous != self.levels[channel]:
+            edge, callback, bouncetime = detect
+
+            if callback is not None and self._edge_matches(edge, self.levels[channel]):
+                self._dispatcher.post(channel, callback, bouncetime)
+
+    def script(self, channel, steps, wait=False):
+        # steps is a list of (delay_s, level) applied in order on a background thread
+        def run():
+            for delay_s, level in steps:
+                time.sleep(delay_s)
+                self.set_level(channel, level)
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+
+        if wait:
+            thread.join()
+
+        return thread
+
+    def insert_module(self, channel, bounces=0, bounce_s=0.002, wait=False):
+        steps = [ (bounce_s, level) for _ in range(bounces) for level in (1, 0) ] + [ (bounce_s if bounces else 0, 1) ]
+
+        return self.script(channel, steps, wait)
+
+    def remove_module(self, channel, bounces=0, bounce_s=0.002, wait=False):
+        steps = [ (bounce_s, level) for _ in range(bounces) for level in (0, 1) ] + [ (bounce_s if bounces else 0, 0) ]
+
+        return self.script(channel, steps, wait)
+
+
+class CharDevGPIO(GPIOBackend):
+    CONSUMER = 'rpi-test-platform'
+
+    # On the Pi, gpiochip0 line offsets are BCM numbers
+    def __init__(self, chip='gpiochip0'):
+        import gpiod
+
+        self.mode = None
+
+        self._gpiod = gpiod
+        self._chip = gpiod.Chip(chip)
+        self._lines = {}
+        self._watchers = {}
+
+    def _request(self, channel, request_type, default=0):
+        self._release(channel)
+
+        line = self._chip.get_line(channel)
+        line.request(consumer=CharDevGPIO.CONSUMER, type=request_type, default_vals=[ default ])
+
+        self._lines[channel] = line
+
+        return line
+
+    def _release(self, channel):
+        watcher = self._watchers.pop(channel, None)
+
+        if watcher is not None:
+            watcher.set()
+
+        line = self._lines.pop(channel, None)
+
+        if line is not None:
+            line.release()
+
+    def setup(self, channel, direction, initial=None, pull_up_down=None):
+        for pin in self._channels(channel):
+            if direction == self.OUT:
+                self._request(pin, self._gpiod.LINE_REQ_DIR_OUT, initial or 0)
+            else:
+                self._request(pin, self._gpiod.LINE_REQ_DIR_IN)
+
+    def input(self, channel):
+        return self._lines[channel].get_value()
+
+    def input_group(self, channels):
+        return self._gpiod.LineBulk([ self._lines[channel] for channel in channels ]).get_values()
+
+    def output(self, channel, value):
+        for pin in self._channels(channel):
+            self._lines[pin].set_value(int(bool(value)))
+
+    def cleanup(self, channel=None):
+        for pin in self._channels(channel) or list(self._lines):
+            self._release(pin)
+
+    def add_event_detect(self, channel, edge, callback=None, bouncetime=None):
+        request_type = { self.RISING: self._gpiod.LINE_REQ_EV_RISING_EDGE, 
+                         self.FALLING: self._gpiod.LINE_REQ_EV_FALLING_EDGE }.get(edge, self._gpiod.LINE_REQ_EV_BOTH_EDGES)
+
+        line = self._request(channel, request_type)
+        stop = threading.Event()
+        self._watchers[channel] = stop
+
+        threading.Thread(target=self._watch, args=(channel, line, callback, bouncetime, stop), daemon=True).start()
+
+    def remove_event_detect(self, channel):
+        self._request(channel, self._gpiod.LINE_REQ_DIR_IN)
+
+    def _watch(self, channel, line, callback, bouncetime_ms, stop):
+        last_edge = -1e9
+
+        while not stop.is_set():
+            if not line.event_wait(sec=1):
+                continue
+
+            line.event_read()
+            now = time.monotonic()
+
+            if bouncetime_ms and now - last_edge < bouncetime_ms / 1000:
+                continue
+
+            last_edge = now
+
+            if callback is not None:
+                callback(channel)
+
+
+@functools.lru_cache(maxsize=1)
+def _gpiomem_bank0():
+    # GPLEV0 holds the input level of BCM 0-31, so one 32-bit read samples the whole header
+    GPLEV0 = 0x34
+
+    try:
+        with open('/dev/gpiomem', 'r+b') as f:
+            registers = mmap.mmap(f.fileno(), 4096)
+    except OSError:
+        return None
+
+    return lambda: struct.unpack_from('<I', registers, GPLEV0)[0]
+
+
+def read_levels(gpio, channels):
+    # Sample a group of input channels in one read where the backend allows it: a bulk read on 
+    # the simulator and character device, the GPIO level register under RPi.GPIO, and one 
+    # input() per channel otherwise
+    if hasattr(gpio, 'input_group'):
+        return list(gpio.input_group(channels))
+
+    read_bank0 = _gpiomem_bank0() if all(channel < 32 for channel in channels) else None
+
+    if read_bank0 is not None:
+        levels = read_bank0()
+
+        return [ (levels >> channel) & 1 for channel in channels ]
+
+    return [ gpio.input(channel) for channel in channels ]
+
+
+class GPIOSession():
+    # Configures a group of input channels once, reads them singly or together and on exit 
+    # releases only those channels, leaving lines owned by anything else (e.g. GPIOManager's 
+    # BOOT0 and level shifter enables) as they were
+    def __init__(self, gpio, channels, reserved=()):
+        clash = set(channels) & set(reserved)
+
+        if clash:
+            raise ValueError(f'Channels {sorted(clash)} are reserved')
+
+        self.gpio = gpio
+        self.channels = list(channels)
+
+    def __enter__(self):
+        self.gpio.setmode(self.gpio.BCM)
+        self.gpio.setup(self.channels, self.gpio.IN)
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.gpio.cleanup(self.channels)
+
+    def read(self, channels=None):
+        return read_levels(self.gpio, self.channels if channels is None else channels)
+
+    def read_one(self, channel):
+        return self.gpio.input(channel)
+
+
+@functools.lru_cache(maxsize=None)
+def load(name=None):
+    # One backend instance per process, shared by everything that drives GPIO
+    name = name or os.environ.get('RTP_GPIO_BACKEND')
+
+    if name not in (None, 'rpi', 'gpiod', 'sim'):
+        raise ValueError(f'Unknown GPIO backend {name}, expected rpi, gpiod or sim')
+
+    if name == 'sim':
+        print(f"{datetime.datetime.now()} gpio_backend.py: Using the simulated GPIO backend")
+        return SimulatedGPIO()
+
+    if name == 'gpiod':
+        return CharDevGPIO()
+
+    try:
+        import RPi.GPIO as gpio
+
+        return gpio
+    except (ImportError, RuntimeError) as e:
+        if name == 'rpi':
+            raise
+
+        rpi_error = e
+
+    try:
+        return CharDevGPIO()
+    except (ImportError, OSError) as e:
+        gpiod_error = e
+
+    raise RuntimeError(f'No GPIO hardware backend available (RPi.GPIO: {rpi_error}; gpiod: {gpiod_error}). '
+                       'Set RTP_GPIO_BACKEND=sim to run against the simulator')
@@ -7,26 +7,43 @@
 """
 
 # Standard library imports
-import atexit, datetime, sys, time
-from subprocess import check_output
+import atexit, collections, datetime, sys, threading, time
 
 # 3rd-party library imports
-import RPi.GPIO as gpio
 import socketio
 
+# Thingpilot library imports
+import gpio_backend, readiness
+
+gpio = gpio_backend.load()
+
 
 sio = socketio.Client()
 
 
 class GPIOManager(object):
-    DETECT_PIN       = 1
-    BOOT0_PIN        = 0
-    U2_OUTPUT_ENABLE = 16
-    U3_OUTPUT_ENABLE = 12
+    DETECT_PIN       = gpio_backend.DETECT_PIN
+    BOOT0_PIN        = gpio_backend.BOOT0_PIN
+    U2_OUTPUT_ENABLE = gpio_backend.U2_OUTPUT_ENABLE
+    U3_OUTPUT_ENABLE = gpio_backend.U3_OUTPUT_ENABLE
+
+    # Lines this process drives; other GPIO users must leave them alone
+    MANAGED_CHANNELS = gpio_backend.MANAGED_CHANNELS
+
+    DEBOUNCE_MS    = 50
+    HISTORY_LENGTH = 64
+    POLL_PERIOD_S  = 0.15
     
-    def __init__(self):
+    def __init__(self, debounce_ms=DEBOUNCE_MS):
         self.current_state = 0
         self.previous_state = 0
+        self.debounce_ms = debounce_ms
+
+        # Timestamped insert/remove events, newest last
+        self.history = collections.deque(maxlen=GPIOManager.HISTORY_LENGTH)
+
+        self._state_lock = threading.Lock()
+        self._started = False
 
         gpio.setmode(gpio.BCM)
 
@@ -44,19 +61,58 @@ class GPIOManager(object):
     def is_connected(self):
         return self.current_state
 
+    def get_history(self):
+        return list(self.history)
+
+    def _update(self, level):
+        with self._state_lock:
+            self.previous_state = self.current_state
+            self.current_state = level
+
+            if self.current_state == self.previous_state:
+                return
+
+            event = { 'time': time.time(), 'event': 'inserted' if level else 'removed' }
+            self.history.append(event)
+
+        if self.current_state == 1:
+            print(f"{datetime.datetime.now()} gpio_manager.py: Module connected")
+            sio.emit('is_connected_progress', True, namespace='/GPIONamespace')         
+        else:
+            print(f"{datetime.datetime.now()} gpio_manager.py: Module disconnected")
+            sio.emit('is_connected_progress', False, namespace='/GPIONamespace') 
+
+    def _on_edge(self, channel):
+        # Runs on RPi.GPIO's callback thread. Contact bounce is ridden out by waiting for the line to
+        # settle and acting on the level it settles at, so a bouncy insert gives one event
+        time.sleep(self.debounce_ms / 1000)
+        self._update(gpio.input(GPIOManager.DETECT_PIN))
+
+    def start(self):
+        if self._started:
+            return
+
+        self._started = True
+        self._update(gpio.input(GPIOManager.DETECT_PIN))
+
+        try:
+            gpio.add_event_detect(GPIOManager.DETECT_PIN, gpio.BOTH, callback=self._on_edge, bouncetime=self.debounce_ms)
+        except RuntimeError as e:
+            print(f"{datetime.datetime.now()} gpio_manager.py: Edge detection unavailable ({e}), polling instead")
+            sio.start_background_task(self.poll)
+
     def poll(self):
+        # Fallback for kernels where edge detection can't be set up
         while True:
-            self.previous_state = self.current_state
-            self.current_state = gpio.input(GPIOManager.DETECT_PIN)
+            level = gpio.input(GPIOManager.DETECT_PIN)
 
-            if(self.current_state == 1 and self.previous_state == 0):
-                print(f"{datetime.datetime.now()} gpio_manager.py: Module connected")
-                sio.emit('is_connected_progress', True, namespace='/GPIONamespace')         
-            elif(self.current_state == 0 and self.previous_state == 1):
-                print(f"{datetime.datetime.now()} gpio_manager.py: Module disconnected")
-                sio.emit('is_connected_progress', False, namespace='/GPIONamespace') 
+            if level != self.current_state:
+                sio.sleep(self.debounce_ms / 1000)
+                level = gpio.input(GPIOManager.DETECT_PIN)
 
-            sio.sleep(0.15)   
+            self._update(level)
+
+            sio.sleep(GPIOManager.POLL_PERIOD_S)   
 
 
 class GPIOManagerNamespace(socketio.ClientNamespace):
@@ -70,12 +126,12 @@ class GPIOManagerNamespace(socketio.ClientNamespace):
     def on_connect(self):
         self.sio_connected = True
         
-        sio.start_background_task(self._gpio_manager.poll)
+        self._gpio_manager.start()
 
     def on_disconnect(self):
         self.sio_connected = False
 
-    def on_is_connected(self, data):
+    def on_is_connected(self, data=None):
         is_connected = self._gpio_manager.is_connected()
 
         if is_connected:
@@ -85,37 +141,15 @@ class GPIOManagerNamespace(socketio.ClientNamespace):
 
         sio.emit('is_connected_progress', is_connected, namespace='/GPIONamespace')
 
-
-def get_ip_address():
-    ip = check_output(['hostname', '-I'])
-    ip = ip.split()[0]
-    ip = ip.decode('utf-8')
-
-    return ip
+    def on_get_detect_history(self, data=None):
+        sio.emit('detect_history_progress', self._gpio_manager.get_history(), namespace='/GPIONamespace')
 
 
 def connect(n_attempts=100):
     ns = GPIOManagerNamespace(GPIOManager(), '/GPIOManagerNamespace')
     sio.register_namespace(ns)
 
-    for i in range(n_attempts):
-        print(f"{datetime.datetime.now()} gpio_manager.py: Attempt {i + 1} connecting to {get_ip_address()}:80")
-
-        try:
-            sio.connect(f'http://{get_ip_address()}:80')       
-
-            print(f"{datetime.datetime.now()} gpio_manager.py: Connected to {get_ip_address()}:80")
-
-            break
-        except socketio.exceptions.ConnectionError:
-            sio.sleep(0.5)
-
-    if ns.sio_connected:
-        sio.sleep(10)
-
-    sio.sleep(1)
-
-    return ns.sio_connected
+    return readiness.connect(sio, 'gpio_manager.py', ['is_connected', 'get_detect_history'], n_attempts)
 
 
 if __name__ == "__main__":
@@ -123,4 +157,4 @@ if __name__ == "__main__":
         while True:
             sio.sleep(1)
     else:
-        print(f"{datetime.datetime.now()} gpio_manager.py: Failed to connect to {get_ip_address()}:80")
\ No newline at end of file
+        print(f"{datetime.datetime.now()} gpio_manager.py: Failed to connect to {readiness.server_address()}:80")
\ No newline at end of file
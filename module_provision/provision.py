@@ -6,12 +6,20 @@
 """
 
 # Standard library imports
-import datetime, functools, time
-from subprocess import check_output
+import datetime, functools, inspect, os, sys, time
 
 # 3rd-party library imports
 import serial, socketio
 
+# Thingpilot library imports
+if __name__ == '__main__':
+    # Append parent directory to path so that the shared modules can be imported
+    currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+    sys.path.insert(0, os.path.dirname(currentdir))
+
+import progress_codec, readiness, uart_link
+from python_ocd.pipeline import Pipeline, Step
+
 
 sio = socketio.Client()
 
@@ -31,6 +39,7 @@ class ThingpilotProvisioner():
         self.uid = None
 
         self.uart = None
+        self.link = None
         self.timeout_flag = False
         self.prov_passed = True
         self.total_prov_start_time = None
@@ -56,8 +65,8 @@ class ThingpilotProvisioner():
     def _flush_uart_input_buffer(func):
         @functools.wraps(func)
         def wrap(self, *args, **kwargs):
-            if self.uart is not None:
-                self.uart.reset_input_buffer()
+            if self.link is not None:
+                self.link.flush()
 
             return func(self, *args, **kwargs)
 
@@ -73,7 +82,7 @@ class ThingpilotProvisioner():
     @_reset_timeout_flag
     def initialise_device(self):
         try:
-            self.uart = serial.Serial('/dev/serial0', 9600, timeout=0.2)
+            self.uart = serial.Serial('/dev/serial0', uart_link.DEFAULT_BAUD, timeout=uart_link.IDLE_TIMEOUT_S)
         except serial.serialutil.SerialException:
             return { 'success': False, 'message': 'Failed to connect to port /dev/serial0\n'}
 
@@ -83,22 +92,17 @@ class ThingpilotProvisioner():
         if not self.uart.is_open:
             return { 'success': False, 'message': 'Failed to open port /dev/serial0\n'}
 
-        start_time = self._get_millis()
-
-        while True:
-            s = str(self.uart.readline())
-            print(f"{datetime.datetime.now()} provision.py: ({self.module.title()}) received: {s}")
+        self.link = uart_link.UARTLink(self.uart, tag=f'provision.py: ({self.module.title()})').start()
+        ctrl = self.link.expect(ThingpilotProvisioner.CTRL).wait(1.0)
 
-            if ThingpilotProvisioner.CTRL in s:
-                self.uart.write(bytes(ThingpilotProvisioner.PROV_INIT, 'utf-8'))
-                self.uart.write(bytes(ThingpilotProvisioner.ACK, 'utf-8'))
-                print(f"{datetime.datetime.now()} provision.py: ({self.module.title()}) sent: {ThingpilotProvisioner.PROV_INIT}")
-                print(f"{datetime.datetime.now()} provision.py: ({self.module.title()}) sent: {ThingpilotProvisioner.ACK}")
-                break
-
-            if self._get_millis() > (start_time + 1000):
-                self.timeout_flag = True
-                break
+        if ctrl is None:
+            self.timeout_flag = True
+        else:
+            # Firmware that announces itself in a frame talks frames for the rest of the session
+            self.link.framed = ctrl.framed
+            self.link.send(ThingpilotProvisioner.PROV_INIT)
+            self.link.send(ThingpilotProvisioner.ACK)
+            self.link.negotiate_baud(cache_key=self.module)
         
         if self.timeout_flag:
             return { 'success': False, 'message': 'Failed to place module into provisioning mode'}
@@ -137,20 +141,15 @@ class ThingpilotProvisioner():
     def end_provision(self):
         start_time = self._get_millis()
 
-        while True:
-            self.uart.write(bytes(ThingpilotProvisioner.PROV_END, 'utf-8'))
-            print(f"{datetime.datetime.now()} provision.py: ({self.module.title()}) sent: {ThingpilotProvisioner.PROV_END}")
-
-            s = str(self.uart.readline())
-            print(f"{datetime.datetime.now()} provision.py: ({self.module.title()}) received: {s}")
-
-            if ThingpilotProvisioner.ACK in s:
-                break
-
-            if self._get_millis() > (start_time + 1000):
+        # The module may miss AT+END while it is busy, so keep asking for up to a second
+        while self.link is not None and self._get_millis() < start_time + 1000:
+            if self.link.transact(ThingpilotProvisioner.PROV_END, ThingpilotProvisioner.ACK, timeout_s=0.2) is not None:
                 break
         
-        if self.uart.is_open:
+        if self.link is not None:
+            self.link.close()
+            self.link = None
+        elif self.uart is not None and self.uart.is_open:
             self.uart.close()
 
         if self.prov_passed:
@@ -164,23 +163,18 @@ class ThingpilotProvisioner():
 
     @_reset_prov_passed_flag
     def provision(self):
-        steps = { 
-            'start_provision': 'self.start_provision()',
-            'initialise_device': 'self.initialise_device()',
-            'provision_device': 'self.provision_device()',
-            'end_provision': 'self.end_provision()'
-        }
-
-        for step, func in steps.items():
-            print(f"{datetime.datetime.now()} provision.py: ({self.module.title()}) {step}")
+        steps = [ Step('start_provision', self.start_provision),
+                  Step('initialise_device', self.initialise_device),
+                  Step('provision_device', self.provision_device) ]
 
-            result = eval(func)
-            yield result
+        log_step = lambda step: print(f"{datetime.datetime.now()} provision.py: ({self.module.title()}) {step}")
 
+        for result in Pipeline(steps, final=Step('end_provision', self.end_provision), on_step_start=log_step).run():
+            # The failed result is handled here before the pipeline resumes, so end_provision sees it
             if not result['success']:
-                self.test_passed = False
-                yield self.end_provision()
-                break
+                self.prov_passed = False
+
+            yield result
 
 
 class ProvisionerNamespace(socketio.ClientNamespace):
@@ -197,46 +191,22 @@ class ProvisionerNamespace(socketio.ClientNamespace):
     def on_disconnect(self):
         self.sio_connected = False
 
-    def on_run_provision(self, module, url, uid):
+    def on_run_provision(self, module, url, uid, job_id=None):
         self._provisioner.module = module
         self._provisioner.url = url
         self._provisioner.uid = uid
 
         for result in self._provisioner.provision():
-            sio.emit('run_provision_progress', result, namespace='/DeviceNamespace')
+            result['job_id'] = job_id
+            sio.emit('run_provision_progress', progress_codec.encode(result), namespace='/DeviceNamespace')
             sio.sleep(0.2)
 
         
-def get_ip_address():
-    ip = check_output(['hostname', '-I'])
-    ip = ip.split()[0]
-    ip = ip.decode('utf-8')
-
-    return ip
-
-
 def connect(n_attempts=100):
     ns = ProvisionerNamespace(ThingpilotProvisioner(), '/ProvisionerNamespace')
     sio.register_namespace(ns)
 
-    for i in range(n_attempts):
-        print(f"{datetime.datetime.now()} provision.py: Attempt {i + 1} connecting to {get_ip_address()}:80")
-
-        try:
-            sio.connect(f'http://{get_ip_address()}:80')       
-
-            print(f"{datetime.datetime.now()} provision.py: Connected to {get_ip_address()}:80")
-
-            break
-        except socketio.exceptions.ConnectionError:
-            sio.sleep(0.5)
-
-    if ns.sio_connected:
-        sio.sleep(10)
-
-    sio.sleep(1)
-
-    return ns.sio_connected
+    return readiness.connect(sio, 'provision.py', ['run_provision'], n_attempts)
 
 
 if __name__ == '__main__':
@@ -244,4 +214,4 @@ if __name__ == '__main__':
         while True:
             sio.sleep(1)
     else:
-        print(f"{datetime.datetime.now()} provision.py: Failed to connect to {get_ip_address()}:80")
\ No newline at end of file
+        print(f"{datetime.datetime.now()} provision.py: Failed to connect to {readiness.server_address()}:80")
\ No newline at end of file
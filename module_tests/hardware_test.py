@@ -8,19 +8,26 @@
 """
 
 # Standard library imports
-import datetime, functools, time
-from subprocess import check_output
+import datetime, functools, inspect, os, sys, time
 
 # 3rd-party library imports
-import RPi.GPIO as gpio
 import serial, socketio
 
 # Thingpilot library imports
 if __name__ == '__main__':
+    # Append parent directory to path so that the shared modules can be imported
+    currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+    sys.path.insert(0, os.path.dirname(currentdir))
+
     import pinmap
 else:
     from module_tests import pinmap
 
+import gpio_backend, progress_codec, readiness, uart_link
+from python_ocd.pipeline import Pipeline, Step
+
+gpio = gpio_backend.load()
+
 
 sio = socketio.Client()
 
@@ -31,16 +38,26 @@ class TestCommands():
     TEST_END  = 'AT+END'
     ACK       = 'OK'
     TEST_GPIO = 'AT+GPIO='
+    TEST_GPIO_BULK = 'AT+GPIOS='
 
 
 class HardwareTest():
     EARHART = 'earhart'
     WRIGHT = 'wright'
 
-    def __init__(self):
+    SKIP_BUSES = ('SWD', 'PWR', 'RSVD', 'UART')
+    GPIO_TEST_MODES = ['bulk', 'per_pin']
+
+    # Module types whose test firmware didn't answer AT+GPIOS, so later runs in this process go 
+    # straight to per pin instead of waiting out the first pattern's timeout again
+    _bulk_unsupported = set()
+
+    def __init__(self, gpio_test_mode='bulk'):
+        self.gpio_test_mode = gpio_test_mode
         self.module = None
         self.pinmap = None
         self.uart = None
+        self.link = None
         self.timeout_flag = False
         self.test_passed = True
         self.total_test_start_time = None
@@ -66,8 +83,8 @@ class HardwareTest():
     def _flush_uart_input_buffer(func):
         @functools.wraps(func)
         def wrap(self, *args, **kwargs):
-            if self.uart is not None:
-                self.uart.reset_input_buffer()
+            if self.link is not None:
+                self.link.flush()
 
             return func(self, *args, **kwargs)
 
@@ -102,7 +119,7 @@ class HardwareTest():
     @_reset_timeout_flag
     def initialise_device(self):
         try:
-            self.uart = serial.Serial('/dev/serial0', 9600, timeout=0.2)
+            self.uart = serial.Serial('/dev/serial0', uart_link.DEFAULT_BAUD, timeout=uart_link.IDLE_TIMEOUT_S)
         except serial.serialutil.SerialException:
             return { 'success': False, 'message': 'Failed to connect to port /dev/serial0'}
 
@@ -112,21 +129,17 @@ class HardwareTest():
         if not self.uart.is_open:
             return { 'success': False, 'message': 'Failed to open port /dev/serial0'}
 
-        start_time = self._get_millis()
-
-        while True:
-            s = str(self.uart.readline())
-            print(f"{datetime.datetime.now()} hardware_test.py: ({self.module.title()}) received: {s}")
+        self.link = uart_link.UARTLink(self.uart, tag=f'hardware_test.py: ({self.module.title()})').start()
+        ctrl = self.link.expect(TestCommands.CTRL).wait(1.0)
 
-            if TestCommands.CTRL in s:
-                self.uart.write(bytes(TestCommands.TEST_INIT, 'utf-8'))
-                self.uart.write(bytes(TestCommands.ACK, 'utf-8'))
-                print(f"{datetime.datetime.now()} hardware_test.py: ({self.module.title()}) sent: {TestCommands.ACK}")
-                break
-
-            if self._get_millis() > (start_time + 1000):
-                self.timeout_flag = True
-                break
+        if ctrl is None:
+            self.timeout_flag = True
+        else:
+            # Firmware that announces itself in a frame talks frames for the rest of the session
+            self.link.framed = ctrl.framed
+            self.link.send(TestCommands.TEST_INIT)
+            self.link.send(TestCommands.ACK)
+            self.link.negotiate_baud(cache_key=self.module)
         
         if self.timeout_flag:
             return { 'success': False, 'message': 'Failed to place DUT into test mode'}
@@ -136,83 +149,145 @@ class HardwareTest():
     def start_test_gpio(self):
         return { 'success': True, 'message': 'Starting GPIO test'}
 
-    def _toggle_test_gpio(self, cpu_pin, rpi_pin, expected_pin_state):
-        gpio.setmode(gpio.BCM)
-        gpio.setup(rpi_pin, gpio.IN)
-        test_passed = False
+    def _toggle_test_gpio(self, session, cpu_pin, rpi_pin, expected_pin_state):
+        reply = self.link.transact(f'{TestCommands.TEST_GPIO}{cpu_pin},{expected_pin_state}',
+                                   f'GPIO: {cpu_pin}, {expected_pin_state}', timeout_s=1.0)
 
-        self.uart.write(bytes(f'{TestCommands.TEST_GPIO}{cpu_pin},{expected_pin_state}', 'utf-8'))
-        print(f"{datetime.datetime.now()} hardware_test.py: ({self.module.title()}) sent: {TestCommands.TEST_GPIO}{cpu_pin},{expected_pin_state}")
-        start_time = self._get_millis()
+        if reply is None or session.read_one(rpi_pin) != expected_pin_state:
+            return False
 
-        while True: 
-            result = str(self.uart.readline())
-            print(f"{datetime.datetime.now()} hardware_test.py: ({self.module.title()}) received: {result}")
-
-            if f'GPIO: {cpu_pin}, {expected_pin_state}' in result:
-                actual_pin_state = gpio.input(rpi_pin)
-
-                if actual_pin_state == expected_pin_state:
-                    self.uart.write(bytes(TestCommands.ACK, 'utf-8'))
-                    print(f"{datetime.datetime.now()} hardware_test.py: ({self.module.title()}) sent: {TestCommands.ACK}")
-                    test_passed = True
-                    break
-            
-            if self._get_millis() > (start_time + 1000):
-                test_passed = False
-                break
+        self.link.send(TestCommands.ACK)
+
+        return True
+
+    def _testable_pins(self):
+        return [ (pin, mapping) for pin, mapping in self.pinmap.items() if mapping['bus'] not in HardwareTest.SKIP_BUSES ]
+
+    @staticmethod
+    def _bulk_patterns(n_pins):
+        # One pattern per bit of the pin's index plus its complement. Every pin is driven both 
+        # high and low, which catches stuck pins, and every pair of pins differs in at least one 
+        # pattern, which catches shorts between them: 2 * log2(n) patterns rather than 2 * n 
+        # single-pin toggles
+        patterns = []
+
+        for bit in range(max(1, (n_pins - 1).bit_length())):
+            ones = [ (index >> bit) & 1 for index in range(n_pins) ]
+            patterns += [ ones, [ 1 - level for level in ones ] ]
+
+        return patterns
+
+    # AT+GPIOS=<mask>,<levels> in hex, bit n for CPU pin n. The DUT drives the masked pins, echoes
+    # GPIOS: <mask>,<levels> and holds them until the next command, so no ACK is needed. Returns
+    # True once driven, False on an ERROR reply and None on no reply
+    def _drive_bulk(self, cpu_pins, levels):
+        mask = sum(1 << cpu_pin for cpu_pin in cpu_pins)
+        value = sum(level << cpu_pin for cpu_pin, level in zip(cpu_pins, levels))
+        command = f'{TestCommands.TEST_GPIO_BULK}{mask:x},{value:x}'
+        echo = f'GPIOS: {mask:x},{value:x}'
+
+        reply = self.link.transact(command, lambda text: echo in text or 'ERROR' in text, timeout_s=1.0)
+
+        if reply is None:
+            return None
+
+        return echo in reply.text
+
+    def _test_gpio_bulk(self, session, pins):
+        cpu_pins = [ mapping['cpu_pin_no'] for _, mapping in pins ]
+
+        high = [ True ] * len(pins)
+        low = [ True ] * len(pins)
+
+        for n, pattern in enumerate(HardwareTest._bulk_patterns(len(pins))):
+            driven = self._drive_bulk(cpu_pins, pattern)
+
+            if driven is None and n == 0:
+                # One lost reply isn't enough to decide the firmware has no bulk support
+                driven = self._drive_bulk(cpu_pins, pattern)
+
+            if driven:
+                sampled = session.read()
+            elif n == 0:
+                # ERROR or still no answer to the first pattern: firmware without bulk support
+                return None
+            else:
+                sampled = [ None ] * len(pins)
+
+            for i, (expected, actual) in enumerate(zip(pattern, sampled)):
+                if expected != actual:
+                    if expected:
+                        high[i] = False
+                    else:
+                        low[i] = False
+
+        return [ { 'pin': pin, 'high': high[i], 'low': low[i] } for i, (pin, _) in enumerate(pins) ]
 
-        gpio.cleanup()
+    def _test_gpio_per_pin(self, session, pins):
+        results = []
 
-        return test_passed
+        for pin, mapping in pins:
+            rpi_pin = mapping['rpi_pin_no']
+            cpu_pin = mapping['cpu_pin_no']
+
+            HIGH_RESULT = self._toggle_test_gpio(session, cpu_pin, rpi_pin, 1)
+            LOW_RESULT = self._toggle_test_gpio(session, cpu_pin, rpi_pin, 0)  
+
+            results.append({ 'pin': pin, 'high': HIGH_RESULT, 'low': LOW_RESULT })  
+
+        return results
 
     @_flush_uart_input_buffer
     @_reset_timeout_flag
     def test_gpio(self):
         test_start_time = self._get_millis()
         test_results = { 'time_taken': 0, 'type': 'GPIO', 'results': [] }
-        test_passed = True
 
-        for pin, mapping in self.pinmap.items():
-            if mapping['bus'] == 'SWD' or mapping['bus'] == 'PWR' or mapping['bus'] == 'RSVD' or mapping['bus'] == 'UART':
-                continue
+        pins = self._testable_pins()
+        results = None
+        mode = self.gpio_test_mode
 
-            rpi_pin = mapping['rpi_pin_no']
-            cpu_pin = mapping['cpu_pin_no']
+        if mode == 'bulk' and self.module in HardwareTest._bulk_unsupported:
+            mode = 'per_pin'
 
-            HIGH_RESULT = self._toggle_test_gpio(cpu_pin, rpi_pin, 1)
-            LOW_RESULT = self._toggle_test_gpio(cpu_pin, rpi_pin, 0)  
+        # Test pins are configured once for the whole run; GPIOManager's lines are never touched
+        rpi_pins = [ mapping['rpi_pin_no'] for _, mapping in pins ]
 
-            if not HIGH_RESULT or not LOW_RESULT: 
-                test_passed = False   
+        with gpio_backend.GPIOSession(gpio, rpi_pins, reserved=gpio_backend.MANAGED_CHANNELS) as session:
+            if mode == 'bulk':
+                results = self._test_gpio_bulk(session, pins)
 
-            test_results['results'].append({ 'pin': pin, 'high': HIGH_RESULT, 'low': LOW_RESULT })  
+                if results is None:
+                    print(f"{datetime.datetime.now()} hardware_test.py: ({self.module.title()}) bulk GPIO test not supported, testing per pin")
+                    HardwareTest._bulk_unsupported.add(self.module)
+                    self.link.flush()
+                    mode = 'per_pin'
 
-        time_taken = self._get_millis() - test_start_time
-        test_results['time_taken'] = time_taken
+            if results is None:
+                results = self._test_gpio_per_pin(session, pins)
 
-        return { 'success': test_passed, 'message': 'GPIO', 'results': test_results }
+        test_passed = all(result['high'] and result['low'] for result in results)
 
+        test_results['results'] = results
+        test_results['mode'] = mode
+        test_results['time_taken'] = self._get_millis() - test_start_time
+
+        return { 'success': test_passed, 'message': 'GPIO', 'results': test_results }
 
     @_flush_uart_input_buffer
     @_reset_timeout_flag
     def end_test(self):
         start_time = self._get_millis()
 
-        while True:
-            self.uart.write(bytes(TestCommands.TEST_END, 'utf-8'))
-            print(f"{datetime.datetime.now()} hardware_test.py: ({self.module.title()}) sent: {TestCommands.TEST_END}")
-
-            s = str(self.uart.readline())
-            print(f"{datetime.datetime.now()} hardware_test.py: ({self.module.title()}) received: {s}")
-
-            if TestCommands.ACK in s:
-                break
-
-            if self._get_millis() > (start_time + 1000):
+        # The DUT may miss AT+END while it is busy, so keep asking for up to a second
+        while self.link is not None and self._get_millis() < start_time + 1000:
+            if self.link.transact(TestCommands.TEST_END, TestCommands.ACK, timeout_s=0.2) is not None:
                 break
 
-        if self.uart.is_open:
+        if self.link is not None:
+            self.link.close()
+            self.link = None
+        elif self.uart is not None and self.uart.is_open:
             self.uart.close()
 
         if self.test_passed:
@@ -226,25 +301,20 @@ class HardwareTest():
 
     @_reset_test_passed_flag
     def run_test(self, module):
-        steps = { 
-            'start_test': 'self.start_test(module)',
-            'verify_pinmap': 'self.verify_pinmap()',
-            'initialise_device': 'self.initialise_device()',
-            'start_test_gpio': 'self.start_test_gpio()',
-            'test_gpio': 'self.test_gpio()',
-            'end_test': 'self.end_test()'
-        }
-
-        for step, func in steps.items():
-            print(f"{datetime.datetime.now()} hardware_test.py: ({module.title()}) {step}")
-
-            result = eval(func)
-            yield result
+        steps = [ Step('start_test', lambda: self.start_test(module)),
+                  Step('verify_pinmap', self.verify_pinmap),
+                  Step('initialise_device', self.initialise_device),
+                  Step('start_test_gpio', self.start_test_gpio),
+                  Step('test_gpio', self.test_gpio) ]
+
+        log_step = lambda step: print(f"{datetime.datetime.now()} hardware_test.py: ({module.title()}) {step}")
 
+        for result in Pipeline(steps, final=Step('end_test', self.end_test), on_step_start=log_step).run():
+            # The failed result is handled here before the pipeline resumes, so end_test sees it
             if not result['success']:
                 self.test_passed = False
-                yield self.end_test()
-                break
+
+            yield result
 
 
 class HWTestNamespace(socketio.ClientNamespace):
@@ -261,42 +331,18 @@ class HWTestNamespace(socketio.ClientNamespace):
     def on_disconnect(self):
         self.sio_connected = False
 
-    def on_run_test(self, module):
+    def on_run_test(self, module, job_id=None):
         for result in self._hw_test.run_test(module):
-            sio.emit('run_test_progress', result, namespace='/DeviceNamespace')
+            result['job_id'] = job_id
+            sio.emit('run_test_progress', progress_codec.encode(result), namespace='/DeviceNamespace')
             sio.sleep(0.2)
 
 
-def get_ip_address():
-    ip = check_output(['hostname', '-I'])
-    ip = ip.split()[0]
-    ip = ip.decode('utf-8')
-
-    return ip
-
-
 def connect(n_attempts=100):
     ns = HWTestNamespace(HardwareTest(), '/HWTestNamespace')
     sio.register_namespace(ns)
 
-    for i in range(n_attempts):
-        print(f"{datetime.datetime.now()} hardware_test.py: Attempt {i + 1} connecting to {get_ip_address()}:80")
-
-        try:
-            sio.connect(f'http://{get_ip_address()}:80')       
-
-            print(f"{datetime.datetime.now()} hardware_test.py: Connected to {get_ip_address()}:80")
-
-            break
-        except socketio.exceptions.ConnectionError:
-            sio.sleep(0.5)
-
-    if ns.sio_connected:
-        sio.sleep(10)
-
-    sio.sleep(1)
-
-    return ns.sio_connected
+    return readiness.connect(sio, 'hardware_test.py', ['run_test'], n_attempts)
 
 
 if __name__ == '__main__':
@@ -304,4 +350,4 @@ if __name__ == '__main__':
         while True:
             sio.sleep(1)
     else:
-        print(f"{datetime.datetime.now()} hardware_test.py: Failed to connect to {get_ip_address()}:80")
\ No newline at end of file
+        print(f"{datetime.datetime.now()} hardware_test.py: Failed to connect to {readiness.server_address()}:80")
\ No newline at end of file
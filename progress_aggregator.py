@@ -0,0 +1,144 @@
+"""
+    file:    progress_aggregator.py
+    version: 0.2.0
+    author:  Adam Mitchell
+    brief:   Batches progress records for browser clients into frames sent at most every ~50ms.
+             Records are grouped into streams (event name plus job ID). Each frame entry carries
+             only the fields that changed since the previous record on the same stream, and 
+             clients rebuild full records from those. Clients subscribe to a station room (every
+             record) or to one job's room. New subscribers get a snapshot of each stream's last 
+             record so later deltas apply cleanly. A record arriving after a quiet spell is sent 
+             straight away; only bursts wait for the next frame. Frames are only ever sent from 
+             one background task, so they reach clients in sequence order.
+"""
+
+# Standard library imports
+import collections, socket, threading, time
+
+
+STATION = socket.gethostname()
+
+
+class ProgressAggregator():
+    FRAME_INTERVAL_S = 0.05
+    MAX_STREAMS = 256
+
+    def __init__(self, socketio, namespace='/WebAppNamespace', interval_s=FRAME_INTERVAL_S):
+        self.socketio = socketio
+        self.namespace = namespace
+        self.interval_s = interval_s
+
+        self._pending = []
+        self._snapshots = []
+        self._last = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._sequence = 0
+        self._flusher = None
+        self._wake = None
+        self._last_flush = 0
+
+    @staticmethod
+    def station_room(station=None):
+        return f'station:{station or STATION}'
+
+    @staticmethod
+    def job_room(job_id):
+        return f'job:{job_id}'
+
+    def _entry(self, event, stream, record):
+        previous = self._last.get(stream)
+        self._last[stream] = record
+        self._last.move_to_end(stream)
+
+        if len(self._last) > ProgressAggregator.MAX_STREAMS:
+            self._last.popitem(last=False)
+
+        if not isinstance(record, dict) or not isinstance(previous, dict):
+            return { 'e': event, 's': stream, 'v': record }
+
+        entry = { 'e': event, 's': stream, 
+                  'd': { key: value for key, value in record.items() if key not in previous or previous[key] != value } }
+        removed = [ key for key in previous if key not in record ]
+
+        if removed:
+            entry['r'] = removed
+
+        return entry
+
+    def publish(self, event, record):
+        job_id = record.get('job_id') if isinstance(record, dict) else None
+        stream = f'{event}:{job_id}' if job_id else event
+
+        with self._lock:
+            self._pending.append((job_id, self._entry(event, stream, record)))
+            self._start_flusher()
+
+        self._wake.set()
+
+    # Called with _lock held
+    def _start_flusher(self):
+        if self._flusher is None:
+            # An event of the server's async mode, so waiting on it yields under eventlet
+            self._wake = self.socketio.server.eio.create_event()
+            self._flusher = self.socketio.start_background_task(self._flush_forever)
+
+    def _flush_forever(self):
+        while True:
+            # Idle until there is something to send; a record after a quiet spell goes out
+            # straight away, and a burst is held back to one frame per interval
+            self._wake.wait()
+            self._wake.clear()
+
+            wait_s = self._last_flush + self.interval_s - time.monotonic()
+
+            if wait_s > 0:
+                self.socketio.sleep(wait_s)
+
+            self.flush()
+
+    # Only called from _flush_forever, so no two frames are ever being emitted at once
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, []
+            snapshots, self._snapshots = self._snapshots, []
+
+            if pending:
+                self._sequence += 1
+                sequence = self._sequence
+                self._last_flush = time.monotonic()
+
+        for sid, snapshot_sequence, entries in snapshots:
+            self._emit(sid, snapshot_sequence, entries, snapshot=True)
+
+        if not pending:
+            return
+
+        self._emit(ProgressAggregator.station_room(), sequence, [ entry for _, entry in pending ])
+
+        jobs = collections.OrderedDict()
+
+        for job_id, entry in pending:
+            if job_id:
+                jobs.setdefault(job_id, []).append(entry)
+
+        for job_id, entries in jobs.items():
+            self._emit(ProgressAggregator.job_room(job_id), sequence, entries)
+
+    def _emit(self, room, sequence, entries, snapshot=False):
+        frame = { 'seq': sequence, 'entries': entries }
+
+        if snapshot:
+            frame['snapshot'] = True
+
+        self.socketio.emit('progress_frame', frame, namespace=self.namespace, room=room)
+
+    def snapshot(self, sid, job_id=None):
+        # Full last record of each stream, for a client that has just subscribed. Sent by the 
+        # flusher like the frames, so it can't overtake a frame it has already accounted for
+        with self._lock:
+            entries = [ { 'e': stream.split(':')[0], 's': stream, 'v': record } for stream, record in self._last.items()
+                        if job_id is None or (isinstance(record, dict) and record.get('job_id') == job_id) ]
+            self._snapshots.append((sid, self._sequence, entries))
+            self._start_flusher()
+
+        self._wake.set()
@@ -0,0 +1,100 @@
+"""
+    file:    progress_codec.py
+    version: 0.2.0
+    author:  Adam Mitchell
+    brief:   Compact binary encoding for progress records sent from the worker services to 
+             /DeviceNamespace. With msgpack installed, each record is packed as a schema-versioned
+             list with the common result fields in fixed positions, instead of a JSON dict with
+             every key spelled out, and a bitmask saying which of those fields are present. The
+             GPIO test's per-pin results become [pin, high, low] 
+             triples. decode() accepts both packets and plain dicts, so workers without msgpack
+             can still report to a server that has it; a server without msgpack logs and drops
+             packets, returning None. /WebAppNamespace still gets plain JSON dicts.
+"""
+
+# Standard library imports
+import datetime
+
+# 3rd-party library imports
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+SCHEMA_VERSION = 1
+
+# Field order is part of the schema: append new fields and bump SCHEMA_VERSION, never reorder
+FIELDS = ('success', 'message', 'error', 'job_id', 'step', 'start_time', 'end_time')
+
+RESULT = 0
+GPIO_RESULT = 1
+
+# Cleared by single_process.py, where records are handed over in memory and packing only costs time
+BINARY = msgpack is not None
+
+
+def _pack_gpio(results):
+    pins = [ (pin['pin'], pin['high'], pin['low']) for pin in results['results'] ]
+    extras = { key: value for key, value in results.items() if key not in ('time_taken', 'type', 'results') }
+
+    return [ results['time_taken'], results['type'], pins, extras ]
+
+
+def _unpack_gpio(packed):
+    time_taken, test_type, pins, extras = packed
+
+    results = { 'time_taken': time_taken, 'type': test_type, 
+                'results': [ { 'pin': pin, 'high': high, 'low': low } for pin, high, low in pins ] }
+    results.update(extras)
+
+    return results
+
+
+def encode(record):
+    if not BINARY or not isinstance(record, dict):
+        return record
+
+    extras = { key: value for key, value in record.items() if key not in FIELDS }
+    kind = RESULT
+
+    if isinstance(extras.get('results'), dict) and extras['results'].get('type') == 'GPIO':
+        kind = GPIO_RESULT
+        extras['results'] = _pack_gpio(extras['results'])
+
+    present = [ field in record for field in FIELDS ]
+    mask = sum(1 << bit for bit, is_present in enumerate(present) if is_present)
+    values = [ record[field] for field in FIELDS if field in record ]
+
+    packet = [ SCHEMA_VERSION, kind, mask, values, extras ]
+
+    # Anything msgpack can't pack, e.g. an exception left in 'error', goes as its text so the
+    # failure still reaches the browser
+    return msgpack.packb(packet, use_bin_type=True, default=str)
+
+
+def decode(payload):
+    if not isinstance(payload, (bytes, bytearray)):
+        return payload
+
+    if msgpack is None:
+        print(f"{datetime.datetime.now()} progress_codec.py: Dropped a {len(payload)} byte progress packet, msgpack is not installed")
+
+        return None
+
+    packet = msgpack.unpackb(payload, raw=False)
+
+    if packet[0] != SCHEMA_VERSION:
+        print(f"{datetime.datetime.now()} progress_codec.py: Unsupported progress schema version {packet[0]}")
+
+        return { 'success': False, 'message': f'Unsupported progress schema version {packet[0]}', 'error': 'SchemaError' }
+
+    _, kind, mask, values, extras = packet
+
+    record = dict(zip([ field for bit, field in enumerate(FIELDS) if mask & (1 << bit) ], values))
+    record.update(extras)
+
+    if kind == GPIO_RESULT:
+        record['results'] = _unpack_gpio(record['results'])
+
+    return record
@@ -0,0 +1,298 @@
+"""
+    file:    async_ocd.py
+    version: 0.2.0
+    author:  Adam Mitchell
+    brief:   asyncio client for the OpenOCD Tcl interface. Unlike OCD it needs no eventlet monkey
+             patching, so a single event loop can drive several OpenOCD instances (probes or 
+             stations) at once. Commands may be submitted concurrently: they are pipelined on the
+             connection and their replies matched up in order.
+"""
+
+# Standard library imports
+import asyncio, collections, os
+
+# Thingpilot library imports
+if __name__ == '__main__':
+    import tcl
+else:
+    try:
+        from python_ocd import tcl
+    except ImportError:
+        import tcl
+
+
+class AsyncOCD():
+    # Upper bound on a single reply, e.g. a large mdw or flash dump
+    READ_LIMIT = 64 * 1024 * 1024
+
+    def __init__(self, tcl_ip='localhost', tcl_port=6666, max_in_flight=8):
+        self.tcl_ip = tcl_ip
+        self.tcl_port = tcl_port
+        self.max_in_flight = max_in_flight
+
+        self._reader = None
+        self._writer = None
+        self._reader_task = None
+        self._pending = collections.deque()
+        self._in_flight = None
+        self._session_healthy = False
+
+    async def __aenter__(self):
+        await self.connect()
+
+        return self
+
+    async def __aexit__(self, type, value, traceback):
+        await self.close()
+
+    def is_connected(self):
+        return self._writer is not None
+
+    # False once the reply stream has been lost, e.g. to an oversized reply; reconnect to go on
+    def is_healthy(self):
+        return self.is_connected() and self._session_healthy
+
+    async def connect(self):
+        self._reader, self._writer = await asyncio.open_connection(
+            self.tcl_ip, 
+            self.tcl_port, 
+            limit=AsyncOCD.READ_LIMIT
+        )
+
+        self._in_flight = asyncio.Semaphore(self.max_in_flight)
+        self._session_healthy = True
+        self._reader_task = asyncio.ensure_future(self._read_replies())
+
+    async def close(self):
+        if self._writer is None:
+            return
+
+        self._writer.close()
+        self._writer = None
+
+        if self._reader_task is not None:
+            self._reader_task.cancel()
+
+            try:
+                await self._reader_task
+            except asyncio.CancelledError:
+                pass
+
+            self._reader_task = None
+
+        self._fail_pending(ConnectionResetError('Connection to Tcl server closed'))
+
+    def _fail_pending(self, exc):
+        while self._pending:
+            future, replies, n_replies = self._pending.popleft()
+
+            if not future.done():
+                future.set_exception(exc)
+
+            self._in_flight.release()
+
+    async def _read_replies(self):
+        try:
+            while True:
+                reply = await self._reader.readuntil(tcl.COMMAND_TOKEN_BYTES)
+                reply = reply[:-len(tcl.COMMAND_TOKEN_BYTES)].decode('utf-8').strip()
+
+                if not self._pending:
+                    # Nobody asked for this, e.g. a notification; nothing to match it with
+                    continue
+
+                future, replies, n_replies = self._pending[0]
+                replies.append(reply)
+
+                if len(replies) < n_replies:
+                    continue
+
+                self._pending.popleft()
+                self._in_flight.release()
+
+                # A cancelled or timed out caller no longer wants the reply, but it still had to
+                # be consumed to keep later replies matched to the right requests
+                if not future.done():
+                    future.set_result(replies)
+        except (asyncio.LimitOverrunError, asyncio.IncompleteReadError, ConnectionError) as e:
+            # The replies can't be matched up any more after any of these, whether the server 
+            # went away or sent a reply bigger than READ_LIMIT, so the session is finished with
+            self._session_healthy = False
+            self._fail_pending(ConnectionResetError(f'Lost the Tcl reply stream: {type(e).__name__}: {e}'))
+
+    async def _submit(self, data, n_replies, timeout_s):
+        if self._writer is None:
+            raise ConnectionResetError('Not connected to Tcl server')
+
+        # Backpressure: wait for a free slot rather than queueing without bound
+        await self._in_flight.acquire()
+
+        # Checked once the slot is ours, as the reader may have given up while we waited
+        if not self._session_healthy:
+            self._in_flight.release()
+            raise ConnectionResetError('Tcl session is unhealthy, reconnect first')
+
+        future = asyncio.get_event_loop().create_future()
+
+        # Queue the future and write in one step so that reply order matches request order
+        self._pending.append((future, [], n_replies))
+        self._writer.write(data)
+
+        await self._writer.drain()
+
+        if timeout_s:
+            return await asyncio.wait_for(future, timeout_s)
+
+        return await future
+
+    async def send(self, command, recv_string=None, timeout_s=20):
+        try:
+            replies = await self._submit(tcl.frame(command), 1, timeout_s)
+        except asyncio.TimeoutError:
+            return tcl.check_reply(None, recv_string, timed_out=True)
+        except ConnectionResetError as e:
+            return { 'success': False, 'message': 'Failed to send to Tcl server. Server appears to be down', 'error': str(e) }
+
+        return tcl.check_reply(replies[0], recv_string)
+
+    async def send_batch(self, commands, timeout_s=20):
+        commands, script = tcl.batch_script(commands)
+        data = b''.join(tcl.frame(line) for line in script)
+
+        try:
+            replies = await self._submit(data, len(script), timeout_s)
+        except asyncio.TimeoutError:
+            return tcl.batch_results(commands, [], timed_out=True)
+        except ConnectionResetError as e:
+            return [ { 'success': False, 'message': 'Failed to send to Tcl server. Server appears to be down', 'error': str(e) } ]
+
+        return tcl.batch_results(commands, replies)
+
+
+class AsyncOCDTarget(AsyncOCD):
+    STATES = tcl.STATES
+
+    async def get_state(self):
+        result = await self.send(tcl.CURRENT_STATE)
+
+        if result['success']:
+            state = tcl.parse_state(result['message'])
+
+            if state is not None:
+                result['state'] = state
+            else:
+                result['success'] = False
+
+        return result
+
+    async def init(self):
+        result = await self.send('init')
+
+        if result['success']:
+            result['message'] = 'Target CPU successfully initialised'
+        else:
+            result['message'] = 'Failed to initialise target CPU'
+
+        return result
+
+    async def wait_for_state(self, state, timeout_s=1):
+        result = await self.send(tcl.wait_state_command(state, timeout_s), timeout_s=timeout_s + 5)
+
+        if result['success']:
+            result['state'] = tcl.parse_state(result['message'])
+            result['success'] = result['state'] == state
+
+        return result
+
+    async def _reset(self, command, expected_state, verify, timeout_s=1):
+        if not verify:
+            return await self.send(command)
+
+        results = await self.send_batch([ command, tcl.wait_state_command(expected_state, timeout_s) ], 
+                                        timeout_s=timeout_s + 20)
+        result = results[0]
+
+        if len(results) == 2 and results[1]['success']:
+            result['state'] = tcl.parse_state(results[1]['message'])
+            result['success'] = result['state'] == expected_state
+        else:
+            result['success'] = False
+
+        return result
+
+    async def reset_run(self, verify=True):
+        result = await self._reset('reset run', 'running', verify)
+
+        if verify:
+            if result['success']:
+                result['message'] = 'Target CPU running'
+            else:
+                result['message'] = 'Failed to make target CPU run'
+
+        return result
+
+    async def reset_halt(self, verify=True):
+        result = await self._reset('reset halt', 'halted', verify)
+
+        if verify:
+            if result['success']:
+                result['message'] = 'Target CPU successfully halted'
+            else:
+                result['message'] = 'Failed to halt target CPU'
+
+        return result
+
+    async def targets(self):
+        return await self.send('targets')
+
+    async def flash_write_image_bin(self, firmware, address):
+        result = await self.send(f'flash write_image erase {firmware} {address}')
+
+        if result['success']:
+            bytes_wrote = tcl.parse_bytes_wrote(result['message'])
+
+            if bytes_wrote is not None:
+                result['bytes_wrote'] = bytes_wrote
+            else:
+                result['success'] = False
+
+        return result
+
+    async def verify_image(self, firmware, address):
+        result = await self.send(f'verify_image {firmware} {address}')
+
+        if result['success']:
+            result['success'] = tcl.is_verified(result['message'])
+
+        return result
+
+    async def program_bin(self, firmware, address, verify=True):
+        firmware = os.path.join('python_ocd', 'firmware', firmware)
+
+        steps = [ ('init', self.init),
+                  ('reset halt', self.reset_halt),
+                  ('flash write_image erase', lambda: self.flash_write_image_bin(firmware, address)) ]
+
+        if verify:
+            steps.append(('verify_image', lambda: self.verify_image(firmware, address)))
+
+        steps.append(('reset run', self.reset_run))
+
+        for name, step in steps:
+            result = await step()
+
+            if not result['success']:
+                result['message'] = f'{result["message"]}: {name}'
+                yield result
+
+                break
+
+            yield result
+
+
+async def program_many(targets, firmware, address):
+    # Program several targets concurrently. Returns the list of progress results per target.
+    async def program(target):
+        return [ result async for result in target.program_bin(firmware, address) ]
+
+    return await asyncio.gather(*(program(target) for target in targets))
@@ -0,0 +1,99 @@
+"""
+    file:    multi_probe.py
+    version: 0.2.0
+    author:  Adam Mitchell
+    brief:   Programs several DUTs at once, one debug probe and OpenOCD instance per DUT. Each 
+             probe has its own config, Tcl/GDB/telnet ports and process, so throughput scales 
+             with the number of probes on the station. 
+             Usage: python python_ocd/multi_probe.py <probes.json> <firmware.bin>
+"""
+
+# Standard library imports
+import datetime, inspect, json, os, sys, time
+from concurrent.futures import ThreadPoolExecutor
+
+if __name__ == '__main__':
+    currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+    sys.path.insert(0, os.path.dirname(currentdir))
+
+from python_ocd.targets.stm32l0 import STM32L0
+
+
+class ProbeScheduler():
+    # probes is a list of dicts, e.g.
+    # { 'name': 'dut1', 'openocd_cfg': 'stm32l0_stlink1.cfg', 'tcl_port': 6667, 
+    #   'gdb_port': 3334, 'telnet_port': 4445, 'ocd_commands': [ 'adapter serial 0670FF48' ] }
+    # Only name, openocd_cfg and tcl_port are required.
+    def __init__(self, probes, target_class=STM32L0):
+        tcl_ports = [ probe['tcl_port'] for probe in probes ]
+
+        if len(set(tcl_ports)) != len(tcl_ports):
+            raise ValueError('Each probe needs its own tcl_port')
+
+        self.targets = {}
+
+        for probe in probes:
+            self.targets[probe['name']] = target_class(
+                probe['openocd_cfg'], 
+                probe.get('tcl_ip', 'localhost'), 
+                probe['tcl_port'], 
+                probe.get('gdb_port'), 
+                probe.get('telnet_port'), 
+                probe.get('ocd_commands')
+            )
+
+    def _program(self, name, firmware, address, progress, kwargs):
+        target = self.targets[name]
+        results = []
+        start_time = time.monotonic()
+
+        with target as session:
+            if not session:
+                result = { 'success': False, 'message': 'Failed to connect to Tcl server', 'error': f'CPUCommsError: {name}' }
+                results.append(result)
+                progress(name, result)
+            else:
+                for result in target.program_bin(firmware, address, **kwargs):
+                    results.append(result)
+                    progress(name, result)
+
+        success = bool(results) and all(result['success'] for result in results)
+
+        return { 'success': success, 'results': results, 'time_taken': round(time.monotonic() - start_time, 3) }
+
+    def program_all(self, firmware, address=STM32L0.PGM_START_ADDRESS, progress=None, **kwargs):
+        # Flash and verify every DUT concurrently. progress(name, result) is called for each step
+        # of each DUT as it completes. Returns { name: { 'success', 'results', 'time_taken' } }.
+        if progress is None:
+            progress = lambda name, result: None
+
+        with ThreadPoolExecutor(max_workers=len(self.targets)) as executor:
+            futures = { name: executor.submit(self._program, name, firmware, address, progress, kwargs) 
+                        for name in self.targets }
+
+            return { name: future.result() for name, future in futures.items() }
+
+
+def print_progress(name, result):
+    status = 'ok' if result['success'] else 'FAILED'
+    print(f"{datetime.datetime.now()} multi_probe.py: ({name}) {status} {result['message']}")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) < 3:
+        print(__doc__)
+        sys.exit(1)
+
+    with open(sys.argv[1]) as f:
+        probes = json.load(f)
+
+    scheduler = ProbeScheduler(probes)
+
+    start_time = time.monotonic()
+    summary = scheduler.program_all(sys.argv[2], progress=print_progress)
+    time_taken = time.monotonic() - start_time
+
+    passed = sum(1 for result in summary.values() if result['success'])
+
+    print(f"{datetime.datetime.now()} multi_probe.py: {passed}/{len(summary)} DUTs programmed in {time_taken:.1f}s "
+          f"({len(summary) * 3600 / time_taken:.0f} units/hour)")
@@ -0,0 +1,132 @@
+"""
+    file:    ocd_log.py
+    version: 0.2.0
+    author:  Adam Mitchell
+    brief:   Drains OpenOCD's stdout and stderr in the background so a chatty OpenOCD can never
+             fill a pipe and stall, keeping the most recent lines in a bounded ring buffer as 
+             structured events for diagnostics and progress reporting.
+"""
+
+# Standard library imports
+import collections, re, threading, time
+
+
+class OCDLogDrain():
+    MAX_EVENTS = 1000
+
+    # (kind, regex) pairs tried in order. Named groups become event fields.
+    PATTERNS = [
+        ('tcl_port',      re.compile(r'listening on port (?P<port>\d+) for tcl connections', re.IGNORECASE)),
+        ('adapter_speed', re.compile(r'adapter speed: (?P<khz>\d+) kHz', re.IGNORECASE)),
+        ('flash_write',   re.compile(r'wrote (?P<bytes>\d+) bytes from file (?P<file>\S+) in (?P<seconds>[\d.]+)s \((?P<kib_s>[\d.]+) KiB/s\)')),
+        ('verified',      re.compile(r'verified (?P<bytes>\d+) bytes in (?P<seconds>[\d.]+)s \((?P<kib_s>[\d.]+) KiB/s\)')),
+        ('checksum_mismatch', re.compile(r'checksum mismatch', re.IGNORECASE)),
+        ('target_state',  re.compile(r'target (?:state: )?(?P<state>halted|running|reset|debug-running)\b'))
+    ]
+
+    LEVELS = [ ('Error', 'error'), ('Warn', 'warning'), ('Info', 'info'), ('Debug', 'debug') ]
+
+    def __init__(self, max_events=MAX_EVENTS):
+        self._events = collections.deque(maxlen=max_events)
+        self._condition = threading.Condition()
+        self._listeners = []
+        self._open_streams = 0
+        self._sequence = 0
+
+    def _parse(self, stream, line):
+        level = 'info'
+
+        for prefix, name in OCDLogDrain.LEVELS:
+            if line.startswith(prefix):
+                level = name
+                break
+
+        event = { 'time': time.time(), 'stream': stream, 'level': level, 'kind': level, 'line': line }
+
+        for kind, pattern in OCDLogDrain.PATTERNS:
+            match = pattern.search(line)
+
+            if match:
+                event['kind'] = kind
+                event.update({ key: value for key, value in match.groupdict().items() if value is not None })
+                break
+
+        return event
+
+    def _add(self, event):
+        with self._condition:
+            self._sequence += 1
+            event['seq'] = self._sequence
+
+            self._events.append(event)
+            self._condition.notify_all()
+
+        for listener in list(self._listeners):
+            listener(event)
+
+    def _drain(self, stream_name, stream):
+        try:
+            for line in stream:
+                line = line.decode('utf-8', errors='replace').strip()
+
+                if line:
+                    self._add(self._parse(stream_name, line))
+        except (OSError, ValueError):
+            # Pipe closed underneath us when OpenOCD is stopped
+            pass
+        finally:
+            with self._condition:
+                self._open_streams -= 1
+                self._condition.notify_all()
+
+    def start(self, process):
+        streams = [ ('stdout', process.stdout), ('stderr', process.stderr) ]
+
+        with self._condition:
+            self._open_streams += len(streams)
+
+        for stream_name, stream in streams:
+            threading.Thread(target=self._drain, args=(stream_name, stream), daemon=True).start()
+
+    def add_listener(self, callback):
+        self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        if callback in self._listeners:
+            self._listeners.remove(callback)
+
+    def events(self, kind=None, since=0):
+        with self._condition:
+            return [ event for event in self._events 
+                     if event['seq'] > since and (kind is None or event['kind'] == kind) ]
+
+    def last_sequence(self):
+        with self._condition:
+            return self._sequence
+
+    def wait_for(self, kind, timeout_s, since=0, **fields):
+        # Returns the first event of the given kind (and matching fields) after sequence number 
+        # since, or None on timeout or once OpenOCD has closed both streams
+        deadline = time.monotonic() + timeout_s
+
+        def match():
+            for event in self._events:
+                if event['seq'] > since and event['kind'] == kind and \
+                        all(event.get(key) == str(value) for key, value in fields.items()):
+                    return event
+
+            return None
+
+        with self._condition:
+            while True:
+                event = match()
+
+                if event is not None or self._open_streams == 0:
+                    return event
+
+                remaining = deadline - time.monotonic()
+
+                if remaining <= 0:
+                    return None
+
+                self._condition.wait(remaining)
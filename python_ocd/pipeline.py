@@ -0,0 +1,166 @@
+"""
+    file:    pipeline.py
+    version: 0.2.0
+    author:  Adam Mitchell
+    brief:   Small step pipeline shared by programming, hardware test and provisioning flows.
+             Steps are callables returning the usual { 'success', 'message', 'error' } result 
+             dicts, with optional per-step timeouts, retries and dependencies. Steps whose 
+             dependencies are met run concurrently and every result is stamped with its start and
+             end times.
+"""
+
+# Standard library imports
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+
+class Step():
+    # depends_on=None means "after the previous step", i.e. a plain sequence. Pass a list of step
+    # names (or an empty list) to say exactly what a step needs.
+    def __init__(self, name, func, timeout_s=None, retries=0, depends_on=None):
+        self.name = name
+        self.func = func
+        self.timeout_s = timeout_s
+        self.retries = retries
+        self.depends_on = depends_on
+
+
+class Pipeline():
+    # final runs last whatever happened, like a finally block, e.g. to take a DUT out of test mode
+    def __init__(self, steps, final=None, on_step_start=None, max_workers=4):
+        self.steps = steps
+        self.final = final
+        self.on_step_start = on_step_start
+        self.max_workers = max_workers
+        self.success = None
+
+        previous = None
+
+        for step in self.steps:
+            if step.depends_on is None:
+                step.depends_on = [] if previous is None else [ previous.name ]
+
+            previous = step
+
+        names = [ step.name for step in self.steps + ([ final ] if final else []) ]
+
+        if len(set(names)) != len(names):
+            raise ValueError(f'Duplicate step names in {names}')
+
+        for step in self.steps:
+            for dependency in step.depends_on:
+                if dependency not in names:
+                    raise ValueError(f'{step.name} depends on unknown step {dependency}')
+
+    def _call(self, step):
+        if self.on_step_start is not None:
+            self.on_step_start(step.name)
+
+        start_time = time.time()
+        start_counter = time.perf_counter()
+
+        result = None
+
+        for attempt in range(1, step.retries + 2):
+            try:
+                result = step.func()
+            except Exception as e:
+                result = { 'success': False, 'message': f'{step.name} raised {type(e).__name__}', 'error': str(e) }
+
+            if result['success']:
+                break
+
+        result['step'] = step.name
+        result['attempts'] = attempt
+        result['start_time'] = start_time
+        result['end_time'] = start_time + (time.perf_counter() - start_counter)
+        result['duration'] = result['end_time'] - start_time
+
+        return result
+
+    def _timed_out(self, step, start_time):
+        end_time = time.time()
+
+        return { 'success': False, 'message': f'{step.name} timed out after {step.timeout_s}s', 'error': 'Timed out', 
+                 'step': step.name, 'attempts': 1, 'start_time': start_time, 'end_time': end_time, 
+                 'duration': end_time - start_time }
+
+    def run(self):
+        # Yields each step's result as it finishes. After the first failure no new steps start;
+        # steps already running are allowed to finish, then final runs if given.
+        self.success = True
+
+        pending = list(self.steps)
+        done = set()
+        running = {}
+
+        executor = None
+
+        try:
+            while pending or running:
+                ready = [ step for step in pending if all(dependency in done for dependency in step.depends_on) ]
+
+                if self.success:
+                    # A lone untimed step runs in the caller's thread, which keeps the common 
+                    # sequential case free of thread hand-offs
+                    if len(ready) == 1 and not running and ready[0].timeout_s is None:
+                        step = ready[0]
+                        pending.remove(step)
+
+                        result = self._call(step)
+                        done.add(step.name)
+
+                        if not result['success']:
+                            self.success = False
+
+                        yield result
+                        continue
+
+                    for step in ready:
+                        if executor is None:
+                            executor = ThreadPoolExecutor(max_workers=self.max_workers)
+
+                        pending.remove(step)
+                        running[executor.submit(self._call, step)] = (step, time.time())
+                elif not running:
+                    break
+
+                if not running:
+                    if pending:
+                        raise ValueError(f'Steps {[ step.name for step in pending ]} can never run, check depends_on')
+
+                    break
+
+                deadlines = [ start_time + step.timeout_s for step, start_time in running.values() if step.timeout_s ]
+                wait_s = max(min(deadlines) - time.time(), 0) if deadlines else None
+
+                finished, _ = wait(list(running), timeout=wait_s, return_when=FIRST_COMPLETED)
+
+                for future in finished:
+                    step, _ = running.pop(future)
+                    result = future.result()
+                    done.add(step.name)
+
+                    if not result['success']:
+                        self.success = False
+
+                    yield result
+
+                for future, (step, start_time) in list(running.items()):
+                    if step.timeout_s and time.time() >= start_time + step.timeout_s:
+                        # The worker can't be interrupted; it is abandoned and its result ignored
+                        running.pop(future)
+                        self.success = False
+
+                        yield self._timed_out(step, start_time)
+        finally:
+            if executor is not None:
+                executor.shutdown(wait=False)
+
+        if self.final is not None:
+            result = self._call(self.final)
+
+            if not result['success']:
+                self.success = False
+
+            yield result
@@ -7,12 +7,14 @@
 """
 
 # Standard library imports
+import atexit
 import functools
-import os
+import select
 import socket
 import subprocess
 import sys
 import threading
+import time
 
 try:
     import thread
@@ -22,164 +24,411 @@ except ImportError:
 # Monkey patch standard libs for eventlet compatibility
 import eventlet; eventlet.monkey_patch()
 
+try:
+    from python_ocd import tcl
+    from python_ocd.ocd_log import OCDLogDrain
+except ImportError:
+    import tcl
+    from ocd_log import OCDLogDrain
+
 
 class TimeoutError(Exception): 
     pass
 
 
-class OCD():
-    COMMAND_TOKEN = '\x1a'
-
-    def __init__(self, openocd_cfg, tcl_ip='localhost', tcl_port=6666):
-        if __name__ == '__main__':
-            self.openocd_cfg = f'../configs/{openocd_cfg}'
-        else:
-            self.openocd_cfg = f'python_ocd/configs/{openocd_cfg}'
+# Keeps one OpenOCD process and Tcl session alive per config/port so that targets can lease a 
+# warm session rather than starting OpenOCD for every operation
+class OCDSupervisor():
+    _supervisors = {}
+    _supervisors_lock = threading.Lock()
 
+    def __init__(self, openocd_cfg, tcl_ip='localhost', tcl_port=6666, gdb_port=None, telnet_port=None,
+                 ocd_commands=None, start_timeout_s=5):
+        self.openocd_cfg = openocd_cfg
         self.tcl_ip = tcl_ip
         self.tcl_port = tcl_port
-        self.buffer_size = 4096
-        self.timeout_flag = False
+        # Keep OpenOCD's default 3333/4444 for the default Tcl port 6666 and move them along with
+        # the Tcl port otherwise, so several instances never collide
+        self.gdb_port = gdb_port if gdb_port is not None else tcl_port - 3333
+        self.telnet_port = telnet_port if telnet_port is not None else tcl_port - 2222
+        self.ocd_commands = ocd_commands or []
+        self.start_timeout_s = start_timeout_s
+        self.restarts = 0
+
         self._ocd_process = None
+        self._sock = None
+        self._lease_lock = threading.Lock()
+        self.log = OCDLogDrain()
 
-        self.sock = None
+    @classmethod
+    def get(cls, openocd_cfg, tcl_ip='localhost', tcl_port=6666, **kwargs):
+        key = (openocd_cfg, tcl_ip, tcl_port)
 
-    def _reset_timeout_flag(func):
-        @functools.wraps(func)
-        def wrap(self, *args, **kwargs):
-            self.timeout_flag = False
+        with cls._supervisors_lock:
+            if key not in cls._supervisors:
+                cls._supervisors[key] = cls(openocd_cfg, tcl_ip, tcl_port, **kwargs)
 
-            return func(self, *args, **kwargs)
+            return cls._supervisors[key]
 
-        return wrap
+    @classmethod
+    def stop_all(cls):
+        with cls._supervisors_lock:
+            for supervisor in cls._supervisors.values():
+                supervisor.stop()
 
-    def _handle_timeout(self):
-        self.timeout_flag = True
-        raise TimeoutError
+    def _openocd_args(self):
+        args = [ 'sudo', 'openocd', '-f', f'{self.openocd_cfg}',
+                 '-c', f'tcl_port {self.tcl_port}',
+                 '-c', f'gdb_port {self.gdb_port}',
+                 '-c', f'telnet_port {self.telnet_port}' ]
 
-    def _deinit_openocd(self):
-        if self._ocd_process is None:
-            os.system('sudo pkill -9 openocd')
-        else:
-            self._ocd_process.kill()
+        for command in self.ocd_commands:
+            args += [ '-c', command ]
+
+        return args
+
+    def _start_openocd(self):
+        # Clear out an instance on our port left behind by a previous run, leaving other 
+        # probes' instances alone
+        self._kill_stale_openocd()
 
-    @_reset_timeout_flag
-    def _init_openocd(self, timeout_s=5):
         try:
             self._ocd_process = subprocess.Popen(
-                ['sudo', 'openocd', '-f', f'{self.openocd_cfg}'], 
+                self._openocd_args(), 
                 stdout=subprocess.PIPE, 
                 stderr=subprocess.PIPE
             )
-        except subprocess.CalledProcessError:
+        except (OSError, subprocess.CalledProcessError):
             self._ocd_process = None
-            self._deinit_openocd()
             return False
 
-        timer = threading.Timer(timeout_s, self._handle_timeout)
-        timer.start()
+        # Both pipes are drained for the lifetime of the process so OpenOCD never blocks on a 
+        # full pipe; readiness is the Tcl port banner arriving through the drain
+        since = self.log.last_sequence()
+        self.log.start(self._ocd_process)
+
+        return self.log.wait_for('tcl_port', self.start_timeout_s, since=since, port=self.tcl_port) is not None
+
+    def _kill_stale_openocd(self):
+        # The [o] stops the pattern from matching the pkill command line itself
+        subprocess.call(
+            [ 'sudo', 'pkill', '-9', '-f', f'[o]penocd -f .*-c tcl_port {self.tcl_port}( |$)' ],
+            stdout=subprocess.DEVNULL, 
+            stderr=subprocess.DEVNULL
+        )
+
+    def _stop_openocd(self):
+        if self._ocd_process is None:
+            return
+
+        # SIGTERM is relayed to OpenOCD by sudo, SIGKILL would only kill sudo itself
+        self._ocd_process.terminate()
 
         try:
-            for line in self._ocd_process.stderr:
-                line_decoded = line.decode('utf-8')
-                
-                if '6666 for tcl connections' in line_decoded.lower():
-                    break
-        except TimeoutError:
-            pass
-        finally:
-            timer.cancel()
+            self._ocd_process.wait(timeout=2)
+        except subprocess.TimeoutExpired:
+            self._ocd_process.kill()
+            self._ocd_process.wait()
+            self._kill_stale_openocd()
 
-        if self.timeout_flag:
+        self._ocd_process = None
+
+    def _connect(self):
+        self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+        try:
+            self._sock.connect((self.tcl_ip, self.tcl_port))
+        except ConnectionError:
+            self._close_socket()
             return False
+
+        return True
+
+    def _close_socket(self):
+        if self._sock is not None:
+            self._sock.close()
+            self._sock = None
+
+    def is_alive(self):
+        return self._ocd_process is not None and self._ocd_process.poll() is None
+
+    def health_check(self):
+        if not self.is_alive() or self._sock is None:
+            return False
+
+        # A healthy idle session has nothing to read. Readable with no data means the Tcl server
+        # closed the connection; readable with data means a stale reply we can discard.
+        try:
+            while True:
+                readable, _, _ = select.select([self._sock], [], [], 0)
+
+                if not readable:
+                    return True
+
+                if not self._sock.recv(4096):
+                    return False
+        except OSError:
+            return False
+
+    def start(self):
+        self.stop()
+
+        if not self._start_openocd():
+            self._stop_openocd()
+            return False
+
+        if not self._connect():
+            self._stop_openocd()
+            return False
+
+        return True
+
+    def restart(self):
+        self.restarts += 1
+
+        return self.start()
+
+    def stop(self):
+        self._close_socket()
+
+        if self._ocd_process is not None:
+            self._stop_openocd()
+
+    def lease(self):
+        self._lease_lock.acquire()
+
+        if not self.health_check():
+            if self.is_alive():
+                # OpenOCD is fine, only the Tcl connection needs replacing
+                self._close_socket()
+                ready = self._connect() or self.restart()
+            elif self._ocd_process is not None:
+                ready = self.restart()
+            else:
+                ready = self.start()
+
+            if not ready:
+                self._lease_lock.release()
+                return None
+
+        return self._sock
+
+    def release(self, healthy=True):
+        if not healthy:
+            self._close_socket()
+
+        self._lease_lock.release()
+
+    def events(self, kind=None, since=0):
+        return self.log.events(kind, since)
+
+
+atexit.register(OCDSupervisor.stop_all)
+
+
+class OCD():
+    COMMAND_TOKEN = tcl.COMMAND_TOKEN
+    COMMAND_TOKEN_BYTES = tcl.COMMAND_TOKEN_BYTES
+
+    def __init__(self, openocd_cfg, tcl_ip='localhost', tcl_port=6666, gdb_port=None, telnet_port=None, 
+                 ocd_commands=None):
+        if __name__ == '__main__':
+            self.openocd_cfg = f'../configs/{openocd_cfg}'
         else:
-            return True
+            self.openocd_cfg = f'python_ocd/configs/{openocd_cfg}'
+
+        self.tcl_ip = tcl_ip
+        self.tcl_port = tcl_port
+        self.buffer_size = 4096
+        self.timeout_flag = False
+        self._rx_buffer = bytearray(self.buffer_size)
+        self._rx_len = 0
+        self._stale_replies = 0
+        self._supervisor = OCDSupervisor.get(
+            self.openocd_cfg, 
+            self.tcl_ip, 
+            self.tcl_port, 
+            gdb_port=gdb_port, 
+            telnet_port=telnet_port, 
+            ocd_commands=ocd_commands
+        )
+        self._session_healthy = True
+
+        self.sock = None
+
+    def _reset_timeout_flag(func):
+        @functools.wraps(func)
+        def wrap(self, *args, **kwargs):
+            self.timeout_flag = False
+
+            return func(self, *args, **kwargs)
+
+        return wrap
 
     def __enter__(self):
-        if self._init_openocd():
-            self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock = self._supervisor.lease()
 
-            try:
-                self.sock.connect((self.tcl_ip, self.tcl_port))
-            except ConnectionError:
-                return False
+        if self.sock is None:
+            return False
+
+        self._session_healthy = True
+        self._rx_len = 0
+        self._stale_replies = 0
         
         return self
 
     def __exit__(self, type, value, traceback):
-        self.sock.close()
-        self._deinit_openocd()
+        if self.sock is None:
+            return
+
+        self.sock = None
+        healthy = self._session_healthy and type is None and not self._stale_replies
+        self._supervisor.release(healthy=healthy)
 
-    def _recv(self):
-        data = bytes()
+    def _recv(self, deadline=None):
+        # Replies are read straight into a reusable buffer and only newly received bytes are
+        # scanned for the token. Anything after the token belongs to the next reply and is kept.
+        buf = self._rx_buffer
+        scan_from = 0
 
         while True:
-            chunk = self.sock.recv(self.buffer_size)
-            data += chunk
+            end = buf.find(OCD.COMMAND_TOKEN_BYTES, scan_from, self._rx_len)
 
-            if bytes(OCD.COMMAND_TOKEN, encoding='utf-8') in chunk:
+            if end != -1:
                 break
 
-        data = data.decode('utf-8').strip()
-        data = data[:-1]
+            scan_from = self._rx_len
+
+            if self._rx_len == len(buf):
+                buf.extend(bytes(len(buf)))
+
+            if deadline is not None:
+                remaining = deadline - time.monotonic()
+
+                if remaining <= 0:
+                    raise TimeoutError
+
+                self.sock.settimeout(remaining)
+
+            try:
+                with memoryview(buf) as view:
+                    n_bytes = self.sock.recv_into(view[self._rx_len:])
+            except socket.timeout:
+                raise TimeoutError
+
+            if n_bytes == 0:
+                raise ConnectionResetError('Tcl server closed the connection')
+
+            self._rx_len += n_bytes
+
+        with memoryview(buf) as view:
+            data = str(view[:end], 'utf-8').strip()
+
+        leftover = self._rx_len - (end + 1)
+        buf[:leftover] = buf[end + 1:self._rx_len]
+        self._rx_len = leftover
 
         return data
 
+    def _recv_replies(self, n_replies, timeout_s=None):
+        # One monotonic deadline covers every reply of the command. Replies still outstanding 
+        # after a timeout are marked stale and discarded before the next command's reply.
+        deadline = None if not timeout_s else time.monotonic() + timeout_s
+        replies = []
+
+        try:
+            while self._stale_replies:
+                self._recv(deadline)
+                self._stale_replies -= 1
+
+            while len(replies) < n_replies:
+                replies.append(self._recv(deadline))
+        except TimeoutError:
+            self.timeout_flag = True
+            self._stale_replies += n_replies - len(replies)
+        finally:
+            if deadline is not None:
+                self.sock.settimeout(None)
+
+        return replies
+
     def connect(self):
         self.__enter__()
 
     def disconnect(self):
         self.__exit__(*sys.exc_info())
 
+    def get_ocd_events(self, kind=None, since=0):
+        return self._supervisor.events(kind, since)
+
+    def last_ocd_event(self):
+        return self._supervisor.log.last_sequence()
+
+    def wait_for_ocd_event(self, kind, timeout_s, since=0, **fields):
+        return self._supervisor.log.wait_for(kind, timeout_s, since, **fields)
+
+    def add_ocd_listener(self, callback):
+        self._supervisor.log.add_listener(callback)
+
+    def remove_ocd_listener(self, callback):
+        self._supervisor.log.remove_listener(callback)
+
     def get_buffer_size(self):
         return self.buffer_size
 
     def set_buffer_size(self, buffer_size_bytes):
-        self.buffer_size(buffer_size_bytes)
+        self.buffer_size = buffer_size_bytes
+
+        if len(self._rx_buffer) < self.buffer_size:
+            self._rx_buffer.extend(bytes(self.buffer_size - len(self._rx_buffer)))
 
         return self.get_buffer_size()
 
     @_reset_timeout_flag
     def send(self, command, recv_string=None, timeout_s=20):
-        success = False
         recv_data = None
-        error = ''
 
-        data = (command + OCD.COMMAND_TOKEN).encode('utf-8')
+        data = tcl.frame(command)
 
         try:
-            self.sock.send(data)
+            self.sock.sendall(data)
         except (BrokenPipeError, ConnectionResetError) as e:
-            return { 'success': False, 'message': 'Failed to send to Tcl server. Server appears to be down', 'error': e}
+            self._session_healthy = False
+            return { 'success': False, 'message': 'Failed to send to Tcl server. Server appears to be down', 'error': str(e)}
 
-        if timeout_s:
-            timer = threading.Timer(timeout_s, self._handle_timeout)
-            timer.start()
-            
-            try:
-                try:
-                    recv_data = self._recv()
-                except ConnectionResetError as e:
-                    timer.cancel()
-                    return { 'success': False, 'message': 'Module likely isn\'t connected properly to the test HAT', 'error': e }
-            except TimeoutError: 
-                pass
-            finally:
-                timer.cancel()
-        else:
-            recv_data = self._recv()
-
-        if not self.timeout_flag:
-            if recv_string is not None:
-                if recv_string in recv_data:
-                    success = True
-                else:
-                    success = False
-                    error = f'{recv_string} not in {recv_data}'
-            else:
-                success = True
-        else:
-            success = False
-            error = 'Timed out'
+        try:
+            replies = self._recv_replies(1, timeout_s)
+        except ConnectionResetError as e:
+            self._session_healthy = False
+            return { 'success': False, 'message': 'Module likely isn\'t connected properly to the test HAT', 'error': str(e) }
+
+        if replies:
+            recv_data = replies[0]
+
+        return self._check_reply(recv_data, recv_string)
+
+    def _check_reply(self, recv_data, recv_string=None):
+        return tcl.check_reply(recv_data, recv_string, self.timeout_flag)
+
+    @_reset_timeout_flag
+    def send_batch(self, commands, timeout_s=20):
+        # Commands are strings or (command, recv_string) tuples. Results are returned in order 
+        # and end at the first failing command, as OpenOCD skips everything after it.
+        commands, script = tcl.batch_script(commands)
+        data = b''.join(tcl.frame(line) for line in script)
+
+        try:
+            self.sock.sendall(data)
+        except (BrokenPipeError, ConnectionResetError) as e:
+            self._session_healthy = False
+            return [ { 'success': False, 'message': 'Failed to send to Tcl server. Server appears to be down', 'error': str(e)} ]
+
+        try:
+            # Every reply has to be consumed, including skipped ones, to keep the session in sync
+            replies = self._recv_replies(len(script), timeout_s)
+        except ConnectionResetError as e:
+            self._session_healthy = False
+            return [ { 'success': False, 'message': 'Module likely isn\'t connected properly to the test HAT', 'error': str(e) } ]
 
-        return { 'success': success, 'message': recv_data, 'error': error }
\ No newline at end of file
+        return tcl.batch_results(commands, replies, self.timeout_flag)
@@ -6,47 +6,38 @@
              extraction of the STM32 unique ID.
 """
 
-import datetime, functools, inspect
-from subprocess import check_output
+import datetime, functools, inspect, itertools, os, queue, struct, sys, threading, time, uuid
 
 if __name__ == '__main__':
+    # Append the repository root to path so that the station's shared modules can be imported
+    currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+    sys.path.insert(0, os.path.dirname(os.path.dirname(currentdir)))
+
     # Import Parent target class
     from target import OCDTarget
 else:
     from python_ocd.targets.target import OCDTarget
 
+import progress_codec, readiness
+from python_ocd.pipeline import Step
+
 import socketio
 
 
 sio = socketio.Client()
 
 
-class MutexLockedError(Exception):
-    def __init__(self, func):
-        success = False
-        message = 'Operation currently in progress'
-        error   = f'MutexLockedError: {func}'
-
-        result = { 'success': success, 'message': message, 'error': error }
-        
-        sio.emit(
-            func.split('on_')[1] + '_progress', 
-            result, 
-            namespace='/DeviceNamespace'
-        )
-
-
 class CPUCommsError(Exception):
-    def __init__(self, func):
+    def __init__(self, func, job_id=None):
         success = False
         message = 'Failed to connect to Tcl server'
         error   = f'CPUCommsError: {func}'
 
-        result = { 'success': success, 'message': message, 'error': error }
+        result = { 'success': success, 'message': message, 'error': error, 'job_id': job_id }
 
         sio.emit(
             func.split('on_')[1] + '_progress', 
-            result, 
+            progress_codec.encode(result), 
             namespace='/DeviceNamespace'
         )
 
@@ -62,25 +53,115 @@ class SIONotConnectedError(Exception):
         print(result)
 
 
+class JobQueue():
+    # Priority queue of CPU jobs served by a single worker, so requests that arrive while the CPU is
+    # busy wait their turn rather than being dropped. A request identical to one still waiting is
+    # coalesced into it and gets the waiting job's ID back. Callers may supply their own job ID so 
+    # the same ID can follow a job through the other namespaces.
+    def __init__(self, run_job):
+        self._run_job = run_job
+        self._jobs = queue.PriorityQueue()
+        self._waiting = {}
+        self._lock = threading.Lock()
+        self._sequence = itertools.count()
+        self._worker = None
+
+        self.current = None
+
+    def depth(self):
+        return len(self._waiting)
+
+    def submit(self, name, args, kwargs, priority, job_id=None):
+        key = repr((name, args, sorted(kwargs.items())))
+
+        with self._lock:
+            if key in self._waiting:
+                return self._waiting[key], True
+
+            job = { 'job_id': job_id or uuid.uuid4().hex[:8], 'name': name, 'cancelled': False, 'args': args, 'kwargs': kwargs, 
+                    'priority': priority, 'key': key, 'queued_at': time.monotonic() }
+
+            self._waiting[key] = job
+            self._jobs.put((priority, next(self._sequence), job))
+
+            if self._worker is None:
+                self._worker = sio.start_background_task(self._work)
+
+        return job, False
+
+    # A job that has not started yet is dropped; one that is already running is left to finish
+    def cancel(self, job_id):
+        with self._lock:
+            for job in self._waiting.values():
+                if job['job_id'] == job_id:
+                    job['cancelled'] = True
+
+                    return True
+
+        return False
+
+    def _work(self):
+        try:
+            while True:
+                _, _, job = self._jobs.get()
+
+                with self._lock:
+                    self._waiting.pop(job['key'], None)
+
+                if job['cancelled']:
+                    continue
+
+                job['wait_time'] = time.monotonic() - job['queued_at']
+                self.current = job
+
+                # One job failing, e.g. an emit on a dropped connection, must not take the only 
+                # worker down with it
+                try:
+                    self._run_job(job)
+                except Exception as e:
+                    print(f"{datetime.datetime.now()} stm32l0.py: Job {job['job_id']} ({job['name']}) failed: {type(e).__name__}: {e}")
+                finally:
+                    self.current = None
+        finally:
+            # Should the worker die anyway, the next submit starts another
+            with self._lock:
+                self._worker = None
+
+
 class STM32L0(OCDTarget):
     PGM_START_ADDRESS = '0x08000000'
+    UID_ADDRESS = '0x1FF80050'
+    FLASH_SECTOR_SIZE = 4096
 
-    def __init__(self, openocd_cfg='stm32l0_ocd.cfg', tcl_ip='localhost', tcl_port=6666):
-        super().__init__(openocd_cfg, tcl_ip, tcl_port)
+    def __init__(self, openocd_cfg='stm32l0_ocd.cfg', tcl_ip='localhost', tcl_port=6666, gdb_port=None, 
+                 telnet_port=None, ocd_commands=None):
+        super().__init__(openocd_cfg, tcl_ip, tcl_port, gdb_port, telnet_port, ocd_commands)
 
     def get_unique_id(self):
-        result = self.init()
-        result = self.reset_halt()
-        result = self.send('mdw 0x1FF80050 3')
+        address = int(STM32L0.UID_ADDRESS, 0)
+        results = self._send_memory_batch(lambda: [ 'init', 'reset halt', self._memory_read_command(address, 32, 3) ])
+        result = results[-1]
 
-        if result['success']:
-            if '00000000 00000000 00000000' in result['message'] or result['message'] == '':
-                result['success'] = False
+        if len(results) < 3:
+            result['success'] = False
+        elif result['success']:
+            uid = self._unpack_memory(result['message'], 32, 3)
 
-            result['message'] = result['message'][12:38]
+            if uid is None or uid == bytes(12):
+                result['success'] = False
+            else:
+                result['message'] = ' '.join(f'{word:08x}' for word in struct.unpack('<3I', uid))
         
         return result
 
+    # UID read, flash, verify and reset run in one session. get_unique_id leaves the CPU halted, so
+    # the flash steps follow on without a second init/reset halt
+    def flash_and_run(self, firmware, verify=True, differential=False, verify_mode='checksum'):
+        steps = [ Step('get_unique_id', self.get_unique_id) ]
+        steps += self._program_steps(firmware, STM32L0.PGM_START_ADDRESS, verify, differential, verify_mode)
+
+        yield from self._run_steps(steps)
+
 
 class STM32L0Namespace(socketio.ClientNamespace):
     def __init__(self, cpu, *args, **kwargs):
@@ -88,39 +169,60 @@ class STM32L0Namespace(socketio.ClientNamespace):
 
         self.sio_connected = False
 
-        self._mutex_lock = False
         self._cpu = cpu
+        self._jobs = JobQueue(self._run_job)
+
+    def _emit_job(self, job, state, **fields):
+        status = { 'job_id': job['job_id'], 'name': job['name'], 'state': state, 'queue_depth': self._jobs.depth() }
+        status.update(fields)
+
+        sio.emit('job_progress', progress_codec.encode(status), namespace='/DeviceNamespace')
 
-    def _mutex_use_cpu(func):
-        @functools.wraps(func)
-        def wrapper(self, *args, **kwargs):
-            res = None
-
-            try:
-                if not self._mutex_lock:
-                    self._mutex_lock = True
-
-                    if self.sio_connected:
-                        with self._cpu:
-                            if self._cpu:
-                                res = func(self, *args, **kwargs)   
-                            else:
-                                self._mutex_lock = False
-                                raise CPUCommsError(wrapper.__name__)
-                    
-                        self._mutex_lock = False
-                    else:
-                        self._mutex_lock = False
+    def _run_job(self, job):
+        func = functools.partial(getattr(type(self), job['name']).__wrapped__, self)
+        start_time = time.monotonic()
+
+        self._emit_job(job, 'started', wait_time=round(job['wait_time'], 3))
+
+        # Leaving the with block releases the OpenOCD lease whether or not the job raised
+        try:
+            with self._cpu as session:
+                if not session:
+                    raise CPUCommsError(job['name'], job['job_id'])
+
+                func(*job['args'], **job['kwargs'])
+
+            state = 'done'
+        except CPUCommsError:
+            state = 'failed'
+        except Exception as e:
+            result = { 'success': False, 'message': str(e), 'error': f'{type(e).__name__}: {job["name"]}', 
+                       'job_id': job['job_id'] }
+            sio.emit(job['name'].split('on_')[1] + '_progress', progress_codec.encode(result), namespace='/DeviceNamespace')
+
+            print(f"{datetime.datetime.now()} stm32l0.py: Job {job['job_id']} ({job['name']}) raised {type(e).__name__}: {e}")
+            state = 'failed'
+
+        self._emit_job(job, state, time_taken=round(time.monotonic() - start_time, 3))
+
+    def _queue_cpu_job(priority):
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(self, *args, **kwargs):
+                try:
+                    if not self.sio_connected:
                         raise SIONotConnectedError(wrapper.__name__)
-                else:
-                    raise MutexLockedError(wrapper.__name__)
-            except (MutexLockedError, SIONotConnectedError, CPUCommsError):
-                pass
-            
-            if res is not None:
-                return res
+                except SIONotConnectedError:
+                    return
+
+                job_id = inspect.signature(func).bind(self, *args, **kwargs).arguments.get('job_id')
+
+                job, coalesced = self._jobs.submit(wrapper.__name__, args, kwargs, priority, job_id)
+                self._emit_job(job, 'coalesced' if coalesced else 'queued')
+
+            return wrapper
 
-        return wrapper
+        return decorator
 
     def on_connect(self):
         self.sio_connected = True
@@ -128,56 +230,66 @@ class STM32L0Namespace(socketio.ClientNamespace):
     def on_disconnect(self):
         self.sio_connected = False
 
-    @_mutex_use_cpu
-    def on_get_unique_id(self, data):
-        sio.emit('get_unique_id_progress', self._cpu.get_unique_id(), namespace='/DeviceNamespace')
+    def on_cancel_job(self, job_id):
+        if self._jobs.cancel(job_id):
+            print(f"{datetime.datetime.now()} stm32l0.py: Cancelled job {job_id}")
 
-    @_mutex_use_cpu
-    def on_program_bin(self, binary):
-        for result in self._cpu.program_bin(binary, STM32L0.PGM_START_ADDRESS):
-            sio.emit('program_bin_progress', result, namespace='/DeviceNamespace')
+    @_queue_cpu_job(priority=0)
+    def on_get_unique_id(self, data=None):
+        sio.emit('get_unique_id_progress', progress_codec.encode(self._cpu.get_unique_id()), namespace='/DeviceNamespace')
 
-    @_mutex_use_cpu
-    def on_run_test(self, data):
-        sio.emit('run_test_progress', self._cpu.init(), namespace='/DeviceNamespace')
-        sio.emit('run_test_progress', self._cpu.reset_run(), namespace='/DeviceNamespace')
+    @_queue_cpu_job(priority=1)
+    def on_program_bin(self, binary, differential=False):
+        for result in self._cpu.program_bin(binary, STM32L0.PGM_START_ADDRESS, differential=differential):
+            sio.emit('program_bin_progress', progress_codec.encode(result), namespace='/DeviceNamespace')
 
-    @_mutex_use_cpu
-    def on_run_provision(self, data):
-        sio.emit('run_provision_progress', self._cpu.init(), namespace='/DeviceNamespace')
-        sio.emit('run_provision_progress', self._cpu.reset_run(), namespace='/DeviceNamespace')
+    # Runs the whole DUT cycle under one lock and one OpenOCD session, then hands the running CPU
+    # over to the hardware test or provisioner via DeviceNamespace
+    @_queue_cpu_job(priority=1)
+    def on_flash_and_test(self, binary, module, handoff='test', url=None, differential=False, job_id=None):
+        uid = None
+        success = True
 
+        for result in self._cpu.flash_and_run(binary, differential=differential):
+            if result['step'] == 'get_unique_id':
+                sio.emit('get_unique_id_progress', progress_codec.encode(result), namespace='/DeviceNamespace')
 
-def get_ip_address():
-    ip = check_output(['hostname', '-I'])
-    ip = ip.split()[0]
-    ip = ip.decode('utf-8')
-
-    return ip
-
+                if result['success']:
+                    uid = result['message']
+                else:
+                    # Nothing gets flashed, but the browser is waiting on programming to finish
+                    aborted = { 'success': False, 'message': 'Programming skipped, unique ID not read', 
+                                'error': result['error'] or 'Flash and test aborted', 'job_id': job_id }
+                    sio.emit('program_bin_progress', progress_codec.encode(aborted), namespace='/DeviceNamespace')
+            else:
+                sio.emit('program_bin_progress', progress_codec.encode(result), namespace='/DeviceNamespace')
 
-def connect(n_attempts=100):
-    ns = STM32L0Namespace(STM32L0(), '/STM32L0Namespace')
-    sio.register_namespace(ns)
+            success = success and result['success']
 
-    for i in range(n_attempts):
-        print(f"{datetime.datetime.now()} stm32l0.py: Attempt {i + 1} connecting to {get_ip_address()}:80")
+        if success:
+            handoff = { 'handoff': handoff, 'module': module, 'url': url, 'uid': uid, 'job_id': job_id }
+            sio.emit('flash_and_test_handoff', progress_codec.encode(handoff), namespace='/DeviceNamespace')
 
-        try:
-            sio.connect(f'http://{get_ip_address()}:80')       
+    @_queue_cpu_job(priority=1)
+    def on_run_test(self, job_id=None):
+        for result in (self._cpu.init(), self._cpu.reset_run()):
+            result['job_id'] = job_id
+            sio.emit('run_test_progress', progress_codec.encode(result), namespace='/DeviceNamespace')
 
-            print(f"{datetime.datetime.now()} stm32l0.py: Connected to {get_ip_address()}:80")
+    @_queue_cpu_job(priority=1)
+    def on_run_provision(self, job_id=None):
+        for result in (self._cpu.init(), self._cpu.reset_run()):
+            result['job_id'] = job_id
+            sio.emit('run_provision_progress', progress_codec.encode(result), namespace='/DeviceNamespace')
 
-            break
-        except socketio.exceptions.ConnectionError:
-            sio.sleep(0.5)
 
-    if ns.sio_connected:
-        sio.sleep(10)
+def connect(n_attempts=100):
+    ns = STM32L0Namespace(STM32L0(), '/STM32L0Namespace')
+    sio.register_namespace(ns)
 
-    sio.sleep(1)
+    capabilities = [ 'get_unique_id', 'program_bin', 'flash_and_test', 'run_test', 'run_provision', 'cancel_job' ]
 
-    return ns.sio_connected
+    return readiness.connect(sio, 'stm32l0.py', capabilities, n_attempts)
 
 
 if __name__ == '__main__':
@@ -185,6 +297,6 @@ if __name__ == '__main__':
         while True:
             sio.sleep(1)
     else:
-        print(f"{datetime.datetime.now()} stm32l0.py: Failed to connect to {get_ip_address()}:80")
+        print(f"{datetime.datetime.now()} stm32l0.py: Failed to connect to {readiness.server_address()}:80")
 
 
@@ -8,7 +8,7 @@
 """
 
 # Standard library imports
-import inspect, os, re, sys
+import hashlib, inspect, os, struct, sys, tempfile, time
 
 
 if __name__ == '__main__':
@@ -19,9 +19,13 @@ if __name__ == '__main__':
 
     # Import the OCD interface from python_ocd.py
     from python_ocd import OCD
+    from pipeline import Pipeline, Step
+    import tcl
 else:
     try:
         from python_ocd.python_ocd import OCD
+        from python_ocd.pipeline import Pipeline, Step
+        from python_ocd import tcl
     except ModuleNotFoundError:
         currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
         parentdir = os.path.dirname(currentdir)
@@ -29,34 +33,83 @@ else:
 
         # Import the OCD interface from python_ocd.py
         from python_ocd import OCD
+        from pipeline import Pipeline, Step
+        import tcl
 
 import eventlet; eventlet.monkey_patch()
 
 
 class OCDTarget(OCD):
-    STATES = [ 'unknown', 'halted', 'running', 'reset', 'debug-running' ]
+    STATES = tcl.STATES
 
-    def __init__(self, openocd_cfg, tcl_ip='localhost', tcl_port=6666):
-        super().__init__(openocd_cfg, tcl_ip, tcl_port)
+    # Flash erase granularity in bytes. Targets that set this support differential flashing.
+    FLASH_SECTOR_SIZE = None
 
-    def get_state(self):
-        result = self.send('targets')
-        state = ''
+    # Cache of firmware path -> ((mtime, size), image bytes, per-sector digests)
+    _image_index = {}
 
-        if result['success']:
-            for state in OCDTarget.STATES:
-                if state in result['message']:
-                    result['state'] = state
-                    result['success'] = True
-                    break
-            
-            if not result['success']:
-                result['success'] = False
+    # Last measured erase + program throughput in bytes/s, used to estimate time saved
+    _write_rate = None
+
+    # Transfers at least this big go through a binary file (dump_image/load_image) when OpenOCD
+    # runs on this machine; smaller or remote transfers use read_memory/write_memory
+    BULK_TRANSFER_BYTES = 4096
+    MEMORY_CHUNK_BYTES = 16 * 1024
+
+    MEMORY_ARRAY = '::python_ocd_mem'
+
+    # How long to wait for OpenOCD's log line explaining a failed command to come through the drain
+    LOG_EVENT_TIMEOUT_S = 0.5
+
+    def __init__(self, openocd_cfg, tcl_ip='localhost', tcl_port=6666, gdb_port=None, telnet_port=None, 
+                 ocd_commands=None):
+        super().__init__(openocd_cfg, tcl_ip, tcl_port, gdb_port, telnet_port, ocd_commands)
+
+        # read_memory/write_memory need OpenOCD 0.12+, older versions only have mem2array/array2mem
+        self._memory_commands = 'read_memory'
+
+        # Last known CPU state, from state replies and from OpenOCD's own 'target halted' output
+        self.last_state = None
+        self.last_state_time = None
+
+        self.add_ocd_listener(self._on_ocd_event)
+
+    def _on_ocd_event(self, event):
+        if event['kind'] == 'target_state':
+            self._set_last_state(event['state'])
+
+    def _set_last_state(self, state):
+        if state is not None:
+            self.last_state = state
+            self.last_state_time = time.monotonic()
+
+    def _state_result(self, result, expected_state=None):
+        state = tcl.parse_state(result['message']) if result['success'] else None
+        self._set_last_state(state)
+
+        result['state'] = state
+
+        if expected_state is None:
+            result['success'] = state is not None
         else:
-            result['success'] = False
+            result['success'] = state == expected_state
+
+            if not result['success'] and not result['error']:
+                result['error'] = f'Expected target {expected_state}, target is {state}'
 
         return result
 
+    def get_state(self, cached=False):
+        if cached and self.last_state is not None:
+            return { 'success': True, 'message': self.last_state, 'error': '', 'state': self.last_state }
+
+        return self._state_result(self.send(tcl.CURRENT_STATE))
+
+    def wait_for_state(self, state, timeout_s=1):
+        result = self.send(tcl.wait_state_command(state, timeout_s), timeout_s=timeout_s + 5)
+
+        return self._state_result(result, state)
+
     def init(self):
         result = self.send('init')
 
@@ -67,86 +120,441 @@ class OCDTarget(OCD):
 
         return result
 
+    def _reset(self, command, expected_state, verify, timeout_s=1):
+        if not verify:
+            self.last_state = None
+            return self.send(command)
+
+        # The reset and a wait for the core to settle in the expected state go out in one write
+        results = self.send_batch([ command, tcl.wait_state_command(expected_state, timeout_s) ], 
+                                  timeout_s=timeout_s + 20)
+        result = results[0]
+
+        if len(results) == 2:
+            result['success'] = self._state_result(results[1], expected_state)['success']
+            result['state'] = results[1]['state']
+        else:
+            result['success'] = False
+
+        return result
+
     def reset_run(self, verify=True):
-        result = self.send('reset run')
+        result = self._reset('reset run', 'running', verify)
 
-        state = self.get_state()
-        if state['success']:   
-            if verify:
-                if self.get_state()['state'] == 'running':
-                    result['success'] = True
-                    result['message'] = 'Target CPU running'
-                else:
-                    result['success'] = False
-                    result['message'] = 'Failed to make target CPU run'
+        if verify:
+            if result['success']:
+                result['message'] = 'Target CPU running'
+            else:
+                result['message'] = 'Failed to make target CPU run'
         
         return result
 
     def reset_halt(self, verify=True):
-        result = self.send('reset halt')
-        
-        state = self.get_state()
-        if state['success']:   
-            if verify:
-                if self.get_state()['state'] == 'halted':
-                    result['success'] = True
-                    result['message'] = 'Target CPU successfully halted'
-                else:
-                    result['success'] = False
-                    result['message'] = 'Failed to halt target CPU'
+        result = self._reset('reset halt', 'halted', verify)
+
+        if verify:
+            if result['success']:
+                result['message'] = 'Target CPU successfully halted'
+            else:
+                result['message'] = 'Failed to halt target CPU'
         
         return result
 
     def targets(self):
         return self.send('targets')
 
-    def flash_write_image_bin(self, firmware, address):
+    def flash_write_image_bin(self, firmware, address, differential=False):
+        if differential and self.FLASH_SECTOR_SIZE:
+            return self._flash_write_image_bin_differential(firmware, address)
+
+        start_time = time.monotonic()
         result = self.send(f'flash write_image erase {firmware} {address}')
 
         if result['success']:
-            bytes_wrote_re = re.search('(wrote\s\d{3,}\sbytes)', result['message'])
+            bytes_wrote = tcl.parse_bytes_wrote(result['message'])
 
-            if bytes_wrote_re:
-                result['bytes_wrote'] = bytes_wrote_re.group().split()[1]
+            if bytes_wrote is not None:
+                result['bytes_wrote'] = bytes_wrote
                 result['success'] = True
+                self._update_write_rate(int(bytes_wrote), time.monotonic() - start_time)
             else:
                 result['success'] = False
 
         return result
 
-    def verify_image(self, firmware, address):
-        result = self.send(f'verify_image {firmware} {address}')
+    def _update_write_rate(self, n_bytes, seconds):
+        if n_bytes and seconds > 0:
+            type(self)._write_rate = n_bytes / seconds
+
+    def _get_image_index(self, firmware):
+        stat = os.stat(firmware)
+        key = (stat.st_mtime, stat.st_size)
+        cached = OCDTarget._image_index.get(firmware)
+
+        if cached is None or cached[0] != key:
+            with open(firmware, 'rb') as f:
+                image = f.read()
+
+            digests = [ hashlib.sha1(image[offset:offset + self.FLASH_SECTOR_SIZE]).digest() 
+                        for offset in range(0, len(image), self.FLASH_SECTOR_SIZE) ]
+
+            cached = (key, image, digests)
+            OCDTarget._image_index[firmware] = cached
+
+        return cached[1], cached[2]
+
+    def _is_local(self):
+        return self.tcl_ip in ('localhost', '127.0.0.1')
+
+    def _to_address(self, address):
+        return int(address, 0) if isinstance(address, str) else address
+
+    def _memory_width(self, address, length):
+        return 32 if address % 4 == 0 and length % 4 == 0 else 8
+
+    def _memory_read_command(self, address, width, count):
+        if self._memory_commands == 'read_memory':
+            return f'read_memory {address:#x} {width} {count}'
+
+        return (f'mem2array {OCDTarget.MEMORY_ARRAY} {width} {address:#x} {count}; set values {{}}; '
+                f'for {{set i 0}} {{$i < {count}}} {{incr i}} {{ lappend values ${OCDTarget.MEMORY_ARRAY}($i) }}; '
+                f'set values')
+
+    def _memory_write_command(self, address, width, values):
+        if self._memory_commands == 'read_memory':
+            return f'write_memory {address:#x} {width} {{{" ".join(hex(value) for value in values)}}}'
+
+        pairs = ' '.join(f'{i} {value:#x}' for i, value in enumerate(values))
+
+        return (f'array unset {OCDTarget.MEMORY_ARRAY}; array set {OCDTarget.MEMORY_ARRAY} {{{pairs}}}; '
+                f'array2mem {OCDTarget.MEMORY_ARRAY} {width} {address:#x} {len(values)}')
+
+    def _unpack_memory(self, message, width, count):
+        try:
+            values = [ int(value, 0) for value in message.split() ]
+        except ValueError:
+            return None
+
+        if len(values) != count:
+            return None
+
+        return struct.pack(f'<{count}{"I" if width == 32 else "B"}', *values)
+
+    def _pack_memory(self, data, width):
+        count = len(data) // (width // 8)
+
+        return list(struct.unpack(f'<{count}{"I" if width == 32 else "B"}', data))
+
+    def _chunks(self, address, length):
+        for offset in range(0, length, OCDTarget.MEMORY_CHUNK_BYTES):
+            yield address + offset, offset, min(OCDTarget.MEMORY_CHUNK_BYTES, length - offset)
+
+    def _send_memory_batch(self, build_commands):
+        results = self.send_batch(build_commands())
+
+        # Fall back to mem2array/array2mem once if this OpenOCD predates read_memory/write_memory
+        if not results[-1]['success'] and 'invalid command name' in results[-1]['message'] and \
+                self._memory_commands == 'read_memory':
+            self._memory_commands = 'mem2array'
+            results = self.send_batch(build_commands())
+
+        return results
+
+    def _dump_memory(self, address, length):
+        fd, dump_path = tempfile.mkstemp(suffix='.bin')
+        os.close(fd)
+
+        try:
+            result = self.send(f'dump_image {dump_path} {address:#x} {length}')
+
+            if result['success']:
+                with open(dump_path, 'rb') as f:
+                    data = f.read()
+
+                if len(data) != length:
+                    result['success'] = False
+                    result['error'] = f'Read {len(data)} of {length} bytes'
+                else:
+                    result['message'] = f'Read {length} bytes from {address:#x}'
+                    result['data'] = data
+        finally:
+            os.remove(dump_path)
+
+        return result
+
+    def _load_memory(self, address, data):
+        fd, load_path = tempfile.mkstemp(suffix='.bin')
+
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+
+            result = self.send(f'load_image {load_path} {address:#x} bin')
+
+            if result['success'] and f'{len(data)} bytes written' not in result['message']:
+                result['success'] = False
+        finally:
+            os.remove(load_path)
+
+        return result
+
+    def read_memory(self, address, length, dtype=None):
+        # result['data'] is a memoryview over the bytes read, or a NumPy array of dtype if given
+        address = self._to_address(address)
+
+        if length == 0:
+            # Nothing to read, and an empty batch has no result to report
+            result = { 'success': True, 'message': f'Read 0 bytes from {address:#x}', 'error': '', 'data': b'' }
+        elif length >= OCDTarget.BULK_TRANSFER_BYTES and self._is_local():
+            result = self._dump_memory(address, length)
+        else:
+            width = self._memory_width(address, length)
+            chunks = list(self._chunks(address, length))
+
+            results = self._send_memory_batch(lambda: [ 
+                self._memory_read_command(chunk_address, width, chunk_length // (width // 8)) 
+                for chunk_address, _, chunk_length in chunks ])
+
+            result = results[-1]
+            data = bytearray()
+
+            if len(results) == len(chunks) and result['success']:
+                for (_, _, chunk_length), chunk_result in zip(chunks, results):
+                    chunk = self._unpack_memory(chunk_result['message'], width, chunk_length // (width // 8))
+
+                    if chunk is None:
+                        result = { 'success': False, 'message': chunk_result['message'], 'error': 'Unexpected memory read reply' }
+                        break
+
+                    data += chunk
+                else:
+                    result = { 'success': True, 'message': f'Read {length} bytes from {address:#x}', 'error': '', 'data': bytes(data) }
+            else:
+                result['success'] = False
 
         if result['success']:
-            if 'verified' in result['message'].lower():
-                result['success'] = True
+            if dtype is not None:
+                import numpy
+
+                result['data'] = numpy.frombuffer(result['data'], dtype=dtype)
+            else:
+                result['data'] = memoryview(result['data'])
+
+        return result
+
+    def write_memory(self, address, data):
+        # data is any bytes-like object, including NumPy arrays. RAM/peripherals only: flash has 
+        # to be programmed with the flash commands.
+        address = self._to_address(address)
+        data = memoryview(data).cast('B').tobytes()
+
+        if not data:
+            result = { 'success': True, 'message': '', 'error': '' }
+        elif len(data) >= OCDTarget.BULK_TRANSFER_BYTES and self._is_local():
+            result = self._load_memory(address, data)
+        else:
+            width = self._memory_width(address, len(data))
+            chunks = list(self._chunks(address, len(data)))
+
+            results = self._send_memory_batch(lambda: [ 
+                self._memory_write_command(chunk_address, width, self._pack_memory(data[offset:offset + chunk_length], width)) 
+                for chunk_address, offset, chunk_length in chunks ])
+
+            result = results[-1]
+            result['success'] = len(results) == len(chunks) and result['success']
+
+        if result['success']:
+            result['message'] = f'Wrote {len(data)} bytes to {address:#x}'
+
+        return result
+
+    def _read_flash(self, address, length):
+        result = self.read_memory(address, length)
+
+        return result['data'].tobytes() if result['success'] else None
+
+    def _write_flash_run(self, image, address, offset, length):
+        fd, run_path = tempfile.mkstemp(suffix='.bin')
+
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(image[offset:offset + length])
+
+            return self.send(f'flash write_image erase {run_path} {address + offset:#x} bin')
+        finally:
+            os.remove(run_path)
+
+    def _flash_write_image_bin_differential(self, firmware, address):
+        # Compare each erase sector of the image against what is already in flash and only 
+        # erase/program the runs of sectors that differ
+        start_time = time.monotonic()
+        address = int(address, 0) if isinstance(address, str) else address
+        sector_size = self.FLASH_SECTOR_SIZE
+
+        try:
+            image, digests = self._get_image_index(firmware)
+        except OSError as e:
+            return { 'success': False, 'message': f'Failed to read {firmware}', 'error': str(e) }
+
+        flash = self._read_flash(address, len(image))
+
+        if flash is None:
+            # Readback failed, fall back to writing the whole image
+            return self.flash_write_image_bin(firmware, f'{address:#x}')
+
+        changed = [ hashlib.sha1(flash[offset:offset + sector_size]).digest() != digest 
+                    for offset, digest in zip(range(0, len(image), sector_size), digests) ]
+
+        runs = []
+        for sector, is_changed in enumerate(changed):
+            if not is_changed:
+                continue
+
+            if runs and runs[-1][1] == sector:
+                runs[-1][1] = sector + 1
             else:
+                runs.append([sector, sector + 1])
+
+        bytes_wrote = 0
+        write_time = 0
+
+        for first, last in runs:
+            offset = first * sector_size
+            length = min(last * sector_size, len(image)) - offset
+
+            write_start = time.monotonic()
+            result = self._write_flash_run(image, address, offset, length)
+            write_time += time.monotonic() - write_start
+
+            if not result['success'] or tcl.parse_bytes_wrote(result['message']) is None:
                 result['success'] = False
+                return result
+
+            bytes_wrote += length
+
+        self._update_write_rate(bytes_wrote, write_time)
+
+        bytes_skipped = len(image) - bytes_wrote
+        time_taken = time.monotonic() - start_time
+        write_rate = type(self)._write_rate
+
+        if write_rate:
+            time_saved = round(max(len(image) / write_rate - time_taken, 0), 3)
+        else:
+            time_saved = None
+
+        message = (f'wrote {bytes_wrote} bytes, skipped {bytes_skipped} unchanged bytes '
+                   f'({changed.count(False)} of {len(changed)} sectors) in {time_taken:.3f}s')
+
+        return { 'success': True, 'message': message, 'error': '', 'bytes_wrote': str(bytes_wrote), 
+                 'bytes_skipped': bytes_skipped, 'time_saved': time_saved }
+
+    VERIFY_MODES = [ 'checksum', 'digest', 'readback' ]
+
+    def verify_image(self, firmware, address, mode='readback'):
+        # checksum: CRC32 computed on target by OpenOCD's RAM-loaded routine, no readback
+        # digest:   one bulk dump of the region compared against the firmware file's digest
+        # readback: OpenOCD verify_image, reading the image back and comparing on the host
+        # Fast modes fall back to readback if they cannot be run on this target/OpenOCD.
+        start_time = time.monotonic()
+
+        if mode == 'checksum':
+            result = self._verify_image_checksum(firmware, address)
+        elif mode == 'digest':
+            result = self._verify_image_digest(firmware, address)
+        else:
+            result = None
+
+        if result is None:
+            mode = 'readback'
+            result = self.send(f'verify_image {firmware} {address}')
+
+            if result['success']:
+                if tcl.is_verified(result['message']):
+                    result['success'] = True
+                else:
+                    result['success'] = False
+
+        result['verify_mode'] = mode
+        result['time_taken'] = round(time.monotonic() - start_time, 3)
 
         return result
 
-    def program_bin(self, firmware, address, verify=True):
+    def _verify_image_checksum(self, firmware, address):
+        since = self.last_ocd_event()
+        # Batched for the command's error status: a mismatch fails the command, and OpenOCD 
+        # reports it in its log rather than in the reply
+        result = self.send_batch([ f'verify_image_checksum {firmware} {address}' ])[-1]
+
+        if 'invalid command name' in result['message']:
+            return None
+
+        if not result['success']:
+            mismatch = self.wait_for_ocd_event('checksum_mismatch', OCDTarget.LOG_EVENT_TIMEOUT_S, since=since)
+
+            if mismatch is None:
+                # Failed some other way, or no log to tell; leave it to the full readback
+                return None
+
+            return { 'success': False, 'message': mismatch['line'], 'error': 'Checksum mismatch' }
+
+        if not tcl.is_verified(result['message']):
+            return None
+
+        return result
+
+    def _verify_image_digest(self, firmware, address):
+        if not self.FLASH_SECTOR_SIZE:
+            return None
+
+        address = int(address, 0) if isinstance(address, str) else address
+
+        try:
+            image, digests = self._get_image_index(firmware)
+        except OSError as e:
+            return { 'success': False, 'message': f'Failed to read {firmware}', 'error': str(e) }
+
+        flash = self._read_flash(address, len(image))
+
+        if flash is None:
+            return None
+
+        mismatched = sum(hashlib.sha1(flash[offset:offset + self.FLASH_SECTOR_SIZE]).digest() != digest 
+                         for offset, digest in zip(range(0, len(image), self.FLASH_SECTOR_SIZE), digests))
+
+        if mismatched:
+            return { 'success': False, 'message': f'digest mismatch in {mismatched} of {len(digests)} sectors', 'error': '' }
+
+        return { 'success': True, 'message': f'verified {len(image)} bytes', 'error': '' }
+
+    def _firmware_path(self, firmware):
         if __name__ == '__main__':
-            firmware = f'../firmware/{firmware}'
-        else:
-            firmware = f'python_ocd/firmware/{firmware}'
+            return f'../firmware/{firmware}'
+
+        return f'python_ocd/firmware/{firmware}'
+
+    # Flash, verify and run steps for a target that is already initialised and halted
+    def _program_steps(self, firmware, address, verify=True, differential=False, verify_mode='checksum'):
+        firmware = self._firmware_path(firmware)
+
+        steps = [ Step('flash write_image erase', lambda: self.flash_write_image_bin(firmware, address, differential)) ]
 
-        func_dict = { 'init': 'self.init()',
-                      'reset halt': 'self.reset_halt()',
-                      'flash write_image erase': f'self.flash_write_image_bin("{firmware}", "{address}")',
-                      'verify_image': f'self.verify_image("{firmware}", "{address}")',
-                      'init': 'self.init()',
-                      'reset run': 'self.reset_run()'
-                    }
+        if verify:
+            steps.append(Step('verify_image', lambda: self.verify_image(firmware, address, verify_mode)))
 
-        for name, func in func_dict.items():
-            result = eval(func)
+        steps.append(Step('reset run', self.reset_run))
 
+        return steps
+
+    def _run_steps(self, steps):
+        for result in Pipeline(steps).run():
             if not result['success']:
-                result['message'] = f'{result["message"]}: {name}'
-                yield result
+                result['message'] = f'{result["message"]}: {result["step"]}'
 
-                break
-            else:
-                yield result
-        
\ No newline at end of file
+            yield result
+
+    def program_bin(self, firmware, address, verify=True, differential=False, verify_mode='checksum'):
+        steps = [ Step('init', self.init), Step('reset halt', self.reset_halt) ]
+        steps += self._program_steps(firmware, address, verify, differential, verify_mode)
+
+        yield from self._run_steps(steps)
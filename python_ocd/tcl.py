@@ -0,0 +1,138 @@
+"""
+    file:    tcl.py
+    version: 0.2.0
+    author:  Adam Mitchell
+    brief:   OpenOCD Tcl protocol helpers shared by the blocking and asyncio clients: command
+             framing, batch scripts and parsing of OpenOCD replies. Deliberately free of eventlet
+             so that it can be imported without monkey patching.
+"""
+
+# Standard library imports
+import re
+
+
+COMMAND_TOKEN = '\x1a'
+COMMAND_TOKEN_BYTES = COMMAND_TOKEN.encode('utf-8')
+
+BATCH_FLAG    = '::python_ocd_batch_ok'
+BATCH_ERROR   = 'python_ocd batch error: '
+BATCH_SKIPPED = 'python_ocd batch skipped'
+
+STATES = [ 'unknown', 'halted', 'running', 'reset', 'debug-running' ]
+
+
+def frame(command):
+    return (command + COMMAND_TOKEN).encode('utf-8')
+
+
+def check_reply(recv_data, recv_string=None, timed_out=False):
+    success = False
+    error = ''
+
+    if not timed_out:
+        if recv_string is not None:
+            if recv_string in recv_data:
+                success = True
+            else:
+                success = False
+                error = f'{recv_string} not in {recv_data}'
+        else:
+            success = True
+    else:
+        success = False
+        error = 'Timed out'
+
+    return { 'success': success, 'message': recv_data, 'error': error }
+
+
+def batch_command(command, recv_string=None):
+    # Wrap a command so that OpenOCD skips it once an earlier command in the same batch has
+    # failed. Failures are Tcl errors or, when given, recv_string missing from the output.
+    if recv_string is None:
+        check = ''
+    else:
+        check = f' elseif {{[string first {{{recv_string}}} $r] < 0}} {{ set {BATCH_FLAG} 0; set r }}'
+
+    return (f'if {{${BATCH_FLAG}}} {{ '
+            f'if {{[catch {{{command}}} r]}} {{ set {BATCH_FLAG} 0; set r "{BATCH_ERROR}$r" }}'
+            f'{check} else {{ set r }} '
+            f'}} else {{ set r "{BATCH_SKIPPED}" }}')
+
+
+def batch_script(commands):
+    # Commands are strings or (command, recv_string) tuples
+    commands = [ (command, None) if isinstance(command, str) else tuple(command) for command in commands ]
+
+    script = [ f'set {BATCH_FLAG} 1' ]
+    script += [ batch_command(command, recv_string) for command, recv_string in commands ]
+
+    return commands, script
+
+
+def batch_results(commands, replies, timed_out=False):
+    # replies includes the reply to the leading 'set' of the batch script. An empty batch has
+    # no results
+    results = []
+
+    for (command, recv_string), reply in zip(commands, replies[1:]):
+        if reply.startswith(BATCH_SKIPPED):
+            break
+
+        if reply.startswith(BATCH_ERROR):
+            result = { 'success': False, 'message': reply[len(BATCH_ERROR):], 'error': f'{command} failed' }
+        else:
+            result = check_reply(reply, recv_string, timed_out)
+
+        result['command'] = command
+        results.append(result)
+
+        if not result['success']:
+            break
+
+    if not results and commands:
+        results.append({ 'success': False, 'message': '', 'error': 'Timed out', 'command': commands[0][0] })
+
+    return results
+
+
+CURRENT_STATE = '[target current] curstate'
+
+
+def parse_state(message):
+    # Exact curstate reply first, otherwise look for a state in 'targets' style output
+    message = message.strip()
+
+    if message in STATES:
+        return message
+
+    for state in STATES:
+        if state in message:
+            return state
+
+    return None
+
+
+def wait_state_command(state, timeout_s, poll_ms=10):
+    # Waits inside OpenOCD so that reaching the state costs a single round-trip. Evaluates to the
+    # current state, whether or not it was reached in time.
+    timeout_ms = int(timeout_s * 1000)
+
+    if state == 'halted':
+        return f'catch {{wait_halt {timeout_ms}}}; {CURRENT_STATE}'
+
+    return (f'set deadline [expr {{[clock milliseconds] + {timeout_ms}}}]; '
+            f'while {{[{CURRENT_STATE}] ne "{state}" && [clock milliseconds] < $deadline}} {{ sleep {poll_ms} }}; '
+            f'{CURRENT_STATE}')
+
+
+def parse_bytes_wrote(message):
+    bytes_wrote_re = re.search(r'(wrote\s\d{3,}\sbytes)', message)
+
+    if bytes_wrote_re:
+        return bytes_wrote_re.group().split()[1]
+
+    return None
+
+
+def is_verified(message):
+    return 'verified' in message.lower()
@@ -0,0 +1,81 @@
+"""
+    file:    readiness.py
+    version: 0.2.0
+    author:  Adam Mitchell
+    brief:   Start-up handshake shared by the Socket.IO worker services. As soon as a worker's
+             /StationNamespace connection is accepted it registers its service name and 
+             capabilities, and waits for the server's ack. This replaces the fixed sleeps that 
+             used to follow every connect.
+"""
+
+# Standard library imports
+import datetime, functools, os, threading
+from subprocess import check_output
+
+# 3rd-party library imports
+import socketio
+
+
+@functools.lru_cache(maxsize=1)
+def server_address():
+    # The server binds to this host's first address; resolved once per process
+    ip = check_output(['hostname', '-I'])
+    ip = ip.split()[0]
+    ip = ip.decode('utf-8')
+
+    return ip
+
+
+class ReadinessNamespace(socketio.ClientNamespace):
+    def __init__(self, service, capabilities, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+
+        self.service = service
+        self.capabilities = capabilities
+        self.ack = None
+
+        self._registered = threading.Event()
+
+    # Register from our own connect handler: it runs once the server has accepted the namespace,
+    # whereas anything the server emits from its connect handler arrives before that
+    def on_connect(self):
+        registration = { 'service': self.service, 'capabilities': self.capabilities, 'pid': os.getpid() }
+        self.emit('register', registration, callback=self.on_register_ack)
+
+    def on_register_ack(self, ack):
+        self.ack = ack
+        self._registered.set()
+
+    def on_disconnect(self):
+        self._registered.clear()
+
+    def wait(self, timeout_s):
+        return self._registered.wait(timeout_s)
+
+
+def connect(sio, service, capabilities, n_attempts=100, ack_timeout_s=5, url=None):
+    ready = ReadinessNamespace(service, capabilities, '/StationNamespace')
+    sio.register_namespace(ready)
+
+    url = url or f'http://{server_address()}:80'
+    backoff_s = 0.1
+
+    for i in range(n_attempts):
+        try:
+            sio.connect(url)
+            break
+        except socketio.exceptions.ConnectionError:
+            # Retry quickly while the server is coming up, backing off to at most 1s
+            sio.sleep(backoff_s)
+            backoff_s = min(backoff_s * 2, 1)
+    else:
+        print(f"{datetime.datetime.now()} {service}: Failed to connect to {url} after {n_attempts} attempts")
+        return False
+
+    if not ready.wait(ack_timeout_s):
+        print(f"{datetime.datetime.now()} {service}: Connected to {url} but registration was not acknowledged")
+        return False
+
+    print(f"{datetime.datetime.now()} {service}: Registered with {url} after {i + 1} attempt(s), {ready.ack}")
+
+    return True
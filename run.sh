@@ -1,6 +1,14 @@
-sudo /home/pi/miniconda3/envs/rpi-test-platform/bin/python app.py &
-sudo /home/pi/miniconda3/envs/rpi-test-platform/bin/python python_ocd/targets/stm32l0.py &
-sudo /home/pi/miniconda3/envs/rpi-test-platform/bin/python module_tests/hardware_test.py &
-sudo /home/pi/miniconda3/envs/rpi-test-platform/bin/python module_provision/provision.py &
-sudo /home/pi/miniconda3/envs/rpi-test-platform/bin/python gpio_manager.py
+PYTHON=/home/pi/miniconda3/envs/rpi-test-platform/bin/python
 
+# ./run.sh --single-process runs everything in one interpreter on an in-memory event bus; the 
+# default keeps each service in its own process for isolation
+if [ "$1" = "--single-process" ]; then
+    sudo $PYTHON single_process.py
+    exit
+fi
+
+sudo $PYTHON app.py &
+sudo $PYTHON python_ocd/targets/stm32l0.py &
+sudo $PYTHON module_tests/hardware_test.py &
+sudo $PYTHON module_provision/provision.py &
+sudo $PYTHON gpio_manager.py
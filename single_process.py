@@ -0,0 +1,54 @@
+"""
+    file:    single_process.py
+    version: 0.2.0
+    author:  Adam Mitchell
+    brief:   Runs the webserver and all hardware workers in one interpreter. The workers' Socket.IO
+             clients are replaced by an in-memory EventBus, so hand-offs between namespaces are 
+             function calls on worker threads rather than round trips through the Flask server.
+             Browsers still connect over Socket.IO as usual. Use run.sh --single-process to start.
+"""
+
+# Standard library imports
+import datetime
+
+# 3rd-party library imports
+import eventlet; eventlet.monkey_patch()
+
+# Thingpilot library imports
+import app, gpio_manager, progress_codec
+from event_bus import EventBus
+from module_provision import provision
+from module_tests import hardware_test
+from python_ocd.targets import stm32l0
+
+
+def start_workers(bus):
+    # Records stay Python dicts on the bus, there's nothing to gain from packing them
+    progress_codec.BINARY = False
+
+    # Module-level sio is looked up at call time, so swapping it redirects every emit
+    for module in (stm32l0, hardware_test, provision, gpio_manager):
+        module.sio = bus
+
+    bus.register_namespace(stm32l0.STM32L0Namespace(stm32l0.STM32L0(), '/STM32L0Namespace'))
+    bus.register_namespace(hardware_test.HWTestNamespace(hardware_test.HardwareTest(), '/HWTestNamespace'))
+    bus.register_namespace(provision.ProvisionerNamespace(provision.ThingpilotProvisioner(), '/ProvisionerNamespace'))
+    bus.register_namespace(gpio_manager.GPIOManagerNamespace(gpio_manager.GPIOManager(), '/GPIOManagerNamespace'))
+
+
+if __name__ == '__main__':
+    bus = EventBus()
+    app.bus = bus
+
+    device_namespace = app.DeviceNamespace('/DeviceNamespace')
+    gpio_namespace = app.GPIONamespace('/GPIONamespace')
+
+    bus.register_namespace(device_namespace, concurrent=True)
+    bus.register_namespace(gpio_namespace, concurrent=True)
+
+    start_workers(bus)
+
+    print(f"{datetime.datetime.now()} single_process.py: Workers started on in-process event bus")
+
+    # The reloader would re-run this script in a child process and start a second set of workers
+    app.run(device_namespace, gpio_namespace, use_reloader=False)
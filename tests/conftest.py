@@ -0,0 +1,14 @@
+"""
+    file:    conftest.py
+    version: 0.2.0
+    author:  Adam Mitchell
+    brief:   pytest set-up shared by the tests: makes the station's top-level modules importable
+             when the tests are run from anywhere. Run from the repository root: 
+             python -m pytest tests
+"""
+
+# Standard library imports
+import inspect, os, sys
+
+currentdir = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+sys.path.insert(0, os.path.dirname(currentdir))
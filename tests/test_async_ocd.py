@@ -0,0 +1,63 @@
+"""
+    file:    test_async_ocd.py
+    version: 0.2.0
+    author:  Adam Mitchell
+    brief:   AsyncOCD fails every pending command and marks the session unhealthy when its reply
+             stream is lost, whether to a reply bigger than READ_LIMIT or to the server closing
+             the connection, rather than leaving callers waiting forever.
+"""
+
+# Standard library imports
+import asyncio
+
+# Thingpilot library imports
+from python_ocd import tcl
+from python_ocd.async_ocd import AsyncOCD
+
+
+async def serve(reply):
+    # A Tcl server that answers every command with reply, or closes the connection if None
+    async def handle(reader, writer):
+        await reader.readuntil(tcl.COMMAND_TOKEN_BYTES)
+
+        if reply is None:
+            writer.close()
+            return
+
+        writer.write(reply + tcl.COMMAND_TOKEN_BYTES)
+        await writer.drain()
+
+    return await asyncio.start_server(handle, '127.0.0.1', 0)
+
+
+async def send_twice(reply):
+    server = await serve(reply)
+    ocd = AsyncOCD('127.0.0.1', server.sockets[0].getsockname()[1])
+
+    try:
+        await ocd.connect()
+        first = await ocd.send('mdw 0x08000000 0x10000', timeout_s=5)
+        second = await ocd.send('version', timeout_s=5)
+
+        return ocd.is_healthy(), first, second
+    finally:
+        await ocd.close()
+        server.close()
+
+
+def test_oversized_reply_fails_pending(monkeypatch):
+    monkeypatch.setattr(AsyncOCD, 'READ_LIMIT', 1024)
+
+    healthy, first, second = asyncio.run(send_twice(b'0' * 4096))
+
+    assert not healthy
+    assert not first['success'] and 'LimitOverrunError' in first['error']
+    assert not second['success'] and 'unhealthy' in second['error']
+
+
+def test_closed_connection_fails_pending():
+    healthy, first, second = asyncio.run(send_twice(None))
+
+    assert not healthy
+    assert not first['success'] and 'IncompleteReadError' in first['error']
+    assert not second['success']
@@ -0,0 +1,73 @@
+"""
+    file:    test_job_queue.py
+    version: 0.2.0
+    author:  Adam Mitchell
+    brief:   The STM32L0 job queue keeps serving jobs after one of them fails part way through,
+             e.g. when an emit to the server raises.
+"""
+
+# Standard library imports
+import threading, time
+
+# Thingpilot library imports
+import progress_codec
+from python_ocd.targets import stm32l0
+
+
+class FlakySIO():
+    # Stands in for the worker's socketio.Client: the first 'started' job status fails to send
+    def __init__(self):
+        self.emits = []
+        self.failed = False
+
+    def emit(self, event, data=None, namespace=None):
+        data = progress_codec.decode(data)
+
+        if event == 'job_progress' and data['state'] == 'started' and not self.failed:
+            self.failed = True
+            raise ConnectionError('connection lost')
+
+        self.emits.append((event, data))
+
+    def start_background_task(self, target, *args, **kwargs):
+        thread = threading.Thread(target=target, args=args, kwargs=kwargs, daemon=True)
+        thread.start()
+
+        return thread
+
+
+class FakeCPU():
+    def __enter__(self):
+        return True
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def get_unique_id(self):
+        return { 'success': True, 'message': '00000001 00000002 00000003', 'error': '' }
+
+
+def wait_for(condition, timeout_s=5):
+    deadline = time.monotonic() + timeout_s
+
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    return condition()
+
+
+def test_worker_survives_failed_emit(monkeypatch):
+    sio = FlakySIO()
+    monkeypatch.setattr(stm32l0, 'sio', sio)
+
+    ns = stm32l0.STM32L0Namespace(FakeCPU(), '/STM32L0Namespace')
+    ns.sio_connected = True
+
+    ns.on_get_unique_id()
+    assert wait_for(lambda: sio.failed and ns._jobs.current is None and ns._jobs.depth() == 0)
+
+    # The first job lost its status emit; the next one must still run on a live worker
+    ns.on_get_unique_id('again')
+    assert wait_for(lambda: any(event == 'get_unique_id_progress' for event, _ in sio.emits))
+    assert wait_for(lambda: any(data.get('state') == 'done' for event, data in sio.emits if event == 'job_progress'))
+    assert ns._jobs.depth() == 0
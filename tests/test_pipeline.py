@@ -0,0 +1,110 @@
+"""
+    file:    test_pipeline.py
+    version: 0.2.0
+    author:  Adam Mitchell
+    brief:   The step pipeline shared by programming, the hardware test and provisioning: the
+             final step runs after a failure, failing steps are retried the given number of
+             times, a step that overruns its timeout is reported as timed out, and steps only
+             start once the steps they depend on have finished.
+"""
+
+# Standard library imports
+import threading, time
+
+# Thingpilot library imports
+from python_ocd.pipeline import Pipeline, Step
+
+
+def ok(message=''):
+    return { 'success': True, 'message': message, 'error': '' }
+
+
+def failed(message=''):
+    return { 'success': False, 'message': message, 'error': 'Failed' }
+
+
+def test_final_runs_after_failure():
+    ran = []
+
+    steps = [ Step('first', lambda: ran.append('first') or failed()),
+              Step('second', lambda: ran.append('second') or ok()) ]
+    pipeline = Pipeline(steps, final=Step('final', lambda: ran.append('final') or ok()))
+
+    results = list(pipeline.run())
+
+    assert ran == [ 'first', 'final' ]
+    assert [ result['step'] for result in results ] == [ 'first', 'final' ]
+    assert pipeline.success is False
+
+
+def test_retries():
+    attempts = []
+
+    def flaky():
+        attempts.append(time.time())
+        return ok() if len(attempts) == 3 else failed()
+
+    results = list(Pipeline([ Step('flaky', flaky, retries=2) ]).run())
+
+    assert results[0]['success'] and results[0]['attempts'] == 3
+
+    # Raising counts as a failed attempt, and attempts stop at retries + 1
+    def broken():
+        raise RuntimeError('no probe')
+
+    pipeline = Pipeline([ Step('broken', broken, retries=1) ])
+    results = list(pipeline.run())
+
+    assert not results[0]['success'] and results[0]['attempts'] == 2
+    assert results[0]['error'] == 'no probe'
+    assert pipeline.success is False
+
+
+def test_step_timeout():
+    release = threading.Event()
+
+    steps = [ Step('hangs', lambda: release.wait(5) and ok(), timeout_s=0.1),
+              Step('after', ok) ]
+    pipeline = Pipeline(steps, final=Step('final', ok))
+
+    start = time.monotonic()
+    results = list(pipeline.run())
+    release.set()
+
+    assert time.monotonic() - start < 2
+    assert [ result['step'] for result in results ] == [ 'hangs', 'final' ]
+    assert results[0]['error'] == 'Timed out'
+    assert pipeline.success is False
+
+
+def test_dependency_ordering():
+    finished = {}
+    started = {}
+
+    def step(name, delay_s):
+        def run():
+            started[name] = time.monotonic()
+            time.sleep(delay_s)
+            finished[name] = time.monotonic()
+            return ok(name)
+
+        return run
+
+    # a and b have no dependencies and run side by side; c needs both, d needs only a
+    steps = [ Step('a', step('a', 0.05), depends_on=[]),
+              Step('b', step('b', 0.2), depends_on=[]),
+              Step('c', step('c', 0), depends_on=[ 'a', 'b' ]),
+              Step('d', step('d', 0), depends_on=[ 'a' ]) ]
+
+    results = list(Pipeline(steps).run())
+
+    assert all(result['success'] for result in results)
+    assert started['c'] >= max(finished['a'], finished['b'])
+    assert started['d'] >= finished['a'] and started['d'] < finished['b']
+    assert [ result['step'] for result in results ].index('c') == 3
+
+    # Without depends_on, steps run one after another in the order given
+    order = []
+    list(Pipeline([ Step(name, lambda name=name: order.append(name) or ok()) for name in 'xyz' ]).run())
+
+    assert order == [ 'x', 'y', 'z' ]
@@ -0,0 +1,64 @@
+"""
+    file:    test_readiness.py
+    version: 0.2.0
+    author:  Adam Mitchell
+    brief:   Worker start-up handshake against a real Flask-SocketIO server running app.py's
+             StationNamespace: each worker must register and get its ack on the first connect.
+"""
+
+# Standard library imports
+import inspect, os, socket, subprocess, sys
+
+# 3rd-party library imports
+import pytest, socketio
+
+# Thingpilot library imports
+import readiness
+
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe()))))
+
+SERVER = """
+import eventlet; eventlet.monkey_patch()
+import sys, app
+app.socketio.on_namespace(app.StationNamespace('/StationNamespace'))
+app.socketio.run(app.app, host='127.0.0.1', port=int(sys.argv[1]), log_output=False)
+"""
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+
+        return s.getsockname()[1]
+
+
+@pytest.fixture
+def server_url():
+    port = free_port()
+    server = subprocess.Popen([ sys.executable, '-c', SERVER, str(port) ], cwd=ROOT_DIR, 
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+    yield f'http://127.0.0.1:{port}'
+
+    server.terminate()
+    server.wait(timeout=5)
+
+
+def test_workers_register_on_first_connect(server_url):
+    services = [ f'worker_{n}' for n in range(3) ]
+    clients = []
+
+    try:
+        for service in services:
+            client = socketio.Client()
+            clients.append(client)
+
+            # The server may still be starting, which connect() retries through
+            assert readiness.connect(client, service, [ 'run_test' ], n_attempts=50, ack_timeout_s=5, url=server_url)
+
+        status = clients[0].call('status', namespace='/StationNamespace', timeout=5)
+        assert sorted(status['workers']) == services
+    finally:
+        for client in clients:
+            client.disconnect()
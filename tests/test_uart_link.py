@@ -0,0 +1,156 @@
+"""
+    file:    test_uart_link.py
+    version: 0.2.0
+    author:  Adam Mitchell
+    brief:   UARTLink.flush() forgets everything received so far, including a partial frame 
+             still waiting in the ring buffer, so the next frame is parsed on its own, and bytes
+             a read returns after flush() ran are dropped too. Baud 
+             negotiation only caches rates that passed, and a link whose negotiated rate starts
+             failing CRCs drops back to the default rate.
+"""
+
+# Standard library imports
+import inspect, os, sys, threading, time
+
+# Thingpilot library imports
+import gpio_backend, uart_link
+from module_tests import pinmap
+
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe()))))
+
+
+class LoopbackPort():
+    # Just enough of a pyserial port for UARTLink; feed() makes bytes arrive
+    def __init__(self):
+        self.is_open = True
+        self.timeout = uart_link.IDLE_TIMEOUT_S
+
+        self._buffer = bytearray()
+        self._ready = threading.Condition()
+
+    @property
+    def in_waiting(self):
+        return len(self._buffer)
+
+    def feed(self, data):
+        with self._ready:
+            self._buffer += data
+            self._ready.notify_all()
+
+    def read(self, size=1):
+        with self._ready:
+            if not self._buffer:
+                self._ready.wait(self.timeout)
+
+            data = bytes(self._buffer[:size])
+            del self._buffer[:size]
+
+        return data
+
+    def write(self, data):
+        return len(data)
+
+    def reset_input_buffer(self):
+        with self._ready:
+            self._buffer.clear()
+
+    def close(self):
+        with self._ready:
+            self.is_open = False
+            self._ready.notify_all()
+
+
+def test_flush_drops_partial_frame():
+    port = LoopbackPort()
+    link = uart_link.UARTLink(port, framed=True).start()
+
+    try:
+        # Half a frame, well inside the idle timeout so it is still waiting in the ring
+        port.feed(uart_link.encode_frame(0, 'stale reply')[:6])
+        time.sleep(0.005)
+
+        link.flush()
+        port.feed(uart_link.encode_frame(0, 'fresh'))
+
+        message = link.expect('fresh').wait(1)
+
+        assert message is not None and message.framed and message.text == 'fresh'
+        assert link.crc_errors == 0
+    finally:
+        link.close()
+
+
+def test_flush_drops_bytes_read_while_flushing():
+    port = LoopbackPort()
+    # A long read timeout so the reader is sure to be blocked in read() when flush() runs
+    port.timeout = 5
+    link = uart_link.UARTLink(port).start()
+
+    try:
+        time.sleep(0.01)
+        flusher = threading.Thread(target=link.flush)
+        flusher.start()
+        time.sleep(0.01)
+
+        # Arrives while the read that started before the flush is still waiting
+        port.feed(b'STALE\n')
+        flusher.join(1)
+
+        assert not flusher.is_alive()
+        assert link.expect('STALE').wait(0.1) is None
+
+        port.feed(b'fresh\n')
+        assert link.expect('fresh').wait(1) is not None
+    finally:
+        link.close()
+
+
+def simulated_link(**kwargs):
+    # The benchmarks' simulated module speaks the framed protocol and follows AT+BAUD
+    sys.path.insert(0, os.path.join(ROOT_DIR, 'benchmarks'))
+    from sim_dut import SimulatedDUT
+
+    dut = SimulatedDUT(gpio_backend.SimulatedGPIO(), pinmap.wright, timeout=uart_link.IDLE_TIMEOUT_S, **kwargs)
+
+    return dut, uart_link.UARTLink(dut, framed=True).start()
+
+
+def test_unanswered_negotiation_is_not_cached():
+    dut, link = simulated_link(negotiate=False)
+
+    try:
+        assert link.negotiate_baud(cache_key='test_booting') == uart_link.DEFAULT_BAUD
+        assert 'test_booting' not in uart_link._baud_cache
+    finally:
+        link.close()
+
+    # Once the module answers, the same key negotiates a faster rate and caches it
+    dut, link = simulated_link()
+
+    try:
+        assert link.negotiate_baud(cache_key='test_booting') == max(uart_link.BAUD_RATES)
+        assert uart_link._baud_cache['test_booting'] == max(uart_link.BAUD_RATES)
+    finally:
+        link.close()
+        uart_link._baud_cache.pop('test_booting', None)
+
+
+def test_crc_errors_drop_link_back_to_default_baud():
+    dut, link = simulated_link()
+
+    try:
+        assert link.negotiate_baud(cache_key='test_degrading') == max(uart_link.BAUD_RATES)
+
+        # The line degrades: every reply at the negotiated rate now fails its CRC
+        dut.max_baud = uart_link.DEFAULT_BAUD
+        replies = [ link.transact('AT+PING=55aa', 'PONG: 55aa', timeout_s=0.1) for _ in range(uart_link.CRC_ERROR_LIMIT) ]
+
+        # The request that tipped it over is retried at the default rate and answered
+        assert replies[-1] is not None
+        assert link.port.baudrate == uart_link.DEFAULT_BAUD and dut.dut_baud == uart_link.DEFAULT_BAUD
+        assert 'test_degrading' not in uart_link._baud_cache
+        assert link.transact('AT+PING=55aa', 'PONG: 55aa', timeout_s=0.5) is not None
+    finally:
+        link.close()
+        uart_link._baud_cache.pop('test_degrading', None)
@@ -0,0 +1,538 @@
+"""
+    file:    uart_link.py
+    version: 0.2.0
+    author:  Adam Mitchell
+    brief:   Serial protocol layer shared by the hardware test and provisioning. A background
+             thread reads the port into a ring buffer and parses it into messages as bytes
+             arrive: length/CRC framed messages, or newline terminated (or idle terminated) text
+             from legacy firmware. Requests are correlated with their replies by frame sequence
+             number or by the expected reply text, and a waiting caller wakes as soon as its
+             reply is parsed rather than on the next readline timeout. Framed links can 
+             negotiate a faster baud rate once the module is in test or provisioning mode.
+"""
+
+# Standard library imports
+import binascii, collections, datetime, struct, threading, time
+
+
+# Frame: SOF | payload length (u16 LE) | seq (u8) | payload | CRC-16/CCITT (u16 LE) over
+# length, seq and payload. seq 0 is unsolicited, requests use 1-255 and replies echo them.
+SOF = 0x7E
+HEADER = struct.Struct('<BHB')
+CRC = struct.Struct('<H')
+MAX_PAYLOAD = 1024
+
+# Serial read timeout for ports handed to UARTLink: how long the line has to be quiet before
+# unterminated legacy text is taken as a complete message
+IDLE_TIMEOUT_S = 0.05
+
+# Baud negotiation: AT+BAUD=<rate> is answered with BAUD: <rate> (or ERROR) at the current
+# rate, then both ends switch. The host checks the new rate with AT+PING=<pattern> probes and
+# confirms with AT+BAUDOK; the module goes back to its previous rate by itself if no 
+# confirmation arrives within BAUD_REVERT_S, so a rate that doesn't work can't strand the link
+DEFAULT_BAUD = 9600
+BAUD_RATES = [ 1000000, 921600, 460800, 230400, 115200 ]
+BAUD_REVERT_S = 0.25
+# CRC errors tolerated at a negotiated rate before the link drops back to DEFAULT_BAUD
+CRC_ERROR_LIMIT = 3
+# 0x55/0xAA alternate every bit, 0x00/0xFF hold the line, and the rest walks the bits
+BAUD_PROBE = bytes([ 0x55, 0xAA, 0x00, 0xFF ] + [ 1 << bit for bit in range(8) ]).hex()
+
+Message = collections.namedtuple('Message', 'text seq framed')
+
+# Baud rate that passed its probes per module type, so only the first session pays for finding it
+_baud_cache = {}
+
+
+def crc16(data):
+    return binascii.crc_hqx(data, 0xFFFF)
+
+
+def encode_frame(seq, payload):
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+
+    body = HEADER.pack(SOF, len(payload), seq)[1:] + payload
+
+    return bytes([ SOF ]) + body + CRC.pack(crc16(body))
+
+
+class RingBuffer():
+    # Fixed size byte FIFO; when full the oldest bytes are overwritten and counted as overruns
+    def __init__(self, capacity=4096):
+        self._buffer = bytearray(capacity)
+        self._capacity = capacity
+        self._head = 0
+        self._size = 0
+        self.overruns = 0
+
+    def __len__(self):
+        return self._size
+
+    def write(self, data):
+        data = data[-self._capacity:]
+        dropped = max(0, self._size + len(data) - self._capacity)
+
+        if dropped:
+            self.overruns += dropped
+            self.consume(dropped)
+
+        tail = (self._head + self._size) % self._capacity
+        first = min(len(data), self._capacity - tail)
+        self._buffer[tail:tail + first] = data[:first]
+        self._buffer[:len(data) - first] = data[first:]
+        self._size += len(data)
+
+    def peek(self, n=None):
+        n = self._size if n is None else min(n, self._size)
+        end = self._head + n
+
+        if end <= self._capacity:
+            return bytes(self._buffer[self._head:end])
+
+        return bytes(self._buffer[self._head:]) + bytes(self._buffer[:end - self._capacity])
+
+    def consume(self, n):
+        n = min(n, self._size)
+        self._head = (self._head + n) % self._capacity
+        self._size -= n
+
+    def clear(self):
+        self.consume(self._size)
+
+
+class FrameParser():
+    # Turns the bytes in a RingBuffer into Messages. Anything not starting with SOF is legacy
+    # text, delimited by a newline, the next SOF or, when the line goes quiet, by flush()
+    def __init__(self, ring):
+        self.ring = ring
+        self.crc_errors = 0
+        self.framing_errors = 0
+
+    def _text(self, data):
+        text = data.decode('utf-8', errors='replace').strip()
+
+        return Message(text, None, False) if text else None
+
+    def _next(self):
+        data = self.ring.peek()
+
+        if not data:
+            return None, False
+
+        if data[0] == SOF:
+            if len(data) < HEADER.size:
+                return None, False
+
+            _, length, seq = HEADER.unpack_from(data)
+
+            if length > MAX_PAYLOAD:
+                self.framing_errors += 1
+                self.ring.consume(1)
+                return None, True
+
+            end = HEADER.size + length + CRC.size
+
+            if len(data) < end:
+                return None, False
+
+            (crc,) = CRC.unpack_from(data, end - CRC.size)
+
+            if crc != crc16(data[1:end - CRC.size]):
+                # Drop the corrupted frame, but only up to the next SOF in case the length was
+                # what got corrupted and a real frame starts inside it
+                self.crc_errors += 1
+                resync = data.find(bytes([ SOF ]), 1, end)
+                self.ring.consume(resync if resync > 0 else end)
+                return None, True
+
+            self.ring.consume(end)
+            payload = data[HEADER.size:end - CRC.size]
+
+            return Message(payload.decode('utf-8', errors='replace'), seq, True), True
+
+        newline = data.find(b'\n')
+        sof = data.find(bytes([ SOF ]))
+        ends = [ index for index in (newline + 1 if newline >= 0 else -1, sof) if index > 0 ]
+
+        if not ends:
+            return None, False
+
+        self.ring.consume(min(ends))
+
+        return self._text(data[:min(ends)]), True
+
+    def parse(self):
+        messages = []
+        progress = True
+
+        while progress:
+            message, progress = self._next()
+
+            if message is not None:
+                messages.append(message)
+
+        return messages
+
+    def flush(self):
+        # The line has gone quiet: a partial frame will never complete, and unterminated text
+        # is all the legacy firmware is going to send
+        messages = []
+
+        while len(self.ring):
+            messages += self.parse()
+            data = self.ring.peek()
+
+            if not data:
+                break
+
+            if data[0] == SOF:
+                self.framing_errors += 1
+                resync = data.find(bytes([ SOF ]), 1)
+                self.ring.consume(resync if resync > 0 else len(data))
+            else:
+                self.ring.consume(len(data))
+                message = self._text(data)
+
+                if message is not None:
+                    messages.append(message)
+
+        return messages
+
+
+class PendingReply():
+    def __init__(self, match, seq=None):
+        self.match = match
+        self.seq = seq
+        self.message = None
+        self._event = threading.Event()
+
+    def matches(self, message):
+        if self.seq is not None and message.seq != self.seq:
+            return False
+
+        if self.match is None:
+            return True
+
+        if callable(self.match):
+            return self.match(message.text)
+
+        return self.match in message.text
+
+    def resolve(self, message):
+        self.message = message
+        self._event.set()
+
+    def done(self):
+        return self._event.is_set()
+
+    def wait(self, timeout_s=None):
+        self._event.wait(timeout_s)
+
+        return self.message
+
+
+class UARTLink():
+    # tag prefixes the sent/received log lines, e.g. 'hardware_test.py: (Wright)'
+    def __init__(self, port, framed=False, tag='uart_link.py:', backlog=32):
+        self.port = port
+        self.framed = framed
+        self.tag = tag
+
+        self.ring = RingBuffer()
+        self.parser = FrameParser(self.ring)
+
+        self._pending = []
+        self._backlog = collections.deque(maxlen=backlog)
+        self._lock = threading.Lock()
+        self._reading = threading.Condition(self._lock)
+        self._write_lock = threading.Lock()
+        self._seq = 0
+        self._generation = 0
+        self._read_generation = 0
+        self._baud_key = None
+        self._crc_baseline = 0
+        self._changing_baud = False
+        self._stop = threading.Event()
+        self._thread = None
+
+    @property
+    def crc_errors(self):
+        return self.parser.crc_errors
+
+    def start(self):
+        if self._thread is None:
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._read, daemon=True)
+            self._thread.start()
+
+        return self
+
+    def _read(self):
+        while not self._stop.is_set():
+            with self._lock:
+                generation = self._generation
+                self._read_generation = generation
+                self._reading.notify_all()
+
+            try:
+                data = self.port.read(max(1, self.port.in_waiting))
+            except Exception as e:
+                if not self._stop.is_set():
+                    print(f"{datetime.datetime.now()} {self.tag} serial read failed: {e}")
+
+                break
+
+            with self._lock:
+                # flush() ran while this read was in progress, so what it returned was received
+                # before the flush, and so was any partial frame it would have completed
+                if generation != self._generation:
+                    self.ring.clear()
+                    continue
+
+                if data:
+                    self.ring.write(data)
+                    messages = self.parser.parse()
+                else:
+                    messages = self.parser.flush()
+
+                for message in messages:
+                    self._dispatch(message)
+
+    # Called with _lock held
+    def _dispatch(self, message):
+        print(f"{datetime.datetime.now()} {self.tag} received: {message.text}")
+
+        for pending in self._pending:
+            if pending.matches(message):
+                self._pending.remove(pending)
+                pending.resolve(message)
+                return
+
+        self._backlog.append(message)
+
+    def _register(self, pending):
+        with self._lock:
+            for message in self._backlog:
+                if pending.matches(message):
+                    self._backlog.remove(message)
+                    pending.resolve(message)
+                    return pending
+
+            self._pending.append(pending)
+
+        return pending
+
+    def _next_seq(self):
+        self._seq = self._seq % 255 + 1
+
+        return self._seq
+
+    def send(self, command, seq=0):
+        data = encode_frame(seq, command) if self.framed else bytes(command, 'utf-8')
+
+        with self._write_lock:
+            self.port.write(data)
+
+        print(f"{datetime.datetime.now()} {self.tag} sent: {command}")
+
+    def expect(self, match=None):
+        # Wait for a message the other end sends unprompted, e.g. AT+CTRL at boot. Messages
+        # that arrived before anyone was waiting are kept in a short backlog and match too
+        return self._register(PendingReply(match))
+
+    def request(self, command, match=None):
+        # Framed replies are matched on the echoed seq (and match, if given); legacy replies on
+        # match alone. Register before sending so a fast reply can't be missed
+        seq = self._next_seq() if self.framed else None
+        pending = PendingReply(match, seq)
+
+        if seq is None and match is None:
+            raise ValueError('Legacy requests need a reply to match')
+
+        self._register(pending)
+        self.send(command, seq or 0)
+
+        return pending
+
+    def cancel(self, pending):
+        with self._lock:
+            if pending in self._pending:
+                self._pending.remove(pending)
+
+    def transact(self, command, match=None, timeout_s=1.0):
+        # request() and wait for the reply; None on timeout
+        pending = self.request(command, match)
+        message = pending.wait(timeout_s)
+
+        if message is None:
+            self.cancel(pending)
+
+        # If the negotiated rate has stopped being reliable and this reply was lost to it, ask
+        # again at the default rate
+        if self._fall_back_on_errors() and message is None:
+            message = self.transact(command, match, timeout_s)
+
+        return message
+
+    def _switch_baud(self, rate):
+        # Let anything queued go out at the old rate before changing it
+        self.port.flush()
+        self.port.baudrate = rate
+        self.flush()
+
+    def _try_baud(self, rate, probes, timeout_s):
+        base = self.port.baudrate
+        reply = self.transact(f'AT+BAUD={rate}', lambda text: text.startswith('BAUD:') or 'ERROR' in text, timeout_s)
+
+        if reply is None:
+            return None
+
+        if reply.text != f'BAUD: {rate}':
+            return False
+
+        self._switch_baud(rate)
+        crc_errors = self.crc_errors
+
+        for _ in range(probes):
+            if self.transact(f'AT+PING={BAUD_PROBE}', f'PONG: {BAUD_PROBE}', timeout_s) is None:
+                break
+        else:
+            if self.crc_errors == crc_errors and self.transact('AT+BAUDOK', 'OK', timeout_s) is not None:
+                return True
+
+        # The module reverts by itself once BAUD_REVERT_S passes without AT+BAUDOK
+        self._switch_baud(base)
+        time.sleep(BAUD_REVERT_S)
+        self.flush()
+
+        return False
+
+    def negotiate_baud(self, cache_key=None, rates=None, probes=4, timeout_s=0.2):
+        # Move the link to the fastest rate that passes the probes, trying a rate cached for
+        # cache_key first. Firmware that doesn't answer AT+BAUD stays where it is. Returns the
+        # rate in use
+        if not self.framed:
+            return self.port.baudrate
+
+        rates = sorted(BAUD_RATES if rates is None else rates, reverse=True)
+        cached = _baud_cache.get(cache_key)
+        negotiated = None
+
+        if cached is not None:
+            rates = [ cached ] + [ rate for rate in rates if rate != cached ]
+
+        # Probing bad rates is expected to cost CRC errors; don't let those trigger a fall back
+        self._changing_baud = True
+
+        try:
+            for rate in rates:
+                if rate <= self.port.baudrate:
+                    continue
+
+                result = self._try_baud(rate, probes, timeout_s)
+
+                if result is None:
+                    print(f"{datetime.datetime.now()} {self.tag} no answer to AT+BAUD, staying at {self.port.baudrate} baud")
+                    break
+
+                if result:
+                    negotiated = rate
+                    break
+
+                print(f"{datetime.datetime.now()} {self.tag} {rate} baud failed, falling back")
+        finally:
+            self._changing_baud = False
+
+        # Only a rate that passed its probes is worth trying first next time; a module that was
+        # still booting or a rate that failed mustn't stop the next session from negotiating
+        if cache_key is not None:
+            if negotiated is not None:
+                _baud_cache[cache_key] = negotiated
+            else:
+                _baud_cache.pop(cache_key, None)
+
+        self._baud_key = cache_key
+        self._crc_baseline = self.crc_errors
+
+        print(f"{datetime.datetime.now()} {self.tag} link running at {self.port.baudrate} baud")
+
+        return self.port.baudrate
+
+    def _fall_back_on_errors(self):
+        # Past CRC_ERROR_LIMIT corrupt frames at a negotiated rate, move both ends back to 
+        # DEFAULT_BAUD for the rest of the session and forget the cached rate. Runs on the 
+        # caller's thread, never the reader's, as it waits for replies
+        if self._changing_baud or self.port.baudrate == DEFAULT_BAUD:
+            return False
+
+        if self.crc_errors - self._crc_baseline < CRC_ERROR_LIMIT:
+            return False
+
+        print(f"{datetime.datetime.now()} {self.tag} {self.crc_errors - self._crc_baseline} CRC errors at "
+              f"{self.port.baudrate} baud, dropping back to {DEFAULT_BAUD}")
+
+        self._changing_baud = True
+
+        try:
+            _baud_cache.pop(self._baud_key, None)
+            rate = self.port.baudrate
+
+            for _ in range(3):
+                # The module's answer may well be lost at this rate, so don't depend on it; what
+                # counts is that AT+BAUDOK gets through at the default rate before it reverts
+                self.transact(f'AT+BAUD={DEFAULT_BAUD}', f'BAUD: {DEFAULT_BAUD}', timeout_s=0.05)
+                self._switch_baud(DEFAULT_BAUD)
+
+                if self.transact('AT+BAUDOK', 'OK', timeout_s=0.1) is not None:
+                    break
+
+                # Let the module settle back on the negotiated rate and start again from there
+                self._switch_baud(rate)
+                time.sleep(BAUD_REVERT_S)
+            else:
+                self._switch_baud(DEFAULT_BAUD)
+        finally:
+            self._changing_baud = False
+            self._crc_baseline = self.crc_errors
+
+        return True
+
+    def flush(self):
+        # Forget everything received so far, like reset_input_buffer() on the raw port: unread
+        # messages, bytes waiting to be parsed (including any partial frame) and the port's buffer.
+        # A read in progress may yet return bytes from before the flush, so wait until the reader
+        # has thrown those away and started a fresh read
+        with self._lock:
+            self._generation += 1
+            generation = self._generation
+            self.port.reset_input_buffer()
+            self.ring.clear()
+            self._backlog.clear()
+
+            thread = self._thread
+
+            if thread is None or thread is threading.current_thread():
+                return
+
+            # pyserial can wake a blocked read; otherwise it returns by the port's timeout
+            cancel_read = getattr(self.port, 'cancel_read', None)
+
+            if cancel_read is not None:
+                cancel_read()
+
+            self._reading.wait_for(lambda: self._read_generation == generation or not thread.is_alive(),
+                                   timeout=(self.port.timeout or IDLE_TIMEOUT_S) + 0.1)
+
+    def close(self):
+        self._stop.set()
+
+        if self._thread is not None:
+            self._thread.join(timeout=1)
+            self._thread = None
+
+        with self._lock:
+            self._pending.clear()
+
+        if self.port.is_open:
+            self.port.close()